@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""Fingerprinted, precompressed static assets.
+
+Run ``python -m engineering_diplomats.assets [static folder]`` at build
+time to copy every static file to ``dist/`` under a name that contains a
+hash of its contents, next to ``.gz`` and ``.br`` copies. Templates link
+to them with ``asset_url()``. Because the names change whenever the
+contents do, the files are served with a one-year Cache-Control.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import sys
+
+from hashlib import sha256
+from typing import Dict
+
+from flask import Flask, current_app, request, send_from_directory, url_for
+
+from engineering_diplomats.compression import COMPRESSIBLE, brotli, negotiate
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_manifests = {}
+
+
+def build(static_folder: str) -> Dict[str, str]:
+	"""Write fingerprinted and precompressed copies of every static file.
+
+	Parameters
+	----------
+	static_folder : str
+		The application's static folder.
+
+	Returns
+	-------
+	Dict[str, str]
+		The manifest, mapping each file's name to its fingerprinted name,
+		both relative to the static folder.
+	"""
+	manifest = {}
+	for root, directories, files in os.walk(static_folder):
+		if os.path.relpath(root, static_folder).split(os.sep)[0] == DIST:
+			directories[:] = []
+			continue
+		for name in sorted(files):
+			path = os.path.join(root, name)
+			filename = os.path.relpath(path, static_folder).replace(os.sep, "/")
+			with open(path, "rb") as source:
+				data = source.read()
+			stem, extension = os.path.splitext(filename)
+			fingerprinted = f"{DIST}/{stem}.{sha256(data).hexdigest()[:12]}{extension}"
+			target = os.path.join(static_folder, *fingerprinted.split("/"))
+			os.makedirs(os.path.dirname(target), exist_ok=True)
+			with open(target, "wb") as output:
+				output.write(data)
+
+			if COMPRESSIBLE.match(mimetypes.guess_type(filename)[0] or ""):
+				# mtime=0 keeps the output identical across builds
+				variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+				if brotli is not None:
+					variants[".br"] = brotli.compress(data, quality=11)
+				for suffix, compressed in variants.items():
+					if len(compressed) < len(data):
+						with open(target + suffix, "wb") as output:
+							output.write(compressed)
+			manifest[filename] = fingerprinted
+
+	with open(os.path.join(static_folder, DIST, MANIFEST), "w") as output:
+		json.dump(manifest, output, indent=2, sort_keys=True)
+	return manifest
+
+
+def load_manifest(static_folder: str) -> Dict[str, str]:
+	"""Read the manifest written by build(), once per process.
+
+	Returns
+	-------
+	Dict[str, str]
+		The manifest, or an empty one if the build step has not run.
+	"""
+	if static_folder not in _manifests:
+		try:
+			with open(os.path.join(static_folder, DIST, MANIFEST)) as manifest:
+				_manifests[static_folder] = json.load(manifest)
+		except FileNotFoundError:
+			_manifests[static_folder] = {}
+	return _manifests[static_folder]
+
+
+def asset_url(filename: str, **kwargs) -> str:
+	"""url_for("static") for the fingerprinted copy of ``filename``, if one was built.
+
+	Parameters
+	----------
+	filename : str
+		The file's name relative to the static folder, e.g. "css/styles.css".
+	"""
+	filename = load_manifest(current_app.static_folder).get(filename, filename)
+	return url_for("static", filename=filename, **kwargs)
+
+
+def send_static_file(filename: str):
+	"""Serve a static file, preferring a precompressed copy the client accepts.
+
+	Fingerprinted files under dist/ never change, so they are cached
+	for a year. Other files keep Flask's default caching.
+	"""
+	static_folder = current_app.static_folder
+	immutable = filename.startswith(f"{DIST}/")
+	response = None
+	if immutable:
+		encoding = negotiate(request.headers.get("Accept-Encoding"))
+		suffix = {"br": ".br", "gzip": ".gz"}.get(encoding)
+		if suffix is not None and os.path.isfile(os.path.join(static_folder, filename + suffix)):
+			response = send_from_directory(
+				static_folder,
+				filename + suffix,
+				mimetype=mimetypes.guess_type(filename)[0],
+				max_age=IMMUTABLE_MAX_AGE,
+			)
+			response.headers["Content-Encoding"] = encoding
+		else:
+			response = send_from_directory(static_folder, filename, max_age=IMMUTABLE_MAX_AGE)
+		response.cache_control.public = True
+		response.cache_control.immutable = True
+		response.vary.add("Accept-Encoding")
+		return response
+	return send_from_directory(static_folder, filename)
+
+
+def init_assets(app: Flask) -> None:
+	"""Serve precompressed static files and register asset_url() with Jinja."""
+	if app.has_static_folder:
+		app.view_functions["static"] = send_static_file
+	app.add_template_global(asset_url)
+
+
+if __name__ == "__main__": # pragma: no cover
+	folder = sys.argv[1] if len(sys.argv) > 1 else os.environ.get(
+		"STATIC_FOLDER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "views", "static")
+	)
+	for original, fingerprinted in build(folder).items():
+		print(f"{original} -> {fingerprinted}")
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""Response compression for the WSGI application."""
+
+import gzip
+import os
+import re
+import zlib
+
+from itertools import chain
+from typing import Iterable, List, Tuple, Union
+
+try:
+	import brotli
+except ImportError: # pragma: no cover
+	brotli = None
+
+# Content types worth compressing; images and fonts are already compressed
+COMPRESSIBLE = re.compile(r"^(text/|application/(json|javascript|xml|xhtml\+xml|manifest\+json)|image/svg\+xml)")
+
+# Encodings in order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encoding: str) -> Union[str, None]:
+	"""Pick the preferred encoding that an Accept-Encoding header allows.
+
+	Parameters
+	----------
+	accept_encoding : str
+		The request's Accept-Encoding header, e.g. "gzip, deflate, br".
+
+	Returns
+	-------
+	Union[str, None]
+		"br" or "gzip", or None to send the response as is.
+	"""
+	accepted = {}
+	for part in (accept_encoding or "").split(","):
+		name, _, params = part.strip().partition(";")
+		quality = 1.0
+		match = re.search(r"q=([0-9.]+)", params)
+		if match is not None:
+			try:
+				quality = float(match.group(1))
+			except ValueError:
+				quality = 0.0
+		accepted[name.strip().lower()] = quality
+	for encoding in ENCODINGS:
+		if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+			return encoding
+	return None
+
+
+class Compress(object):
+	"""WSGI middleware that compresses responses with Brotli or gzip.
+
+	The encoding is negotiated from Accept-Encoding, preferring Brotli
+	when the brotli package is installed. Responses are left alone if
+	they are already encoded (e.g. precompressed static files), are not
+	text, are smaller than ``min_size`` or have no body; those that could
+	be compressed for another request still get Vary: Accept-Encoding.
+	Responses without a Content-Length are streamed: each chunk the
+	application yields is compressed and flushed on its own, so a
+	streamed page still reaches the browser progressively. Chunks passed
+	to the WSGI write() callable are sent before the returned body.
+
+	Compressed responses get an encoding-specific ETag, e.g. "abc-gzip",
+	and the suffix is stripped from If-None-Match before the application
+	sees it, so conditional requests keep working.
+
+	Attributes
+	----------
+	app : Callable
+		The wrapped WSGI application.
+	min_size : int
+		Responses with a smaller Content-Length are sent uncompressed.
+	level : int
+		gzip compression level; Brotli uses the matching quality.
+	"""
+	def __init__(self, app, min_size: int = 500, level: int = 6):
+		self.app = app
+		self.min_size = min_size
+		self.level = level
+
+
+	@classmethod
+	def from_environment(cls, app) -> "Compress":
+		"""Wrap ``app`` as configured by COMPRESS_MIN_SIZE and COMPRESS_LEVEL."""
+		return cls(
+			app,
+			min_size=int(os.environ.get("COMPRESS_MIN_SIZE", 500)),
+			level=int(os.environ.get("COMPRESS_LEVEL", 6)),
+		)
+
+
+	def __call__(self, environ, start_response):
+		encoding = negotiate(environ.get("HTTP_ACCEPT_ENCODING"))
+		if encoding is None or environ.get("REQUEST_METHOD") == "HEAD":
+			def identity(status: str, headers: List[Tuple[str, str]], exc_info=None):
+				return start_response(status, self._varied(status, headers), exc_info)
+			return self.app(environ, identity)
+		if_none_match = environ.get("HTTP_IF_NONE_MATCH", "")
+		suffixed = f"-{encoding}\"" in if_none_match
+		if suffixed:
+			environ["HTTP_IF_NONE_MATCH"] = if_none_match.replace(f"-{encoding}\"", "\"")
+
+		response = {}
+		written = []
+
+		def capture(status: str, headers: List[Tuple[str, str]], exc_info=None):
+			response.update(status=status, headers=headers, exc_info=exc_info)
+			# Chunks passed to write() are sent before the returned iterable
+			return written.append
+
+		# Run the application up to its first chunk here rather than lazily,
+		# so that it stays inside any deadline set by an outer middleware
+		body = self.app(environ, capture)
+		chunks = chain(written, body)
+		try:
+			first = next(chunks, b"")
+		except BaseException:
+			self._close(body)
+			raise
+		status, headers, exc_info = response["status"], response["headers"], response["exc_info"]
+
+		length = self._header(headers, "Content-Length")
+		if not self._compressible(status, headers) or (length is not None and int(length) < self.min_size):
+			if status[:3] == "304" and suffixed:
+				# Confirm the compressed representation the client holds
+				headers = [(k, self._etag(v, encoding) if k.lower() == "etag" else v) for k, v in headers]
+			start_response(status, self._varied(status, headers), exc_info)
+			return self._pass(first, chunks, body)
+
+		headers = [(k, v) for k, v in headers if k.lower() not in ("content-length", "vary")] + [
+			("Content-Encoding", encoding),
+			("Vary", self._vary(headers)),
+		]
+		headers = [(k, self._etag(v, encoding) if k.lower() == "etag" else v) for k, v in headers]
+		if length is None:
+			start_response(status, headers, exc_info)
+			return self._stream(encoding, first, chunks, body)
+
+		# The body has a known, modest size; compress it in one piece
+		try:
+			data = self._compress_all(encoding, b"".join(chain([first], chunks)))
+		finally:
+			self._close(body)
+		start_response(status, headers + [("Content-Length", str(len(data)))], exc_info)
+		return [data]
+
+
+	def _pass(self, first: bytes, chunks: Iterable[bytes], body) -> Iterable[bytes]:
+		"""Yield the body unchanged."""
+		try:
+			yield first
+			yield from chunks
+		finally:
+			self._close(body)
+
+
+	def _stream(self, encoding: str, first: bytes, chunks: Iterable[bytes], body) -> Iterable[bytes]:
+		"""Yield the body compressed chunk by chunk, flushing after each chunk."""
+		try:
+			compressor = _StreamCompressor(encoding, self.level)
+			for chunk in chain([first], chunks):
+				if chunk:
+					data = compressor.process(chunk)
+					if data:
+						yield data
+			yield compressor.finish()
+		finally:
+			self._close(body)
+
+
+	@staticmethod
+	def _close(body) -> None:
+		if hasattr(body, "close"):
+			body.close()
+
+
+	def _compressible(self, status: str, headers: List[Tuple[str, str]]) -> bool:
+		if status[:3] in ("204", "206", "304") or self._header(headers, "Content-Encoding") is not None:
+			return False
+		if "no-transform" in (self._header(headers, "Cache-Control") or ""):
+			return False
+		return COMPRESSIBLE.match(self._header(headers, "Content-Type") or "") is not None
+
+
+	def _varied(self, status: str, headers: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+		"""Add Accept-Encoding to Vary if the response could have been compressed for another request."""
+		if not self._compressible(status, headers):
+			return headers
+		return [(k, v) for k, v in headers if k.lower() != "vary"] + [("Vary", self._vary(headers))]
+
+
+	def _compress_all(self, encoding: str, data: bytes) -> bytes:
+		if encoding == "br":
+			return brotli.compress(data, quality=min(11, self.level + 1))
+		return gzip.compress(data, compresslevel=self.level)
+
+
+	@staticmethod
+	def _header(headers: List[Tuple[str, str]], name: str) -> Union[str, None]:
+		for key, value in headers:
+			if key.lower() == name.lower():
+				return value
+		return None
+
+
+	@classmethod
+	def _vary(cls, headers: List[Tuple[str, str]]) -> str:
+		vary = [v.strip() for v in (cls._header(headers, "Vary") or "").split(",") if v.strip()]
+		if "accept-encoding" not in (v.lower() for v in vary):
+			vary.append("Accept-Encoding")
+		return ", ".join(vary)
+
+
+	@staticmethod
+	def _etag(etag: str, encoding: str) -> str:
+		return f"{etag[:-1]}-{encoding}\"" if etag.endswith("\"") else etag
+
+
+class _StreamCompressor(object):
+	"""Compresses a stream chunk by chunk, flushing after each chunk."""
+	def __init__(self, encoding: str, level: int):
+		self.encoding = encoding
+		if encoding == "br":
+			self._compressor = brotli.Compressor(quality=min(11, level + 1))
+		else:
+			# wbits=31 writes a gzip header and trailer
+			self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+	def process(self, chunk: bytes) -> bytes:
+		if self.encoding == "br":
+			return self._compressor.process(chunk) + self._compressor.flush()
+		return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+	def finish(self) -> bytes:
+		return self._compressor.finish() if self.encoding == "br" else self._compressor.flush()
@@ -2,4 +2,5 @@
 
 from .cache import MemcachedConnector
 from .db import MongoConnector
-from .mailer import Mailer
+from .http import HTTPClient, HttpPool
+from .mailer import Mailer, SMTPPool
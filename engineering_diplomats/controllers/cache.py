@@ -1,18 +1,109 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import math
 import os
+import pickle
+import zlib
+
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+from time import monotonic, time
+from typing import Any, Callable, Dict, Iterable, Tuple
 
 import bmemcached
+import logme
+
+from bmemcached.exceptions import MemcachedException
+
+# Leading byte of every value this connector writes
+RAW, COMPRESSED = b"r", b"z"
+
+# memcached rejects keys longer than this or containing whitespace and control characters
+MAX_KEY_LENGTH = 250
+
+
+class LRUCache(object):
+	"""A bounded, thread-safe mapping whose entries expire individually.
+
+	Attributes
+	----------
+	maxsize : int
+		The number of entries kept; the least recently used entry is evicted first.
+	"""
+	def __init__(self, maxsize: int = 1024):
+		self.maxsize = maxsize
+		self._entries = OrderedDict()
+		self._lock = Lock()
+
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+
+	def get(self, key: str, default: Any = None) -> Any:
+		"""Return the value stored under ``key``, or ``default`` if it is missing or expired."""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return default
+			if entry[0] <= monotonic():
+				del self._entries[key]
+				return default
+			self._entries.move_to_end(key)
+			return entry[1]
 
 
+	def set(self, key: str, value: Any, ttl: float) -> None:
+		"""Store ``value`` under ``key`` for ``ttl`` seconds, or drop ``key`` if ``ttl`` is not positive."""
+		if ttl <= 0 or self.maxsize <= 0:
+			self.delete(key)
+			return
+		with self._lock:
+			self._entries[key] = (monotonic() + ttl, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+
+	def delete(self, key: str) -> None:
+		"""Remove ``key`` if it is present."""
+		with self._lock:
+			self._entries.pop(key, None)
+
+
+	def clear(self) -> None:
+		"""Remove every entry."""
+		with self._lock:
+			self._entries.clear()
+
+
+@logme.log
 class MemcachedConnector(object):
-	"""Provides a connection to a cloud-based memcached instance.
+	"""Provides a connection to a cloud-based memcached instance,
+	fronted by a small in-process LRU.
+
+	Reads check the in-process tier (L1) first, then memcached (L2),
+	which is shared by every worker and pod. Values are pickled and,
+	above ``compress_min`` bytes, zlib-compressed; the client's own
+	compression is turned off so they are not compressed twice. Each
+	value carries its absolute expiry, so an entry copied from L2 into
+	L1 expires at the same moment in both tiers.
+
+	Keys are namespaced, e.g. ``get("points", email)``, so that callers
+	cannot collide with one another.
 
 	Attributes
 	----------
 	client : bmemcached.Client
 		Authenticated and connected memcached instance.
+	local : LRUCache
+		The in-process tier, sized by CACHE_L1_SIZE entries.
+	prefix : str
+		Prepended to every key, from CACHE_PREFIX.
+	compress_min : int
+		Serialized values at least this large are compressed, from CACHE_COMPRESS_MIN.
 
 	See Also
 	--------
@@ -21,7 +112,217 @@ class MemcachedConnector(object):
 	"""
 	def __init__(self):
 		self.client = bmemcached.Client(
-			(f"{os.environ.get('MEMCACHED_HOST')}:{os.environ.get('MEMCACHED_PORT')}"), 
+			(f"{os.environ.get('MEMCACHED_HOST')}:{os.environ.get('MEMCACHED_PORT')}"),
 			os.environ.get("MEMCACHED_USERNAME"),
 			os.environ.get("MEMCACHED_PASSWORD"),
 		)
+		self.local = LRUCache(int(os.environ.get("CACHE_L1_SIZE", 1024)))
+		self.prefix = os.environ.get("CACHE_PREFIX", "ed")
+		self.compress_min = int(os.environ.get("CACHE_COMPRESS_MIN", 1024))
+		self._counters = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "sets": 0, "errors": 0}
+		self._counters_lock = Lock()
+		self._flights = {}
+		self._flights_lock = Lock()
+
+
+	@property
+	def stats(self) -> Dict[str, int]:
+		"""Hit, miss, set and error counters since startup."""
+		with self._counters_lock:
+			return dict(self._counters)
+
+
+	def get(self, namespace: str, key: str, default: Any = None, local_ttl: float = None) -> Any:
+		"""Return a cached value, checking the in-process tier before memcached.
+
+		Parameters
+		----------
+		namespace : str
+			The namespace the value was stored in.
+		key : str
+			The value's key within the namespace.
+		default : Any
+			Returned if the value is not cached.
+		local_ttl : float
+			Upper bound on how long a value read from memcached is kept
+			in the in-process tier, for values that other processes may
+			change or delete. None keeps it until it expires.
+		"""
+		return self.get_multi(namespace, [key], local_ttl).get(key, default)
+
+
+	def get_multi(self, namespace: str, keys: Iterable[str], local_ttl: float = None) -> Dict[str, Any]:
+		"""Return the cached values for ``keys``, fetching any L1 misses from memcached at once.
+
+		Returns
+		-------
+		Dict[str, Any]
+			The values that were found, by key. Missing keys are left out.
+		"""
+		found, remote = {}, {}
+		for key in keys:
+			full_key = self._key(namespace, key)
+			entry = self.local.get(full_key)
+			if entry is not None:
+				found[key] = entry
+			else:
+				remote[full_key] = key
+		l1_hits = len(found)
+
+		if remote:
+			try:
+				values = self.client.get_multi(list(remote))
+			except (MemcachedException, OSError) as e:
+				self.logger.warning(f"memcached get_multi failed: {e}")
+				self._count("errors")
+				values = {}
+			for full_key, data in values.items():
+				entry = self._loads(data)
+				if entry is None:
+					continue
+				remaining = entry[0] - time()
+				self.local.set(full_key, entry, remaining if local_ttl is None else min(remaining, local_ttl))
+				found[remote[full_key]] = entry
+
+		self._count("l1_hits", l1_hits)
+		self._count("l2_hits", len(found) - l1_hits)
+		self._count("misses", len(remote) - (len(found) - l1_hits))
+		return {key: entry[1] for key, entry in found.items()}
+
+
+	def set(self, namespace: str, key: str, value: Any, ttl: float, local_ttl: float = None) -> bool:
+		"""Store a value in both tiers for ``ttl`` seconds, or ``local_ttl`` seconds in the in-process tier.
+
+		Returns
+		-------
+		bool
+			True if memcached accepted the value. The in-process
+			tier is updated regardless.
+		"""
+		full_key = self._key(namespace, key)
+		entry = (time() + ttl, value)
+		self.local.set(full_key, entry, ttl if local_ttl is None else min(ttl, local_ttl))
+		self._count("sets")
+		try:
+			return bool(self.client.set(full_key, self._dumps(entry), time=_expiry(ttl), compress_level=0))
+		except (MemcachedException, OSError) as e:
+			self.logger.warning(f"memcached set failed: {e}")
+			self._count("errors")
+			return False
+
+
+	def delete(self, namespace: str, key: str) -> None:
+		"""Remove a value from both tiers."""
+		full_key = self._key(namespace, key)
+		self.local.delete(full_key)
+		try:
+			self.client.delete(full_key)
+		except (MemcachedException, OSError) as e:
+			self.logger.warning(f"memcached delete failed: {e}")
+			self._count("errors")
+
+
+	def touch(self, namespace: str, keys: Iterable[str], ttl: float) -> int:
+		"""Extend the expiry of values in memcached without changing them.
+
+		Each value is rewritten with compare-and-swap, so a value that
+		another process changes in the meantime is left as it is.
+
+		Returns
+		-------
+		int
+			The number of values whose expiry was extended.
+		"""
+		touched = 0
+		for key in keys:
+			full_key = self._key(namespace, key)
+			try:
+				data, cas = self.client.gets(full_key)
+				entry = self._loads(data) if data is not None else None
+				data = self._dumps((time() + ttl, entry[1])) if entry is not None else None
+				if data is not None and self.client.cas(full_key, data, cas, time=_expiry(ttl), compress_level=0):
+					touched += 1
+			except (MemcachedException, OSError) as e:
+				self.logger.warning(f"memcached touch failed: {e}")
+				self._count("errors")
+		return touched
+
+
+	def get_or_set(self, namespace: str, key: str, compute: Callable[[], Any], ttl: float) -> Any:
+		"""Return a cached value, computing and storing it on a miss.
+
+		Concurrent callers in this process that miss the same key wait
+		for the first one to compute it instead of all calling ``compute``.
+
+		Parameters
+		----------
+		compute : Callable[[], Any]
+			Produces the value on a miss, e.g. a database query.
+		ttl : float
+			Seconds to cache a computed value for.
+		"""
+		missing = object()
+		value = self.get(namespace, key, missing)
+		if value is not missing:
+			return value
+
+		full_key = self._key(namespace, key)
+		with self._flights_lock:
+			lock, waiters = self._flights.get(full_key, (Lock(), 0))
+			self._flights[full_key] = (lock, waiters + 1)
+		try:
+			with lock:
+				# Check again in case another caller just computed the value,
+				# which is only in memcached if the in-process tier is disabled
+				value = self.get(namespace, key, missing)
+				if value is not missing:
+					return value
+				value = compute()
+				self.set(namespace, key, value, ttl)
+				return value
+		finally:
+			with self._flights_lock:
+				lock, waiters = self._flights[full_key]
+				if waiters == 1:
+					del self._flights[full_key]
+				else:
+					self._flights[full_key] = (lock, waiters - 1)
+
+
+	def _key(self, namespace: str, key: str) -> str:
+		full_key = f"{self.prefix}:{namespace}:{key}"
+		if len(full_key) > MAX_KEY_LENGTH or any(c.isspace() or not c.isprintable() for c in full_key):
+			full_key = f"{self.prefix}:{namespace}:{sha1(str(key).encode()).hexdigest()}"
+		return full_key
+
+
+	def _dumps(self, entry: Tuple[float, Any]) -> bytes:
+		data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+		if len(data) >= self.compress_min:
+			return COMPRESSED + zlib.compress(data)
+		return RAW + data
+
+
+	def _loads(self, data: bytes) -> Tuple[float, Any]:
+		"""Deserialize a value written by _dumps, or None if it is unreadable or expired."""
+		try:
+			if data[:1] == COMPRESSED:
+				entry = pickle.loads(zlib.decompress(data[1:]))
+			elif data[:1] == RAW:
+				entry = pickle.loads(data[1:])
+			else:
+				return None
+		except (pickle.UnpicklingError, zlib.error, TypeError, EOFError, AttributeError, ImportError) as e:
+			self.logger.warning(f"Discarding unreadable cache entry: {e}")
+			return None
+		return entry if entry[0] > time() else None
+
+
+	def _count(self, counter: str, amount: int = 1) -> None:
+		with self._counters_lock:
+			self._counters[counter] += amount
+
+
+def _expiry(ttl: float) -> int:
+	"""memcached's expiry for ``ttl`` seconds; it takes whole seconds and reads 0 as "never"."""
+	return max(1, math.ceil(ttl))
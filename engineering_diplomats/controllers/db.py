@@ -3,17 +3,34 @@
 import logging
 import os
 
-from typing import List
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter
+from typing import List, Tuple, Union
 
 import logme
 
+import pymongo
+
 from bson.objectid import ObjectId
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient, ReturnDocument
+from pymongo.change_stream import ChangeStream
 from pymongo.cursor import CursorType
-from pymongo.errors import ExecutionTimeout, OperationFailure, ServerSelectionTimeoutError
+from pymongo.errors import ExecutionTimeout, OperationFailure, PyMongoError, ServerSelectionTimeoutError
 
+from engineering_diplomats.decorators import cached
+from engineering_diplomats.metrics import dependency_seconds, measure
 from engineering_diplomats.models import QuestionDocument
-from engineering_diplomats.controllers.cache import MemcachedConnector
+from engineering_diplomats.settings import get_cache
+
+# Fields rendered on the questions page and used to answer a question
+QUESTION_FIELDS = {
+	"question_id": True,
+	"submitters_name": True,
+	"submitters_email": True,
+	"submission_date": True,
+	"question": True,
+}
 
 @logme.log
 class MongoConnector(object):
@@ -31,6 +48,8 @@ class MongoConnector(object):
 		Database collection used for current Engineering Diplomats
 	questions_collection : pymongo.collection
 		Database collection for submitted questions
+	outbox_collection : pymongo.collection
+		Database collection for emails waiting to be delivered
 	"""
 	def __init__(self, app):
 		self.app = app
@@ -46,8 +65,25 @@ class MongoConnector(object):
 		self.diplomats_collection = self.client.diplomats.registered_diplomats
 		self.questions_collection = self.client.diplomats.questions
 		self.fundraisers_collection = self.client.diplomats.fundraisers
-		self.cache = MemcachedConnector().client
+		self.outbox_collection = self.client.diplomats.outbox
+		self.cache = get_cache()
+
+
+	@measure("mongo")
+	def ensure_indexes(self) -> None:
+		"""Create the indexes that the application's queries rely on.
+		Index creation is idempotent, so this is safe to call on every startup.
+		"""
+		with self.app.app_context():
+			try:
+				self.outbox_collection.create_index([("status", ASCENDING), ("available_at", ASCENDING)])
+				self.questions_collection.create_index([("submission_date", ASCENDING), ("_id", ASCENDING)])
+				self.questions_collection.create_index("question_id", unique=True)
+			except self.errors as e: # pragma: no cover
+				self.logger.exception(e)
+				raise
 	
+	@measure("mongo")
 	def get_diplomats(self) -> List[str]:
 		"""Return the emails of all of the registered Engineering Diplomats.
 
@@ -64,6 +100,24 @@ class MongoConnector(object):
 				raise
 	
 
+	@measure("mongo")
+	def watch_diplomats(self) -> ChangeStream:
+		"""Open a change stream on the registered diplomats collection.
+
+		Returns
+		-------
+		pymongo.change_stream.ChangeStream
+			A stream whose try_next() waits up to one second for a change.
+		"""
+		with self.app.app_context():
+			try:
+				return self.diplomats_collection.watch(max_await_time_ms=1000)
+			except self.errors as e: # pragma: no cover
+				self.logger.exception(e)
+				raise
+
+
+	@measure("mongo")
 	def insert_question(self, data: QuestionDocument) -> ObjectId:
 		"""Inserts an inquiry into the database.
 		
@@ -85,62 +139,153 @@ class MongoConnector(object):
 				raise
 	
 
-	def get_questions(self) -> list:
-		"""Get all of the unanswered questions that exist in the database.
-		
+	def get_questions_page(self, after: str = None, limit: int = 25) -> Tuple[List[dict], Union[str, None]]:
+		"""Get one page of unanswered questions, oldest first.
+
+		Parameters
+		----------
+		after : str
+			The cursor returned with the previous page, None for the first page.
+		limit : int
+			The maximum number of questions on the page.
+
 		Returns
-		--------
-		pymongo.cursor.Cursor : CursorType
-			A cursor for the collection which contains all of the question documents.
-		"""			
+		-------
+		Tuple[List[dict], Union[str, None]]
+			The questions on the page, limited to QUESTION_FIELDS, and the
+			cursor of the next page, or None if this is the last page.
+
+		Raises
+		------
+		ValueError
+			If ``after`` is not a cursor returned by this method.
+		"""
+		# Timed by QuestionPage, which also times pages that are streamed
+		page = self.stream_questions_page(after, limit)
+		questions = list(page)
+		return questions, page.next_page
+
+
+	def stream_questions_page(self, after: str = None, limit: int = 25) -> "QuestionPage":
+		"""Like get_questions_page(), but read questions from Mongo as they are iterated.
+
+		Pages are found with a range query on the (submission_date, _id)
+		index instead of skip(), so every page costs the same no matter
+		how many questions come before it.
+
+		Returns
+		-------
+		QuestionPage
+			An iterable over the page's questions whose ``next_page``
+			is known once iteration has finished. Reading it must finish
+			within REQUEST_TIMEOUT (default 30) seconds of starting.
+
+		Raises
+		------
+		ValueError
+			If ``after`` is not a cursor returned by get_questions_page().
+		"""
+		query = {}
+		if after is not None:
+			submission_date, _id = self.decode_cursor(after)
+			query = {"$or": [
+				{"submission_date": {"$gt": submission_date}},
+				{"submission_date": submission_date, "_id": {"$gt": _id}},
+			]}
+		return QuestionPage(self, query, limit, timeout=float(os.environ.get("REQUEST_TIMEOUT", 30)))
+
+
+	@measure("mongo")
+	def get_question(self, id) -> Union[dict, None]:
+		"""Get a single unanswered question.
+
+		Parameters
+		----------
+		id : uuid4
+			The question_id of the question.
+
+		Returns
+		-------
+		Union[dict, None]
+			The question limited to QUESTION_FIELDS, or None if it does not exist.
+		"""
 		with self.app.app_context():
 			try:
-				questions = self.questions_collection.find({})
+				return self.questions_collection.find_one({"question_id": id}, QUESTION_FIELDS)
 			except self.errors as e: # pragma: no cover
 				self.logger.exception(e)
 				raise
-		return [question for question in questions]
 
 
-	def remove_question(self, id) -> bool:
-		"""Remove a question that has been answered.
-		
+	@measure("mongo")
+	def pop_question(self, id) -> Union[dict, None]:
+		"""Atomically remove a question that is being answered and return it.
+
+		Only one of several concurrent callers receives the document,
+		so a question can never be answered twice.
+
 		Parameters
 		----------
 		id : uuid4
-			The question_id of the question to be removed
+			The question_id of the question being answered.
 
 		Returns
 		-------
-		pymongo.results.DeleteResult.acknowledged : bool 
-			Database acknowledgement that the document was deleted. 
+		Union[dict, None]
+			dict
+				The removed question, limited to QUESTION_FIELDS and _id.
+			None
+				If the question does not exist or was already answered.
 		"""
 		with self.app.app_context():
 			try:
-				return self.questions_collection.delete_one({"question_id": id}).acknowledged
+				return self.questions_collection.find_one_and_delete({"question_id": id}, QUESTION_FIELDS)
 			except self.errors as e: # pragma: no cover
 				self.logger.exception(e)
 				raise
 
-	
-	def get_fundraisers(self) -> CursorType:
+
+	@staticmethod
+	def encode_cursor(question: dict) -> str:
+		"""Encode a question's position in the (submission_date, _id) order."""
+		position = f"{question['submission_date'].isoformat()}|{question['_id']}"
+		return urlsafe_b64encode(position.encode()).decode()
+
+
+	@staticmethod
+	def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+		"""Decode a cursor created by encode_cursor(), raising ValueError if it is invalid."""
+		try:
+			submission_date, _id = urlsafe_b64decode(cursor.encode()).decode().split("|")
+			return datetime.fromisoformat(submission_date), ObjectId(_id)
+		except Exception as e:
+			raise ValueError(f"Invalid page cursor {cursor!r}.") from e
+
+
+	@cached("fundraisers", float(os.environ.get("FUNDRAISERS_CACHE_TTL", 300)), key=lambda self: "all")
+	@measure("mongo")
+	def get_fundraisers(self) -> List[dict]:
 		"""Get all upcoming fundraisers from fundraisers collection.
+		Cached for FUNDRAISERS_CACHE_TTL seconds (default 300).
 		
 		Returns
 		--------
-		pymongo.cursor.Cursor : CursorType
-			A cursor for the collection which contains all of the question documents.
+		List[dict]
+			Every fundraiser document.
 		"""
 		with self.app.app_context():
 			try:
-				return self.fundraisers_collection.find({})
+				return list(self.fundraisers_collection.find({}))
 			except self.errors as e: # pragma: no cover
 				self.logger.exception(e)
 				raise
 
 
+	@cached("points", float(os.environ.get("POINTS_CACHE_TTL", 60)), key=lambda self, email: email.lower())
+	@measure("mongo")
 	def get_points(self, email) -> dict:
-		"""Get all upcoming fundraisers from fundraisers collection.
+		"""Get a diplomat's points document.
+		Cached for POINTS_CACHE_TTL seconds (default 60).
 		
 		Returns
 		--------
@@ -153,3 +298,208 @@ class MongoConnector(object):
 			except self.errors as e: # pragma: no cover
 				self.logger.exception(e)
 				raise
+
+
+	@measure("mongo")
+	def enqueue_email(self, kind: str, payload: dict) -> ObjectId:
+		"""Add an email to the outbox for delivery by an OutboxWorker.
+
+		Parameters
+		----------
+		kind : str
+			The kind of email, one of "confirmation", "notification" or "answer".
+		payload : dict
+			The data needed to build the email.
+
+		Returns
+		-------
+		bson.objectId.ObjectId
+			The ObjectId of the outbox document.
+		"""
+		now = datetime.utcnow()
+		document = {
+			"kind": kind,
+			"payload": payload,
+			"status": "pending",
+			"attempts": 0,
+			"created_at": now,
+			"available_at": now,
+			"lease_owner": None,
+			"last_error": None,
+		}
+		with self.app.app_context():
+			try:
+				return self.outbox_collection.insert_one(document).inserted_id
+			except self.errors as e: # pragma: no cover
+				self.logger.exception(e)
+				raise
+
+
+	@measure("mongo")
+	def lease_email(self, owner: str, lease_seconds: float) -> Union[dict, None]:
+		"""Atomically claim the oldest email that is ready to be delivered.
+
+		Pending emails and emails whose previous lease has expired are
+		both eligible, since a leased email's available_at is its lease expiry.
+
+		Parameters
+		----------
+		owner : str
+			Identifies the worker claiming the email.
+		lease_seconds : float
+			How long the worker has to deliver the email before
+			another worker may claim it.
+
+		Returns
+		-------
+		Union[dict, None]
+			dict
+				The leased outbox document.
+			None
+				If no email is ready.
+		"""
+		now = datetime.utcnow()
+		with self.app.app_context():
+			try:
+				return self.outbox_collection.find_one_and_update(
+					{"status": {"$in": ["pending", "leased"]}, "available_at": {"$lte": now}},
+					{
+						"$set": {
+							"status": "leased",
+							"lease_owner": owner,
+							"available_at": now + timedelta(seconds=lease_seconds),
+						},
+						"$inc": {"attempts": 1},
+					},
+					sort=[("available_at", ASCENDING)],
+					return_document=ReturnDocument.AFTER,
+				)
+			except self.errors as e: # pragma: no cover
+				self.logger.exception(e)
+				raise
+
+
+	@measure("mongo")
+	def complete_email(self, document: dict) -> bool:
+		"""Remove a delivered email from the outbox.
+
+		Returns
+		-------
+		bool
+			True if the email was still leased by the same worker.
+		"""
+		with self.app.app_context():
+			try:
+				query = {"_id": document["_id"], "lease_owner": document["lease_owner"]}
+				return self.outbox_collection.delete_one(query).deleted_count == 1
+			except self.errors as e: # pragma: no cover
+				self.logger.exception(e)
+				raise
+
+
+	@measure("mongo")
+	def retry_email(self, document: dict, error: str, delay: Union[float, None]) -> None:
+		"""Release a failed email for a later attempt, or dead-letter it.
+
+		Parameters
+		----------
+		document : dict
+			The leased outbox document.
+		error : str
+			Description of the delivery failure.
+		delay : Union[float, None]
+			Seconds to wait before the next attempt,
+			None to mark the email as dead.
+		"""
+		update = {"last_error": error, "lease_owner": None}
+		if delay is None:
+			update["status"] = "dead"
+		else:
+			update["status"] = "pending"
+			update["available_at"] = datetime.utcnow() + timedelta(seconds=delay)
+		with self.app.app_context():
+			try:
+				self.outbox_collection.update_one(
+					{"_id": document["_id"], "lease_owner": document["lease_owner"]},
+					{"$set": update},
+				)
+			except self.errors as e: # pragma: no cover
+				self.logger.exception(e)
+				raise
+
+
+class QuestionPage(object):
+	"""One page of questions, read from a Mongo cursor while it is iterated.
+
+	Fetches one question more than ``limit`` to learn whether another
+	page follows, without a separate count query.
+
+	Attributes
+	----------
+	db : MongoConnector
+		The connector whose questions collection is read.
+	query : dict
+		Selects the questions after the previous page.
+	limit : int
+		The maximum number of questions on the page.
+	next_page : Union[str, None]
+		The next page's cursor, set once iteration has reached the end
+		of this page, or None if this is the last page.
+	timeout : float
+		Seconds from the start of iteration within which every read from
+		Mongo must finish, or None for no deadline. A streamed response is
+		only covered by production.wsgi's RequestTimeout until its first
+		chunk, so without this a stalled cursor would hold the request's
+		greenlet forever.
+	"""
+	def __init__(self, db: MongoConnector, query: dict, limit: int, timeout: float = None):
+		self.db = db
+		self.query = query
+		self.limit = limit
+		self.timeout = timeout
+		self.next_page = None
+
+
+	def __iter__(self):
+		# No application context is held here: this generator may be
+		# suspended between questions while a streamed page is rendered.
+		cursor = (
+			self.db.questions_collection.find(self.query, QUESTION_FIELDS)
+			.sort([("submission_date", ASCENDING), ("_id", ASCENDING)])
+			.limit(self.limit + 1)
+			.batch_size(self.limit + 1)
+		)
+		deadline = None if self.timeout is None else monotonic() + self.timeout
+		last, count, elapsed, outcome = None, 0, 0.0, "ok"
+		try:
+			with cursor:
+				while True:
+					# Only the reads are timed, not the time spent suspended between questions
+					started = perf_counter()
+					try:
+						question = self._next(cursor, deadline)
+					finally:
+						elapsed += perf_counter() - started
+					if question is None:
+						break
+					if count == self.limit:
+						self.next_page = self.db.encode_cursor(last)
+						break
+					count += 1
+					last = question
+					yield question
+		except PyMongoError as e:
+			outcome = "error"
+			self.db.logger.exception(e)
+			raise
+		finally:
+			dependency_seconds.labels("mongo", "questions_page", outcome).observe(elapsed)
+
+
+	@staticmethod
+	def _next(cursor, deadline: float) -> Union[dict, None]:
+		"""The cursor's next question, or None at its end; raises a timeout error after ``deadline``."""
+		if deadline is None:
+			return next(cursor, None)
+		with pymongo.timeout(max(deadline - monotonic(), 0.001)):
+			return next(cursor, None)
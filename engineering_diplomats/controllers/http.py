@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""Pooled HTTP transports for outbound calls."""
+
+import os
+import random
+import socket
+import ssl
+
+from collections import defaultdict
+from queue import Empty, LifoQueue
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+from typing import Callable, Dict, Tuple
+from urllib.parse import urlsplit
+
+import httplib2
+import logme
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from engineering_diplomats.metrics import dependency_seconds
+
+# Errors after which an Http object's cached connections can no longer be trusted
+CONNECTION_ERRORS = (ConnectionError, socket.timeout, ssl.SSLError, httplib2.HttpLib2Error)
+
+# Responses worth retrying: the server may answer differently a moment later
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+
+@logme.log
+class HttpPool(object):
+	"""A thread-safe stand-in for httplib2.Http that lends out pooled instances.
+
+	httplib2.Http is not thread-safe, so a googleapiclient service built
+	around a single instance cannot be shared by request threads. Passing
+	an HttpPool as the service's ``http`` instead gives every request its
+	own authorized Http for the duration of the call. Instances are kept
+	after use, so their keep-alive connections (and TLS sessions) are
+	reused by later calls rather than handshaking each time.
+
+	Attributes
+	----------
+	factory : Callable[[], httplib2.Http]
+		Creates a new authorized Http, e.g. ``lambda: creds.authorize(Http())``.
+	size : int
+		Maximum number of Http instances, and therefore connections, in use at once.
+	"""
+	def __init__(self, factory: Callable[[], httplib2.Http], size: int = 4):
+		self.factory = factory
+		self.size = size
+		self._idle = LifoQueue()
+		self._slots = BoundedSemaphore(size)
+
+
+	def request(self, uri: str, method: str = "GET", body=None, headers: dict = None, **kwargs) -> Tuple[httplib2.Response, bytes]:
+		"""Perform a request with a borrowed Http, with the signature of httplib2.Http.request.
+
+		Blocks while ``size`` requests are already in flight.
+		"""
+		with self._slots:
+			try:
+				http = self._idle.get_nowait()
+			except Empty:
+				http = self.factory()
+			try:
+				response = http.request(uri, method=method, body=body, headers=headers, **kwargs)
+			except CONNECTION_ERRORS:
+				self._close(http)
+				raise
+			self._idle.put(http)
+			return response
+
+
+	def close(self) -> None:
+		"""Close the connections of every idle Http."""
+		while True:
+			try:
+				http = self._idle.get_nowait()
+			except Empty:
+				return
+			self._close(http)
+
+
+	def _close(self, http: httplib2.Http) -> None:
+		"""Drop an Http and any connections it holds open."""
+		try:
+			http.close()
+		except OSError:
+			pass
+
+
+@logme.log
+class HTTPClient(object):
+	"""The outbound HTTP client shared by the views.
+
+	One requests.Session keeps a keep-alive connection pool per host, so
+	repeated calls to GitHub or Microsoft Graph skip DNS, TCP and TLS
+	setup. Every call has connect and read timeouts. Idempotent requests
+	that fail to connect, time out or receive a 429/502/503/504 are
+	retried with exponential backoff and full jitter.
+
+	Attributes
+	----------
+	connect_timeout : float
+		Seconds to wait for a connection to be established.
+	read_timeout : float
+		Seconds to wait between bytes of the response.
+	retries : int
+		Number of retries after the first attempt.
+	backoff : float
+		Upper bound in seconds of the first retry's delay, doubled on each retry.
+	session : requests.Session
+		The session holding the per-host connection pools.
+	"""
+	def __init__(self, connect_timeout: float = 3.05, read_timeout: float = 10.0, retries: int = 2,
+			backoff: float = 0.25, pool_size: int = 10):
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self._stats = defaultdict(lambda: {"requests": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+		self._stats_lock = Lock()
+
+
+	@classmethod
+	def from_environment(cls) -> "HTTPClient":
+		"""Create a client configured by the HTTP_* environment variables."""
+		return cls(
+			connect_timeout=float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05)),
+			read_timeout=float(os.environ.get("HTTP_READ_TIMEOUT", 10)),
+			retries=int(os.environ.get("HTTP_RETRIES", 2)),
+			backoff=float(os.environ.get("HTTP_BACKOFF", 0.25)),
+			pool_size=int(os.environ.get("HTTP_POOL_SIZE", 10)),
+		)
+
+
+	def get(self, url: str, **kwargs) -> requests.Response:
+		"""Send a GET request. See request()."""
+		return self.request("GET", url, **kwargs)
+
+
+	def request(self, method: str, url: str, **kwargs) -> requests.Response:
+		"""Send a request, retrying idempotent requests on transient failures.
+
+		Parameters
+		----------
+		method : str
+			The HTTP method.
+		url : str
+			The absolute URL to request.
+		**kwargs
+			Passed to requests.Session.request. ``timeout`` defaults to
+			(connect_timeout, read_timeout).
+
+		Returns
+		-------
+		requests.Response
+			The last response received. Status codes are not checked.
+		"""
+		kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+		host = urlsplit(url).netloc
+		attempts = 1 + (self.retries if method.upper() in IDEMPOTENT_METHODS else 0)
+		for attempt in range(attempts):
+			if attempt:
+				sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+			started = monotonic()
+			try:
+				response = self.session.request(method, url, **kwargs)
+			except (requests.ConnectionError, requests.Timeout) as e:
+				self._record(host, monotonic() - started, error=True)
+				if attempt == attempts - 1:
+					raise
+				self.logger.warning(f"{method} {host} failed, retrying: {e}")
+				continue
+			self._record(host, monotonic() - started, error=response.status_code >= 500)
+			if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+				return response
+			self.logger.warning(f"{method} {host} answered {response.status_code}, retrying.")
+			response.close()
+
+
+	@property
+	def stats(self) -> Dict[str, dict]:
+		"""Request count, error count, mean and max latency in seconds per host."""
+		with self._stats_lock:
+			return {
+				host: {
+					"requests": stats["requests"],
+					"errors": stats["errors"],
+					"mean_seconds": stats["seconds"] / stats["requests"],
+					"max_seconds": stats["max_seconds"],
+				}
+				for host, stats in self._stats.items()
+			}
+
+
+	def close(self) -> None:
+		"""Close every pooled connection."""
+		self.session.close()
+
+
+	def _record(self, host: str, seconds: float, error: bool) -> None:
+		dependency_seconds.labels("http", host, "error" if error else "ok").observe(seconds)
+		with self._stats_lock:
+			stats = self._stats[host]
+			stats["requests"] += 1
+			stats["errors"] += int(error)
+			stats["seconds"] += seconds
+			stats["max_seconds"] = max(stats["max_seconds"], seconds)
@@ -2,16 +2,178 @@
 
 """Classes for sending emails."""
 
+import atexit
+import logging
 import os
+import smtplib
+import socket
+import ssl
 
-from typing import Tuple
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from threading import BoundedSemaphore
+from time import monotonic, perf_counter
+from typing import List, Tuple
 
-from flask import current_app, render_template
-from flask_mail import Message
+import logme
 
-from engineering_diplomats.decorators import redirect_email_stdout
+from flask import render_template
+from flask_mail import Connection, Message
 
+from engineering_diplomats.metrics import measure
+from engineering_diplomats.settings import get_email_log
 
+# Errors after which a connection can no longer be trusted
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout, ssl.SSLError)
+
+
+class TranscriptMixin(object):
+    """Keeps an SMTP connection's debug output on the connection instead of printing it.
+
+    smtplib prints its debug output to the process-wide sys.stderr, where
+    the output of concurrent connections would interleave.
+
+    Attributes
+    ----------
+    transcript : List[str]
+        Debug lines since the transcript was last taken, if MAIL_DEBUG is set.
+    last_response : Tuple[int, bytes]
+        The server's reply to the last message sent, e.g. (250, b"2.0.0 OK <queue id>").
+    """
+    def __init__(self, *args, **kwargs):
+        self.transcript = []
+        self.last_response = None
+        super().__init__(*args, **kwargs)
+
+
+    def _print_debug(self, *args) -> None:
+        self.transcript.append(" ".join(str(arg) for arg in args))
+
+
+    def data(self, msg) -> Tuple[int, bytes]:
+        self.last_response = super().data(msg)
+        return self.last_response
+
+
+class TranscribedSMTP(TranscriptMixin, smtplib.SMTP):
+    pass
+
+
+class TranscribedSMTP_SSL(TranscriptMixin, smtplib.SMTP_SSL):
+    pass
+
+
+class TranscribedConnection(Connection):
+    """A flask_mail connection over a TranscribedSMTP or TranscribedSMTP_SSL host."""
+    def configure_host(self) -> smtplib.SMTP:
+        if self.mail.use_ssl:
+            host = TranscribedSMTP_SSL(self.mail.server, self.mail.port)
+        else:
+            host = TranscribedSMTP(self.mail.server, self.mail.port)
+
+        host.set_debuglevel(int(self.mail.debug))
+
+        if self.mail.use_tls:
+            host.starttls()
+
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+
+        return host
+
+
+@logme.log
+class SMTPPool(object):
+    """Keeps authenticated SMTP connections open for reuse.
+
+    Opening an SMTP_SSL connection costs a TCP connect, a TLS handshake
+    and a login, which is most of the time it takes to send an email.
+    Connections are returned to the pool after use and checked with a
+    NOOP before being reused if they have been idle for a while.
+
+    Attributes
+    ----------
+    mailer : flask_mail.Mail
+        The configured flask_mail extension used to open connections.
+    size : int
+        Maximum number of connections open at once.
+    noop_after : float
+        Idle seconds after which a connection is checked with NOOP before reuse.
+    """
+    def __init__(self, mailer, size: int = 2, noop_after: float = 30.0):
+        self.mailer = mailer
+        self.size = size
+        self.noop_after = noop_after
+        self._idle = LifoQueue()
+        self._slots = BoundedSemaphore(size)
+
+
+    @contextmanager
+    def connection(self):
+        """Borrow a healthy connection for the duration of a with block.
+
+        The connection is closed instead of returned to the pool if the
+        block raises, as it may be dead or left in the middle of a
+        transaction, e.g. after SMTPRecipientsRefused.
+
+        Yields
+        ------
+        flask_mail.Connection
+            An open connection. Must be used inside an application context.
+        """
+        with self._slots:
+            connection = self._checkout()
+            try:
+                yield connection
+            except BaseException:
+                self._close(connection)
+                raise
+            self._idle.put((connection, monotonic()))
+
+
+    def close(self) -> None:
+        """Close every idle connection."""
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except Empty:
+                return
+            self._close(connection)
+
+
+    def _checkout(self):
+        """Return an idle connection that answers NOOP, or open a new one."""
+        while True:
+            try:
+                connection, last_used = self._idle.get_nowait()
+            except Empty:
+                return self._open()
+            if connection.host is None or monotonic() - last_used < self.noop_after:
+                return connection
+            try:
+                if connection.host.noop()[0] == 250:
+                    return connection
+            except CONNECTION_ERRORS:
+                pass
+            self.logger.info("Discarding stale SMTP connection.")
+            self._close(connection)
+
+
+    def _open(self):
+        """Open and authenticate a new connection."""
+        with self.mailer.app.app_context():
+            return TranscribedConnection(self.mailer.app.extensions["mail"]).__enter__()
+
+
+    def _close(self, connection) -> None:
+        """Quit a connection, ignoring errors from one that is already dead."""
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+@logme.log
 class Mailer(object):
     """Encapsulates an instance of a mailer which
     shall send emails for the application.
@@ -20,14 +182,21 @@ class Mailer(object):
     ----------
     mailer : flask_mail.Mail
         An instance of flask_mail.Mail
+    pool : SMTPPool
+        Reusable SMTP connections, sized by MAIL_POOL_SIZE.
     """
     def __init__(self, mailer):
         self.mailer = mailer
+        self.pool = SMTPPool(
+            mailer,
+            size=int(os.environ.get("MAIL_POOL_SIZE", 2)),
+            noop_after=float(os.environ.get("MAIL_NOOP_AFTER", 30)),
+        )
+        atexit.register(self.pool.close)
 
 
-    @redirect_email_stdout
-    def send_confirmation(self, question_document: object) -> None:
-        """Send a student a confirmation that their question has been received.
+    def build_confirmation(self, question_document: object) -> Message:
+        """Build the confirmation email for a student's question.
 
         Parameters
         ----------
@@ -43,13 +212,12 @@ class Mailer(object):
         msg = Message(**kwargs)
         with self.mailer.app.app_context():
             msg.html = render_template("_emails/send_confirmation.html", question_document=question_document)
-            self.mailer.send(msg)
-    
+        return msg
+
+
+    def build_notification(self, question_document: object) -> Message:
+        """Build the President's notification email for a new question.
 
-    @redirect_email_stdout
-    def send_notification(self, question_document: object) -> None:
-        """Notify the President that a new question has been received.
-        
         Parameters
         ----------
         question_document : QuestionDocument
@@ -63,19 +231,16 @@ class Mailer(object):
         msg = Message(**kwargs)
         with self.mailer.app.app_context():
             msg.html = render_template("_emails/new_question.html", question_document=question_document)
-            self.mailer.send(msg)
+        return msg
 
 
-    @redirect_email_stdout
-    def send_answer(self, answer_data: Tuple[str, object, str]) -> None:
-        """Send a student the answer to their question.
-        
+    def build_answer(self, answer_data: Tuple[str, object, str]) -> Message:
+        """Build the email that sends a student the answer to their question.
+
         Parameters
         ----------
         answer_data : Tuple[str, object, str]
-            The answer submitted by an Engineering Diplomat.
-            The QuestionDocument object that matches the answered question's id.
-            The email of the Engineering Diplomat that submitted the question.
+            See send_answer().
         """
         kwargs = {
             "subject": "Your question has been answered - Engineering Diplomats",
@@ -91,4 +256,101 @@ class Mailer(object):
                 question_document=answer_data[1],
                 diplomat=answer_data[2]
             )
-            self.mailer.send(msg)
+        return msg
+
+
+    @measure("smtp")
+    def send_batch(self, messages: List[Message]) -> None:
+        """Send several messages over one SMTP session.
+
+        If the pooled connection drops part way through, the
+        remaining messages are retried once on a new connection.
+
+        Every attempt to send a message is recorded in the email
+        delivery log (see settings.get_email_log()) with its message id,
+        recipients, duration, the server's response or the error, and
+        the connection's SMTP debug transcript if MAIL_DEBUG is set.
+
+        Parameters
+        ----------
+        messages : List[flask_mail.Message]
+            The messages to be delivered, in order.
+        """
+        pending = list(messages)
+        with self.mailer.app.app_context():
+            for attempt in range(2):
+                try:
+                    with self.pool.connection() as connection:
+                        while pending:
+                            self._send(connection, pending[0])
+                            pending.pop(0)
+                    return
+                except CONNECTION_ERRORS:
+                    if attempt:
+                        raise
+                    self.logger.warning("SMTP connection dropped; retrying on a new connection.")
+
+
+    def _send(self, connection: Connection, message: Message) -> None:
+        """Send one message and record the attempt in the email delivery log."""
+        # The connection replaces its host after MAIL_MAX_EMAILS messages
+        host = connection.host
+        started = perf_counter()
+        error = None
+        try:
+            connection.send(message)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            response = getattr(host, "last_response", None)
+            transcript = getattr(host, "transcript", None)
+            if transcript:
+                host.transcript = []
+            record = {
+                "message_id": getattr(message, "msgId", None),
+                "subject": message.subject,
+                "recipients": list(message.send_to),
+                "duration": round(perf_counter() - started, 6),
+                "response": f"{response[0]} {response[1].decode(errors='replace')}" if response and error is None else None,
+                "error": repr(error) if error is not None else None,
+                "transcript": transcript or None,
+            }
+            outcome = "Failed to send" if error is not None else "Sent"
+            get_email_log().log(logging.ERROR if error is not None else logging.INFO,
+                f"{outcome} {record['message_id']} to {len(record['recipients'])} recipients.", extra=record)
+
+
+    def send_confirmation(self, question_document: object) -> None:
+        """Send a student a confirmation that their question has been received.
+
+        Parameters
+        ----------
+        question_document : QuestionDocument
+            The metadata of the question that was just submitted.
+        """
+        self.send_batch([self.build_confirmation(question_document)])
+
+
+    def send_notification(self, question_document: object) -> None:
+        """Notify the President that a new question has been received.
+
+        Parameters
+        ----------
+        question_document : QuestionDocument
+            The metadata of the question that was just submitted.
+        """
+        self.send_batch([self.build_notification(question_document)])
+
+
+    def send_answer(self, answer_data: Tuple[str, object, str]) -> None:
+        """Send a student the answer to their question.
+
+        Parameters
+        ----------
+        answer_data : Tuple[str, object, str]
+            The answer submitted by an Engineering Diplomat.
+            The QuestionDocument object that matches the answered question's id.
+            The email of the Engineering Diplomat that submitted the question.
+        """
+        self.send_batch([self.build_answer(answer_data)])
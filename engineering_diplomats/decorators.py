@@ -2,14 +2,11 @@
 
 """Custom decorator functions."""
 
-import atexit
-
-from contextlib import redirect_stderr, redirect_stdout
 from functools import wraps
-from threading import Thread
 from typing import Callable
 
-from engineering_diplomats.settings import emails_log_file
+from engineering_diplomats.settings import get_cache
+from engineering_diplomats.workers import task_pool
 
 
 def thread_task(f: Callable) -> Callable:
@@ -23,36 +20,47 @@ def thread_task(f: Callable) -> Callable:
 	Returns
 	-------
 	Callable
-		A function that will be ran on a seperate thread when it is called.
+		A function that will be ran on the shared worker pool when it is called.
+		It returns True if the pool accepted the call and False if it was
+		rejected, see WorkerPool.submit().
 	"""
 	@wraps(f)
-	def wrapper(*args, **kwargs):
-		thread = Thread(target=f, name=f.__name__, args=args, kwargs=kwargs)
-		thread.daemon = True
-		thread.start()
+	def wrapper(*args, **kwargs) -> bool:
+		return task_pool.submit(f, *args, **kwargs)
 	return wrapper
 
 
-def redirect_email_stdout(f: Callable) -> Callable:
-	"""Defines a wrapper that will decorate a function.
+def cached(namespace: str, ttl: float, key: Callable = None) -> Callable:
+	"""Defines a wrapper that caches a function's results in the two-tier cache.
 
 	Parameters
 	----------
-	f : Callable
-		The function to be wrapped.
+	namespace : str
+		The cache namespace for the function's results.
+	ttl : float
+		Seconds to cache each result for.
+	key : Callable
+		Receives the function's arguments and returns the cache key.
+		Defaults to the arguments joined with colons.
 
 	Returns
 	-------
 	Callable
-		A function which will have its contents written to email.log.
-		This decorator should only be used for send_email() functions
-		within the boarding_mailers module.
+		A decorator. Concurrent misses on one key in this process
+		compute the result once; see MemcachedConnector.get_or_set().
+		The wrapped function's ``cache_key`` returns the key for a
+		set of arguments, for callers that need to invalidate it.
 	"""
-	@wraps(f)
-	def wrapper(*args, **kwargs):
-			with redirect_stdout(emails_log_file):
-				with redirect_stderr(emails_log_file):
-					f(*args, **kwargs)
-	return wrapper
+	def decorator(f: Callable) -> Callable:
+		def cache_key(*args, **kwargs) -> str:
+			if key is not None:
+				return str(key(*args, **kwargs))
+			return ":".join([str(arg) for arg in args] + [f"{k}={v}" for k, v in sorted(kwargs.items())]) or "-"
+
+		@wraps(f)
+		def wrapper(*args, **kwargs):
+			return get_cache().get_or_set(namespace, cache_key(*args, **kwargs), lambda: f(*args, **kwargs), ttl)
+		wrapper.cache_key = cache_key
+		return wrapper
+	return decorator
 
-atexit.register(lambda: emails_log_file.close())
\ No newline at end of file
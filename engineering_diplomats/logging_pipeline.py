@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+"""Queued, structured logging that never writes to disk on a request's thread.
+
+Loggers created by logme (see logme.ini) only hold a NullHandler, so
+their records propagate to a single handler on the root logger. That
+handler puts each record in a bounded in-memory queue. A listener on a
+separate thread writes the records in batches to the console and to a
+size-rotated file of JSON lines. A pipeline can also be attached to one
+named logger instead, e.g. for the email delivery log.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import os
+import sys
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Empty
+from typing import List
+
+try:
+	from gevent.monkey import get_original
+except ImportError: # pragma: no cover
+	get_original = None
+
+TEXT_FORMAT = "{asctime} - {name} - {levelname} - {message}"
+
+# Attributes every LogRecord has; anything else was passed with extra= and is kept
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def _native(module: str, name: str):
+	"""The unpatched ``module.name`` if gevent has monkey patched it."""
+	if get_original is not None:
+		return get_original(module, name)
+	return getattr(__import__(module), name)
+
+
+class JSONFormatter(logging.Formatter):
+	"""Formats each record as one line of JSON, with Stackdriver's field names."""
+	def format(self, record: logging.LogRecord) -> str:
+		entry = {
+			"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+			"severity": record.levelname,
+			"logger": record.name,
+			"message": record.getMessage(),
+			"pid": record.process,
+			"thread": record.threadName,
+		}
+		if record.exc_info and not record.exc_text:
+			record.exc_text = self.formatException(record.exc_info)
+		if record.exc_text:
+			entry["exception"] = record.exc_text
+		for key, value in vars(record).items():
+			if key not in RECORD_ATTRIBUTES and key not in entry:
+				entry[key] = value
+		return json.dumps(entry, default=str)
+
+
+class RingBuffer(object):
+	"""A bounded queue that drops its oldest record to make room for a new one.
+
+	Built on the native SimpleQueue rather than the one gevent patches
+	in, so that a greenlet can put records without blocking and a native
+	thread can wait for them.
+
+	Attributes
+	----------
+	capacity : int
+		Maximum number of records held.
+	dropped : int
+		Records discarded because the buffer was full.
+	"""
+	def __init__(self, capacity: int = 10000):
+		self.capacity = capacity
+		self.dropped = 0
+		self._queue = _native("queue", "SimpleQueue")()
+
+
+	def put_nowait(self, record) -> None:
+		while self._queue.qsize() >= self.capacity:
+			try:
+				self._queue.get_nowait()
+			except Empty:
+				break
+			self.dropped += 1
+		self._queue.put(record)
+
+
+	def get(self, block: bool = True, timeout: float = None):
+		return self._queue.get(block, timeout)
+
+
+	def empty(self) -> bool:
+		return self._queue.empty()
+
+
+	def qsize(self) -> int:
+		return self._queue.qsize()
+
+
+class DroppingQueueHandler(QueueHandler):
+	"""Puts records in a RingBuffer with only in-memory work on the caller's thread."""
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		# Merge the arguments and render any traceback now, as they may not outlive the call
+		record = copy.copy(record)
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+
+class BatchingRotatingFileHandler(RotatingFileHandler):
+	"""A RotatingFileHandler that writes ``batch_size`` records at a time instead of one.
+
+	The listener also flushes it whenever the queue runs empty, so at
+	low volume each record still reaches the file right away. Records
+	are held in a list rather than the file's buffer, so a forked child
+	never writes its parent's pending records a second time.
+	"""
+	def __init__(self, filename: str, max_bytes: int, backup_count: int, batch_size: int = 100):
+		os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+		super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+		self.batch_size = batch_size
+		self._buffer = []
+		self._size = 0
+
+
+	def emit(self, record: logging.LogRecord) -> None:
+		try:
+			self._buffer.append(self.format(record) + self.terminator)
+			if len(self._buffer) >= self.batch_size:
+				self.flush()
+		except Exception:
+			self.handleError(record)
+
+
+	def flush(self) -> None:
+		"""Write the buffered records, rotating the file when it reaches max_bytes."""
+		self.acquire()
+		try:
+			lines, self._buffer = self._buffer, []
+			chunk = []
+			for line in lines:
+				if self.stream is None:
+					self.stream = self._open()
+					self._size = self.stream.seek(0, 2)
+				# JSON lines are ASCII, so characters are bytes
+				if self.maxBytes > 0 and self._size and self._size + len(line) >= self.maxBytes:
+					self._write(chunk)
+					chunk = []
+					self.doRollover()
+					self.stream = self._open()
+					self._size = 0
+				chunk.append(line)
+				self._size += len(line)
+			self._write(chunk)
+		finally:
+			self.release()
+
+
+	def close(self) -> None:
+		self.flush()
+		super().close()
+
+
+	def _write(self, chunk: List[str]) -> None:
+		if chunk:
+			self.stream.write("".join(chunk))
+			self.stream.flush()
+
+
+class BatchingQueueListener(QueueListener):
+	"""A QueueListener on a native thread that flushes its handlers when the queue runs empty.
+
+	Under gevent's monkey patching a threading.Thread is a greenlet, and
+	its file writes would stall every request on the event loop, so the
+	listener is started with the unpatched thread primitives.
+	"""
+	_stopped = None
+
+	def handle(self, record: logging.LogRecord) -> None:
+		super().handle(record)
+		if self.queue.empty():
+			for handler in self.handlers:
+				handler.flush()
+
+
+	def start(self) -> None:
+		self._stopped = _native("_thread", "allocate_lock")()
+		self._stopped.acquire()
+		_native("_thread", "start_new_thread")(self._run, (self._stopped,))
+
+
+	def stop(self, timeout: float = 5.0) -> None:
+		"""Write the queued records and stop the listener thread."""
+		if self._stopped is None:
+			return
+		self.queue.put_nowait(self._sentinel)
+		self._stopped.acquire(timeout=timeout)
+		self._stopped = None
+
+
+	def _run(self, stopped) -> None:
+		try:
+			self._monitor()
+		finally:
+			for handler in self.handlers:
+				handler.flush()
+			stopped.release()
+
+
+class LogPipeline(object):
+	"""The root logger's queue, its listener and the listener's handlers.
+
+	Attributes
+	----------
+	filename : str
+		JSON log file; a worker forked by production.wsgi writes
+		``<name>.<WORKER_ID><ext>`` instead, so workers never rotate one file.
+	capacity : int
+		Records buffered before the oldest are dropped.
+	console_format : str
+		"text" or "json" for the console.
+	max_bytes : int
+		Size at which the file is rotated.
+	backup_count : int
+		Rotated files kept.
+	batch_size : int
+		Records written between flushes of the file.
+	level : str
+		Level of the root logger, for libraries that are not configured in logme.ini.
+	logger : str
+		Name of the logger to attach to, or None for the root logger. A
+		named logger's records stop propagating to the root logger.
+	console : bool
+		Whether records are also written to the console.
+	"""
+	def __init__(self, filename: str = "logs/main.log", capacity: int = 10000, console_format: str = "text",
+			max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5, batch_size: int = 100, level: str = "WARNING",
+			logger: str = None, console: bool = True):
+		self.filename = filename
+		self.capacity = capacity
+		self.console_format = console_format
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self.batch_size = batch_size
+		self.level = level
+		self.logger = logger
+		self.console = console
+		self.handler = None
+		self.listener = None
+
+
+	@classmethod
+	def from_environment(cls) -> "LogPipeline":
+		"""Create a pipeline configured by the LOG_* environment variables."""
+		return cls(
+			filename=os.environ.get("LOG_FILE", "logs/main.log"),
+			capacity=int(os.environ.get("LOG_QUEUE_SIZE", 10000)),
+			console_format=os.environ.get("LOG_FORMAT", "text"),
+			max_bytes=int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+			backup_count=int(os.environ.get("LOG_BACKUP_COUNT", 5)),
+			batch_size=int(os.environ.get("LOG_BATCH_SIZE", 100)),
+			level=os.environ.get("LOG_ROOT_LEVEL", "WARNING"),
+		)
+
+
+	@property
+	def dropped(self) -> int:
+		"""Records dropped because the queue was full."""
+		return self.handler.queue.dropped if self.handler is not None else 0
+
+
+	def start(self) -> None:
+		"""Route the logger through the queue and start the listener."""
+		logger = logging.getLogger(self.logger)
+		logger.setLevel(self.level)
+		if self.logger is not None:
+			logger.propagate = False
+		self.handler = DroppingQueueHandler(RingBuffer(self.capacity))
+		logger.addHandler(self.handler)
+		self._listen()
+		_started.append(self)
+		if hasattr(os, "register_at_fork"):
+			os.register_at_fork(after_in_child=self._after_fork)
+
+
+	def stop(self) -> None:
+		"""Write the queued records and detach from the logger."""
+		if self.listener is not None:
+			self.listener.stop()
+			for handler in self.listener.handlers:
+				handler.close()
+			self.listener = None
+		logging.getLogger(self.logger).removeHandler(self.handler)
+		if self in _started:
+			_started.remove(self)
+
+
+	def _listen(self, filename: str = None) -> None:
+		self.listener = BatchingQueueListener(self.handler.queue, *self._handlers(filename or self.filename))
+		self.listener.start()
+
+
+	def _handlers(self, filename: str) -> List[logging.Handler]:
+		handlers = []
+		if self.console:
+			console = logging.StreamHandler(sys.stderr)
+			if self.console_format == "json":
+				console.setFormatter(JSONFormatter())
+			else:
+				console.setFormatter(logging.Formatter(TEXT_FORMAT, style="{"))
+			handlers.append(console)
+		file = BatchingRotatingFileHandler(filename, self.max_bytes, self.backup_count, self.batch_size)
+		file.setFormatter(JSONFormatter())
+		handlers.append(file)
+		return handlers
+
+
+	def _after_fork(self) -> None:
+		"""Give a forked child its own queue, listener thread and file.
+
+		The parent's listener thread does not exist in the child, and
+		records it had not written yet would be written twice.
+		"""
+		self.handler.queue = RingBuffer(self.capacity)
+		stem, extension = os.path.splitext(self.filename)
+		worker = os.environ.get("WORKER_ID", str(os.getpid()))
+		self._listen(f"{stem}.{worker}{extension}")
+
+
+_pipeline = None
+
+# Every running pipeline, so a worker can flush them all before exiting
+_started = []
+
+
+def install_logging() -> LogPipeline:
+	"""Start the process's log pipeline once; later calls return the same pipeline."""
+	global _pipeline
+	if _pipeline is None:
+		_pipeline = LogPipeline.from_environment()
+		_pipeline.start()
+	return _pipeline
+
+
+@atexit.register
+def stop_logging() -> None:
+	"""Write every pipeline's queued records and stop their listeners."""
+	for pipeline in reversed(list(_started)):
+		pipeline.stop()
@@ -11,18 +11,25 @@ from flask_oauthlib.client import OAuth
 
 from opencensus.ext.stackdriver import trace_exporter as stackdriver_exporter
 from opencensus.ext.flask.flask_middleware import FlaskMiddleware as Tracing
-from opencensus.common.transports.async_ \
-    import AsyncTransport
 
-from engineering_diplomats.controllers import Mailer, MongoConnector
+from engineering_diplomats.assets import init_assets
+from engineering_diplomats.controllers import HTTPClient, Mailer, MongoConnector
+from engineering_diplomats.logging_pipeline import install_logging
+from engineering_diplomats.metrics import SharedMetrics, registry
 from engineering_diplomats.routes import apply_routes
-from engineering_diplomats.settings import microsoft_oauth_config, app_config_kwargs
+from engineering_diplomats.services import DiplomatRoster, OutboxWorker
+from engineering_diplomats.sessions import MemcachedSessionInterface
+from engineering_diplomats.settings import microsoft_oauth_config, app_config_kwargs, get_cache, startup_report, timed
+from engineering_diplomats.tracing import EXCLUDED_PATHS, BoundedTransport, TracedTemplate, sampler_from_environment
+from engineering_diplomats.utilities import notifications
 from engineering_diplomats.views.views import SiteHandler
+from engineering_diplomats.workers import task_pool
 
 
 @logme.log
 def init_app(logger=None) -> Flask:
 	"""Initialize the application"""
+	install_logging()
 	logger.debug("Initializing application from factory.")
 	
 	app = Flask(
@@ -32,26 +39,108 @@ def init_app(logger=None) -> Flask:
 	)
 	app.url_map.strict_slashes = False
 	app.config.update(**app_config_kwargs)
+	init_assets(app)
+	# SESSION_BACKEND=cookie keeps Flask's signed cookie sessions
+	if os.environ.get("SESSION_BACKEND", "memcached") == "memcached":
+		app.session_interface = MemcachedSessionInterface.from_environment(get_cache())
 
 	oauth = OAuth(app)
-	db = MongoConnector(app)
+	with timed("mongo"):
+		db = MongoConnector(app)
+		db.ensure_indexes()
 	mailer = Mailer(Mail(app))
-
-	exporter = stackdriver_exporter.StackdriverExporter(
-    	project_id=os.environ.get("GCP_PROJECT"), transport=AsyncTransport
+	outbox = OutboxWorker.from_environment(db, mailer)
+	outbox.start()
+	roster = DiplomatRoster(
+		db,
+		ttl=float(os.environ.get("ROSTER_TTL", 3600)),
+		poll_ttl=float(os.environ.get("ROSTER_POLL_INTERVAL", 60)),
 	)
-	tracer = Tracing(app, exporter=exporter)
+	roster.start()
+
+	# TRACE_SAMPLER=off skips tracing entirely; see sampler_from_environment()
+	sampler = sampler_from_environment()
+	if sampler is not None:
+		with timed("tracing"):
+			exporter = stackdriver_exporter.StackdriverExporter(
+				project_id=os.environ.get("GCP_PROJECT"), transport=BoundedTransport.factory()
+			)
+			tracer = Tracing(app, excludelist_paths=EXCLUDED_PATHS, sampler=sampler, exporter=exporter)
+			app.jinja_env.template_class = TracedTemplate
+		registry.callback(
+			"trace_spans_total",
+			"Finished spans by outcome: exported, dropped by the full export queue, or failed to export.",
+			"counter",
+			("outcome",),
+			lambda: [((outcome,), count) for outcome, count in exporter.transport.stats.items() if outcome != "queued"],
+		)
 
 	microsoft = oauth.remote_app("microsoft", **microsoft_oauth_config)
-	site_handler = SiteHandler(db, microsoft, mailer)
+	http = HTTPClient.from_environment()
+	site_handler = SiteHandler(db, microsoft, mailer, outbox, roster, http)
 	site_handler.get_token = microsoft.tokengetter(site_handler.get_token)
 	setattr(app, "site_handler", site_handler)
+	# Resolve build metadata in the background so /health does not wait on GitHub
+	task_pool.submit(site_handler.build_info.get)
+	register_metrics()
+	# With several worker processes, METRICS_DIR lets /metrics report all of them
+	if os.environ.get("METRICS_DIR"):
+		site_handler.shared_metrics = SharedMetrics(
+			registry,
+			os.environ["METRICS_DIR"],
+			interval=float(os.environ.get("METRICS_SHARE_INTERVAL", 5)),
+		)
+		site_handler.shared_metrics.start()
 	
 	app = apply_routes(app, site_handler)
 
+	logger.info(f"Startup timings: {startup_report()}")
 	logger.debug("Initialization complete; returning application. ")
 	return app
 
 
+def register_metrics() -> None:
+	"""Expose the counters kept by the cache, the logging queue, SMS notifications and the worker pool at /metrics."""
+	registry.callback(
+		"cache_operations_total",
+		"Two-tier cache hits, misses, writes and errors.",
+		"counter",
+		("result",),
+		lambda: [((result,), count) for result, count in get_cache().stats.items()],
+	)
+	registry.callback(
+		"log_records_dropped_total",
+		"Log records discarded because the logging queue was full.",
+		"counter",
+		(),
+		lambda: [((), install_logging().dropped)],
+	)
+	registry.callback(
+		"sms_notifications_total",
+		"SMS notifications received, digests sent and failed sends.",
+		"counter",
+		("outcome",),
+		lambda: [((outcome,), count) for outcome, count in notifications.stats.items() if outcome != "pending"],
+	)
+	registry.callback(
+		"worker_pool_tasks_total",
+		"Background tasks by outcome.",
+		"counter",
+		("pool", "outcome"),
+		lambda: [
+			((task_pool.name, outcome), count)
+			for outcome, count in task_pool.stats.items()
+			if outcome in ("submitted", "completed", "failed", "rejected", "caller_ran")
+		],
+	)
+	registry.callback(
+		"worker_pool_queued_tasks",
+		"Background tasks waiting for a worker thread.",
+		"gauge",
+		("pool",),
+		lambda: [((task_pool.name,), task_pool.stats["queued"])],
+	)
+
+
 if __name__ == "__main__": # pragma: no cover
 	init_app().run(host="0.0.0.0", port=8080, threaded=True, debug=True)
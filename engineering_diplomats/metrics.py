@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+
+"""In-process metrics, exposed in the Prometheus text format at /metrics."""
+
+import atexit
+import fcntl
+import json
+import math
+import os
+
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import logme
+
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException
+
+from engineering_diplomats.tracing import end_span, start_span
+
+# Upper bounds in seconds; covers a memcached hit up to a slow Calendar sync
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Totals of exited workers, kept so that counters and histograms never go down
+ARCHIVE = "archived.json"
+
+# Families whose totals are kept when a worker exits; gauges disappear with it
+ARCHIVED_KINDS = ("counter", "histogram")
+
+
+class _CounterChild(object):
+	"""One labelled series of a Counter."""
+	__slots__ = ("value",)
+
+	def __init__(self):
+		self.value = 0.0
+
+
+	def inc(self, amount: float = 1.0) -> None:
+		self.value += amount
+
+
+class _HistogramChild(object):
+	"""One labelled series of a Histogram."""
+	__slots__ = ("buckets", "counts", "sum")
+
+	def __init__(self, buckets: Tuple[float, ...]):
+		self.buckets = buckets
+		# One count per bucket plus the +Inf bucket, not cumulative
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+
+
+	def observe(self, value: float) -> None:
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+
+
+	def time(self) -> "_Timer":
+		"""A context manager that observes the seconds spent inside it."""
+		return _Timer(self)
+
+
+	def quantile(self, q: float) -> float:
+		"""Estimate the ``q`` quantile, interpolating within a bucket as Prometheus does."""
+		return quantile(q, self.buckets, self.counts)
+
+
+class _Timer(object):
+	__slots__ = ("child", "started")
+
+	def __init__(self, child: _HistogramChild):
+		self.child = child
+
+
+	def __enter__(self) -> "_Timer":
+		self.started = perf_counter()
+		return self
+
+
+	def __exit__(self, *exc_info) -> None:
+		self.child.observe(perf_counter() - self.started)
+
+
+class _Metric(object):
+	"""A named family of series, one per combination of label values.
+
+	Updates take no lock. Under gevent, which serves production, greenlets
+	only switch on I/O, so an increment is never interleaved with another.
+	With real threads a concurrent increment may rarely be lost, which is
+	an acceptable error for metrics and cheaper than a lock per request.
+	"""
+	kind = None
+
+	def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self._children = {}
+		self._lock = Lock()
+
+
+	def labels(self, *values: str):
+		"""Return the series for the given label values, creating it on first use."""
+		values = tuple(str(value) for value in values)
+		child = self._children.get(values)
+		if child is None:
+			if len(values) != len(self.labelnames):
+				raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}.")
+			with self._lock:
+				child = self._children.setdefault(values, self._child())
+		return child
+
+
+	def _child(self):
+		raise NotImplementedError
+
+
+class Counter(_Metric):
+	"""A value that only goes up, e.g. a number of requests."""
+	kind = "counter"
+
+	def inc(self, amount: float = 1.0) -> None:
+		"""Increment the series of a metric without labels."""
+		self.labels().inc(amount)
+
+
+	def _child(self) -> _CounterChild:
+		return _CounterChild()
+
+
+	def _series(self) -> List[list]:
+		return [[list(values), child.value] for values, child in list(self._children.items())]
+
+
+class Histogram(_Metric):
+	"""Observations counted into fixed buckets, e.g. request durations in seconds."""
+	kind = "histogram"
+
+	def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+		super().__init__(name, help, labelnames)
+		self.buckets = tuple(sorted(buckets))
+
+
+	def observe(self, value: float) -> None:
+		"""Observe a value on the series of a metric without labels."""
+		self.labels().observe(value)
+
+
+	def _child(self) -> _HistogramChild:
+		return _HistogramChild(self.buckets)
+
+
+	def _series(self) -> List[list]:
+		return [[list(values), list(child.counts) + [child.sum]] for values, child in list(self._children.items())]
+
+
+class _Callback(object):
+	"""A metric whose series are read from a function when metrics are collected."""
+	def __init__(self, name: str, help: str, kind: str, labelnames: Iterable[str], collect: Callable):
+		self.name = name
+		self.help = help
+		self.kind = kind
+		self.labelnames = tuple(labelnames)
+		self.collect = collect
+
+
+	def _series(self) -> List[list]:
+		return [[[str(value) for value in values], float(value)] for values, value in self.collect()]
+
+
+@logme.log
+class Registry(object):
+	"""Holds every metric of the process and renders them for Prometheus.
+
+	Metrics are created on first request for their name and returned
+	as is afterwards, so modules can declare them at import time.
+	"""
+	def __init__(self):
+		self._metrics = {}
+		self._lock = Lock()
+
+
+	def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+		"""Return the counter called ``name``, creating it if needed."""
+		return self._get(Counter, name, help, labelnames)
+
+
+	def histogram(self, name: str, help: str, labelnames: Iterable[str] = (),
+			buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+		"""Return the histogram called ``name``, creating it if needed."""
+		return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+
+	def callback(self, name: str, help: str, kind: str, labelnames: Iterable[str],
+			collect: Callable[[], Iterable[Tuple[tuple, float]]]) -> None:
+		"""Register a metric whose series are read from ``collect`` at every scrape.
+
+		Parameters
+		----------
+		kind : str
+			"counter" or "gauge".
+		collect : Callable[[], Iterable[Tuple[tuple, float]]]
+			Returns (label values, value) pairs, e.g. from a component's stats.
+			Replaces any callback registered under the same name.
+		"""
+		with self._lock:
+			self._metrics[name] = _Callback(name, help, kind, labelnames, collect)
+
+
+	def snapshot(self) -> Dict[str, dict]:
+		"""The current value of every series, in a JSON-serializable form."""
+		snapshot = {}
+		for metric in list(self._metrics.values()):
+			try:
+				series = metric._series()
+			except Exception as e:
+				self.logger.warning(f"Could not collect {metric.name}: {e}")
+				continue
+			snapshot[metric.name] = {
+				"kind": metric.kind,
+				"help": metric.help,
+				"labelnames": list(metric.labelnames),
+				"buckets": list(getattr(metric, "buckets", ())),
+				"series": series,
+			}
+		return snapshot
+
+
+	def render(self, snapshots: Iterable[Dict[str, dict]] = None) -> str:
+		"""Render metrics in the Prometheus text exposition format.
+
+		Parameters
+		----------
+		snapshots : Iterable[Dict[str, dict]]
+			Snapshots to add together, e.g. one per worker process.
+			Defaults to this registry's own snapshot.
+		"""
+		merged = merge(snapshots if snapshots is not None else [self.snapshot()])
+		lines = []
+		for name in sorted(merged):
+			family = merged[name]
+			lines.append(f"# HELP {name} {_escape(family['help'], quote=False)}")
+			lines.append(f"# TYPE {name} {family['kind']}")
+			labelnames = family["labelnames"]
+			for values, value in sorted(family["series"].items()):
+				labels = list(zip(labelnames, values))
+				if family["kind"] != "histogram":
+					lines.append(f"{name}{_labels(labels)} {_number(value)}")
+					continue
+				cumulative = 0
+				for bound, count in zip(list(family["buckets"]) + ["+Inf"], value[:-1]):
+					cumulative += count
+					le = bound if bound == "+Inf" else _number(bound)
+					lines.append(f"{name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+				lines.append(f"{name}_sum{_labels(labels)} {_number(value[-1])}")
+				lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+		return "\n".join(lines) + "\n"
+
+
+	def _get(self, cls, name: str, help: str, labelnames: Iterable[str], **kwargs) -> _Metric:
+		metric = self._metrics.get(name)
+		if metric is None:
+			with self._lock:
+				metric = self._metrics.setdefault(name, cls(name, help, labelnames, **kwargs))
+		if not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+			raise ValueError(f"Metric {name} is already registered as a different {metric.kind}.")
+		return metric
+
+
+@logme.log
+class SharedMetrics(object):
+	"""Combines the metrics of every worker process on the host.
+
+	Each worker serves /metrics alone, so with WEB_CONCURRENCY > 1 a scrape
+	would only see the worker that answered it. Every ``interval`` seconds,
+	before answering a scrape and at exit, each worker writes its snapshot
+	to ``directory``. /metrics adds up the files only, so a total never
+	goes down when scrapes alternate between workers. The counters and
+	histograms of a worker that has exited are added to ``archived.json``,
+	as in prometheus_client's multiprocess mode, so a rollover is not
+	mistaken for a counter reset.
+
+	Attributes
+	----------
+	registry : Registry
+		This worker's registry.
+	directory : str
+		A directory shared by the workers, from METRICS_DIR.
+	interval : float
+		Seconds between writes, from METRICS_SHARE_INTERVAL.
+	"""
+	def __init__(self, registry: Registry, directory: str, interval: float = 5.0):
+		self.registry = registry
+		self.directory = directory
+		self.interval = interval
+		os.makedirs(directory, exist_ok=True)
+
+
+	def start(self) -> None:
+		"""Start writing this worker's snapshot in the background."""
+		thread = Thread(target=self._share, name="metrics", daemon=True)
+		thread.start()
+		atexit.register(self.write)
+
+
+	def write(self) -> None:
+		"""Write this worker's snapshot, replacing the previous one atomically."""
+		self._dump(f"{os.getpid()}.json", self.registry.snapshot())
+
+
+	def render(self) -> str:
+		"""Render the metrics of every worker, archiving those of workers that have exited."""
+		self.write()
+		# Scrapes and archiving must not interleave, or a worker's totals could be counted twice
+		with open(os.path.join(self.directory, ".lock"), "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			snapshots = []
+			archive = self._read(ARCHIVE)
+			for name in os.listdir(self.directory):
+				pid, extension = os.path.splitext(name)
+				if extension != ".json" or not pid.isdigit():
+					continue
+				snapshot = self._read(name)
+				if _alive(int(pid)):
+					snapshots.append(snapshot)
+					continue
+				archive = _unmerge(merge([archive, {
+					name: family for name, family in snapshot.items() if family["kind"] in ARCHIVED_KINDS
+				}]))
+				self._dump(ARCHIVE, archive)
+				self._remove(os.path.join(self.directory, name))
+		return self.registry.render(snapshots + [archive])
+
+
+	def _share(self) -> None:
+		while True:
+			try:
+				self.write()
+			except (OSError, TypeError, ValueError) as e:
+				self.logger.warning(f"Could not share metrics: {e}")
+			sleep(self.interval)
+
+
+	def _read(self, name: str) -> Dict[str, dict]:
+		try:
+			with open(os.path.join(self.directory, name)) as snapshot:
+				return json.load(snapshot)
+		except FileNotFoundError:
+			return {}
+		except (OSError, ValueError) as e:
+			self.logger.warning(f"Skipping metrics in {name}: {e}")
+			return {}
+
+
+	def _dump(self, name: str, snapshot: Dict[str, dict]) -> None:
+		"""Replace a snapshot file atomically; the temporary name is unique to this process."""
+		path = os.path.join(self.directory, name)
+		with open(f"{path}.{os.getpid()}.tmp", "w") as output:
+			json.dump(snapshot, output)
+		os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+	@staticmethod
+	def _remove(path: str) -> None:
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+
+def merge(snapshots: Iterable[Dict[str, dict]]) -> Dict[str, dict]:
+	"""Add up snapshots series by series.
+
+	Returns
+	-------
+	Dict[str, dict]
+		Each family's metadata, with ``series`` mapping a tuple of label values to its value.
+	"""
+	merged = {}
+	for snapshot in snapshots:
+		for name, family in snapshot.items():
+			target = merged.setdefault(name, dict(family, series={}))
+			if family["kind"] == "histogram" and family["buckets"] != target["buckets"]:
+				continue
+			for values, value in family["series"]:
+				key = tuple(values)
+				current = target["series"].get(key)
+				if current is None:
+					target["series"][key] = value
+				elif isinstance(value, list):
+					target["series"][key] = [a + b for a, b in zip(current, value)]
+				else:
+					target["series"][key] = current + value
+	return merged
+
+
+def _unmerge(merged: Dict[str, dict]) -> Dict[str, dict]:
+	"""Convert the result of merge() back to the JSON-serializable form of a snapshot."""
+	return {
+		name: dict(family, series=[[list(values), value] for values, value in family["series"].items()])
+		for name, family in merged.items()
+	}
+
+
+def quantile(q: float, buckets: Iterable[float], counts: List[int]) -> float:
+	"""Estimate a quantile from non-cumulative bucket counts.
+
+	Parameters
+	----------
+	q : float
+		The quantile, e.g. 0.99.
+	buckets : Iterable[float]
+		The buckets' upper bounds, without +Inf.
+	counts : List[int]
+		The count of each bucket followed by the +Inf bucket's.
+
+	Returns
+	-------
+	float
+		The estimate, or NaN if there are no observations. Observations
+		above the last bound are reported as the last bound.
+	"""
+	buckets = list(buckets)
+	total = sum(counts)
+	if not total:
+		return float("nan")
+	rank = q * total
+	cumulative = 0
+	for index, count in enumerate(counts):
+		if cumulative + count >= rank and count:
+			if index == len(buckets):
+				return buckets[-1]
+			lower = buckets[index - 1] if index else 0.0
+			return lower + (buckets[index] - lower) * (rank - cumulative) / count
+		cumulative += count
+	return buckets[-1]
+
+
+def _alive(pid: int) -> bool:
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
+
+
+def _escape(value: str, quote: bool = True) -> str:
+	value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+	return value.replace("\"", "\\\"") if quote else value
+
+
+def _labels(labels: List[Tuple[str, str]]) -> str:
+	if not labels:
+		return ""
+	return "{" + ",".join(f"{name}=\"{_escape(value)}\"" for name, value in labels) + "}"
+
+
+def _number(value: float) -> str:
+	value = float(value)
+	if math.isfinite(value) and value == int(value):
+		return str(int(value))
+	return repr(value).replace("inf", "Inf").replace("nan", "NaN")
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+	"http_request_duration_seconds",
+	"Time to produce a response, by endpoint, method and status. Streamed pages are timed until streaming begins.",
+	("endpoint", "method", "status"),
+)
+
+dependency_seconds = registry.histogram(
+	"dependency_call_duration_seconds",
+	"Duration of calls to MongoDB, SMTP, Google Calendar, Twilio and HTTP APIs, by outcome.",
+	("dependency", "operation", "outcome"),
+)
+
+
+def measure(dependency: str, operation: str = None) -> Callable:
+	"""Defines a wrapper that times every call to an external dependency.
+
+	Parameters
+	----------
+	dependency : str
+		The service called, e.g. "mongo" or "smtp".
+	operation : str
+		The operation's name; defaults to the function's name.
+
+	Returns
+	-------
+	Callable
+		A decorator that observes each call in dependency_call_duration_seconds,
+		with outcome "error" if the call raised. In a sampled request the
+		call is also a child span named "<dependency>.<operation>".
+	"""
+	def decorator(f: Callable) -> Callable:
+		name = operation or f.__name__
+		span_name = f"{dependency}.{name}"
+		ok = dependency_seconds.labels(dependency, name, "ok")
+
+		@wraps(f)
+		def wrapper(*args, **kwargs):
+			tracer = start_span(span_name)
+			started = perf_counter()
+			try:
+				result = f(*args, **kwargs)
+			except BaseException:
+				dependency_seconds.labels(dependency, name, "error").observe(perf_counter() - started)
+				raise
+			finally:
+				end_span(tracer)
+			ok.observe(perf_counter() - started)
+			return result
+		return wrapper
+	return decorator
+
+
+def instrument_view(endpoint: str, view: Callable) -> Callable:
+	"""Wrap a view so that each request is observed in http_request_duration_seconds.
+
+	Parameters
+	----------
+	endpoint : str
+		The endpoint's name, used as the label rather than the URL so
+		that path parameters do not create a series per value.
+	view : Callable
+		The view function.
+	"""
+	@wraps(view)
+	def wrapper(*args, **kwargs):
+		started = perf_counter()
+		status = 500
+		try:
+			response = current_app.make_response(view(*args, **kwargs))
+			status = response.status_code
+			return response
+		except HTTPException as e:
+			status = e.code
+			raise
+		finally:
+			request_seconds.labels(endpoint, request.method, status).observe(perf_counter() - started)
+	return wrapper
@@ -1,27 +1,37 @@
 # -*- coding: utf-8 -*-
 
+from engineering_diplomats.metrics import instrument_view
+
+
 def apply_routes(app, handler) -> object:
 	"""Add routes to views, GET is an implied method.
+	Every view is timed in the http_request_duration_seconds histogram.
 	
 	Returns
 	-------
 	flask.Flask
 		Flask application with associated routes.
 	"""
+	def add_url_rule(rule, endpoint, view, **options):
+		app.add_url_rule(rule, endpoint, instrument_view(endpoint, view), **options)
+
 	# Register GET routes
-	app.add_url_rule("/", "index", handler.index)
-	app.add_url_rule("/authorize", "authorize", handler.authorize)
-	app.add_url_rule("/logout", "logout", handler.logout)
-	app.add_url_rule("/resources", "resources", handler.resources)
-	app.add_url_rule("/fundraisers", "fundraisers", handler.fundraisers)
-	app.add_url_rule("/points", "points", handler.points)
-	app.add_url_rule("/health", "health", handler.health)
+	add_url_rule("/", "index", handler.index)
+	add_url_rule("/authorize", "authorize", handler.authorize)
+	add_url_rule("/logout", "logout", handler.logout)
+	add_url_rule("/resources", "resources", handler.resources)
+	add_url_rule("/fundraisers", "fundraisers", handler.fundraisers)
+	add_url_rule("/points", "points", handler.points)
+	add_url_rule("/health", "health", handler.health)
+	add_url_rule("/livez", "livez", handler.livez)
+	add_url_rule("/readyz", "readyz", handler.readyz)
+	add_url_rule("/metrics", "metrics", handler.metrics)
 
 	# Register POST routes
 	methods = ["GET", "POST"]
-	app.add_url_rule("/login", "login", handler.login, methods=methods)
-	app.add_url_rule("/questions", "questions", handler.questions, methods=methods)
-	app.add_url_rule("/ask", "ask", handler.ask, methods=methods)
-	app.add_url_rule("/events", "events", handler.events, methods=methods)
+	add_url_rule("/login", "login", handler.login, methods=methods)
+	add_url_rule("/questions", "questions", handler.questions, methods=methods)
+	add_url_rule("/ask", "ask", handler.ask, methods=methods)
+	add_url_rule("/events", "events", handler.events, methods=methods)
 	
 	return app
\ No newline at end of file
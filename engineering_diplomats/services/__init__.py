@@ -1 +1,9 @@
 # -*- coding: utf-8 -*-
+
+from .calendar import CalendarIndex
+from .notifications import LocalTransport, NotificationDispatcher, TwilioTransport
+from .outbox import OutboxWorker
+from .probes import Readiness
+from .roster import DiplomatRoster
+from .rsvp import RSVPWriter
+from .snapshot import Snapshot
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental synchronization of a Google Calendar."""
+
+from bisect import bisect_left, insort
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Callable, List, Tuple
+
+import logme
+
+from dateutil.parser import parse
+from googleapiclient.errors import HttpError
+
+GONE = 410
+
+
+@logme.log
+class CalendarIndex(object):
+	"""A local, ordered index of calendar events kept current with
+	the Calendar API's syncToken protocol.
+
+	The first sync downloads every event that has not ended yet and
+	stores the nextSyncToken returned on the last page. Later syncs send
+	that token back and only receive events that were created, changed
+	or cancelled since, so
+	the cost of a refresh depends on how much changed rather than on
+	how many events there are. If Google expires the token (410 Gone),
+	the index is rebuilt from a full sync.
+
+	Attributes
+	----------
+	get_service : Callable[[], googleapiclient.discovery.Resource]
+		Returns an authorized Calendar v3 service.
+	calendar_id : str
+		The calendar to mirror.
+	sync_token : Union[str, None]
+		Token for the next incremental sync, None before the first full sync.
+
+	Notes
+	------
+	Entries are stored in the format returned by utilities.get_events(),
+	with start times already formatted and attendees reduced to emails.
+	Events without a location or a timed start are not displayed on the
+	site and are therefore not indexed.
+	"""
+	def __init__(self, get_service: Callable, calendar_id: str = "primary"):
+		self.get_service = get_service
+		self.calendar_id = calendar_id
+		self.sync_token = None
+		self._entries = {}
+		self._order = []
+		self._lock = Lock()
+		self._sync_lock = Lock()
+
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+
+	def sync(self) -> int:
+		"""Apply every change made to the calendar since the last sync.
+
+		Returns
+		-------
+		int
+			The number of changed events that were received.
+		"""
+		with self._sync_lock:
+			if self.sync_token is None:
+				return self._full_sync()
+			try:
+				items, sync_token = self._list(self.sync_token)
+			except HttpError as e:
+				if e.resp.status != GONE:
+					raise
+				self.logger.info("Calendar sync token expired; performing a full sync.")
+				return self._full_sync()
+			with self._lock:
+				for event in items:
+					self._apply(event)
+			self.sync_token = sync_token
+			return len(items)
+
+
+	def apply(self, event: dict) -> None:
+		"""Apply a single event resource, e.g. the response of a patch request.
+
+		Parameters
+		----------
+		event : dict
+			A Calendar API event resource.
+		"""
+		with self._lock:
+			self._apply(event)
+
+
+	def upcoming(self, limit: int = 100) -> List[List]:
+		"""Return the indexed events that have not ended yet, ordered by start time.
+
+		Parameters
+		----------
+		limit : int
+			The maximum number of events to return.
+
+		Returns
+		-------
+		List[List]
+			Event entries as described in utilities.fetch_events().
+		"""
+		now = datetime.now(timezone.utc)
+		upcoming = []
+		with self._lock:
+			for _, event_id in self._order:
+				end, entry = self._entries[event_id][1:]
+				if end > now:
+					upcoming.append(entry)
+					if len(upcoming) == limit:
+						break
+		return upcoming
+
+
+	def _full_sync(self) -> int:
+		"""Rebuild the index from every event in the calendar."""
+		items, sync_token = self._list(None)
+		with self._lock:
+			self._entries = {}
+			self._order = []
+			for event in items:
+				self._apply(event)
+		self.sync_token = sync_token
+		self.logger.debug(f"Full calendar sync indexed {len(self._entries)} events.")
+		return len(items)
+
+
+	def _list(self, sync_token: str) -> Tuple[List[dict], str]:
+		"""Page through events().list and return the items and the nextSyncToken."""
+		items = []
+		kwargs = {"calendarId": self.calendar_id, "singleEvents": True, "maxResults": 250}
+		if sync_token is not None:
+			kwargs["syncToken"] = sync_token
+		else:
+			# Past events are never displayed; later syncs still report every change
+			kwargs["timeMin"] = datetime.utcnow().isoformat() + "Z"
+		while True:
+			result = self.get_service().events().list(**kwargs).execute()
+			items.extend(result.get("items", []))
+			if "nextPageToken" not in result:
+				return items, result.get("nextSyncToken")
+			kwargs["pageToken"] = result["nextPageToken"]
+
+
+	def _apply(self, event: dict) -> None:
+		"""Insert, replace or remove one event. Callers must hold self._lock."""
+		event_id = event.get("id")
+		previous = self._entries.pop(event_id, None)
+		if previous is not None:
+			del self._order[bisect_left(self._order, (previous[0], event_id))]
+
+		start = event.get("start", {}).get("dateTime")
+		if event.get("status") == "cancelled" or "location" not in event or start is None:
+			return
+
+		start = parse(start)
+		end = event.get("end", {}).get("dateTime")
+		end = parse(end) if end is not None else start
+		start_date, *start_time = start.strftime("%m/%d/%Y %I:%M %p").split(" ")
+		attendees = event.get("attendees", None)
+		if attendees is not None:
+			attendees = [a["email"] for a in attendees]
+		entry = [
+			event.get("summary"),
+			f"{start_date} at {' '.join(start_time)}",
+			event["location"],
+			attendees,
+			event_id,
+		]
+		self._entries[event_id] = (start, end, entry)
+		insort(self._order, (start, event_id))
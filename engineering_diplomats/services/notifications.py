@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Coalesced, rate-limited SMS notifications."""
+
+import atexit
+import os
+
+from threading import Lock, Timer
+from time import monotonic
+from typing import Dict, List
+
+import logme
+
+from twilio.rest import Client
+
+from engineering_diplomats.metrics import measure
+
+# Twilio splits longer bodies into several billed segments and rejects bodies over 1600 characters
+MAX_BODY_LENGTH = 1600
+
+
+@logme.log
+class TwilioTransport(object):
+	"""Sends SMS through a single Twilio client, created on first use.
+
+	The client keeps its HTTPS connection to Twilio open between
+	messages. It reads its sid and token from the TWILIO_ACCOUNT_SID
+	and TWILIO_AUTH_TOKEN environment variables.
+
+	Attributes
+	----------
+	to : str
+		The number notifications are sent to, from TWILIO_TARGET.
+	from_ : str
+		The Twilio number they are sent from, from TWILIO_NUMBER.
+	"""
+	def __init__(self, to: str = None, from_: str = None):
+		self.to = to or os.environ.get("TWILIO_TARGET")
+		self.from_ = from_ or os.environ.get("TWILIO_NUMBER")
+		self._client = None
+		self._lock = Lock()
+
+
+	@property
+	def client(self):
+		if self._client is None:
+			with self._lock:
+				if self._client is None:
+					self._client = Client()
+		return self._client
+
+
+	@measure("twilio")
+	def send(self, body: str) -> None:
+		self.client.messages.create(to=self.to, from_=self.from_, body=body)
+
+
+class LocalTransport(object):
+	"""Keeps messages in memory instead of sending them, for tests and local development.
+
+	Attributes
+	----------
+	sent : List[str]
+		The body of every message sent, in order.
+	"""
+	def __init__(self):
+		self.sent = []
+
+
+	def send(self, body: str) -> None:
+		self.sent.append(body)
+
+
+@logme.log
+class NotificationDispatcher(object):
+	"""Coalesces notifications into digests and sends them within a rate limit.
+
+	The first notification opens a window. Every notification that
+	arrives within the window joins it, and when the window closes they
+	are sent as one message. Sends are limited by a token bucket holding
+	up to ``burst`` tokens, refilled at ``rate`` tokens a second; while
+	it is empty, notifications keep joining the pending digest, which is
+	sent as soon as a token is available. The number of messages sent,
+	and of connections made, so depends on time rather than on how many
+	notifications there are.
+
+	Attributes
+	----------
+	transport : Union[TwilioTransport, LocalTransport]
+		Sends a message body.
+	window : float
+		Seconds to collect notifications before sending them.
+	rate : float
+		Long-run maximum number of messages sent per second.
+	burst : float
+		Number of messages that can be sent at once after a quiet period.
+	max_pending : int
+		Notifications kept for the next digest; later ones are only counted.
+	"""
+	def __init__(self, transport, window: float = 30.0, rate: float = 1 / 60, burst: float = 3.0,
+		max_pending: int = 50):
+		self.transport = transport
+		self.window = window
+		self.rate = rate
+		self.burst = burst
+		self.max_pending = max_pending
+		self._pending = []
+		self._overflow = 0
+		self._timer = None
+		self._tokens = burst
+		self._updated = monotonic()
+		self._lock = Lock()
+		self._counters = {"notified": 0, "sent": 0, "failed": 0}
+
+
+	@classmethod
+	def from_environment(cls) -> "NotificationDispatcher":
+		"""Create a dispatcher configured by the SMS_* environment variables.
+
+		SMS_TRANSPORT is "twilio" (the default) or "local", which keeps
+		messages in memory. SMS_RATE_LIMIT is in messages per minute and
+		SMS_BURST in messages, for the whole pod: each of the
+		WEB_CONCURRENCY worker processes has its own dispatcher and gets
+		an equal share of both.
+
+		Raises
+		------
+		ValueError
+			If SMS_TRANSPORT is unknown or SMS_RATE_LIMIT is not positive.
+		"""
+		workers = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+		name = os.environ.get("SMS_TRANSPORT", "twilio")
+		if name not in ("twilio", "local"):
+			raise ValueError(f"Unknown SMS_TRANSPORT {name!r}; expected 'twilio' or 'local'.")
+		rate_limit = float(os.environ.get("SMS_RATE_LIMIT", 1))
+		if rate_limit <= 0:
+			raise ValueError(f"SMS_RATE_LIMIT must be a positive number of messages per minute, not {rate_limit:g}.")
+		dispatcher = cls(
+			TwilioTransport() if name == "twilio" else LocalTransport(),
+			window=float(os.environ.get("SMS_WINDOW", 30)),
+			rate=rate_limit / 60 / workers,
+			burst=max(1.0, float(os.environ.get("SMS_BURST", 3)) / workers),
+			max_pending=int(os.environ.get("SMS_MAX_PENDING", 50)),
+		)
+		atexit.register(dispatcher.close)
+		return dispatcher
+
+
+	@property
+	def stats(self) -> Dict[str, int]:
+		"""Notifications received, messages sent and sends that failed, with notifications pending."""
+		with self._lock:
+			stats = dict(self._counters)
+			stats.update(pending=len(self._pending) + self._overflow)
+		return stats
+
+
+	def notify(self, message: str) -> None:
+		"""Queue a notification for the next digest without waiting for it to be sent."""
+		with self._lock:
+			self._counters["notified"] += 1
+			if len(self._pending) < self.max_pending:
+				self._pending.append(message)
+			else:
+				self._overflow += 1
+			if self._timer is None:
+				self._schedule(self.window)
+
+
+	def flush(self) -> None:
+		"""Send the pending notifications if the rate limit allows, or wait for the next token."""
+		with self._lock:
+			self._timer = None
+			if not self._pending:
+				return
+			wait = self._take_token()
+			if wait > 0:
+				self._schedule(wait)
+				return
+			messages, overflow = self._take()
+		self._send(messages, overflow)
+
+
+	def close(self) -> None:
+		"""Send the pending notifications now, regardless of the rate limit."""
+		with self._lock:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			messages, overflow = self._take()
+		if messages:
+			self._send(messages, overflow)
+
+
+	def _schedule(self, delay: float) -> None:
+		self._timer = Timer(delay, self.flush)
+		self._timer.daemon = True
+		self._timer.start()
+
+
+	def _take_token(self) -> float:
+		"""Take a token and return 0, or return the seconds until one is available."""
+		now = monotonic()
+		self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+		if self._tokens < 1.0:
+			return (1.0 - self._tokens) / self.rate
+		self._tokens -= 1.0
+		return 0.0
+
+
+	def _take(self):
+		messages, overflow = self._pending, self._overflow
+		self._pending, self._overflow = [], 0
+		return messages, overflow
+
+
+	def _send(self, messages: List[str], overflow: int) -> None:
+		body = digest(messages, overflow)
+		try:
+			self.transport.send(body)
+		except Exception as e:
+			self.logger.exception(e)
+			self._count("failed")
+		else:
+			self._count("sent")
+			self.logger.debug(f"Sent {len(messages) + overflow} notification(s) in one message.")
+
+
+	def _count(self, counter: str) -> None:
+		with self._lock:
+			self._counters[counter] += 1
+
+
+def digest(messages: List[str], overflow: int = 0) -> str:
+	"""Join notifications into one message body of at most MAX_BODY_LENGTH characters.
+
+	Parameters
+	----------
+	messages : List[str]
+		The notifications, oldest first.
+	overflow : int
+		Further notifications that were not kept.
+	"""
+	if len(messages) == 1 and not overflow:
+		return messages[0][:MAX_BODY_LENGTH]
+	total = len(messages) + overflow
+	lines = [f"{total} notifications:"]
+	length = len(lines[0])
+	for i, message in enumerate(messages):
+		more = f"(+{total - i} more)"
+		# Keep room for the count of the notifications that do not fit
+		if length + len(message) + len(more) + 2 > MAX_BODY_LENGTH:
+			lines.append(more)
+			break
+		lines.append(message)
+		length += len(message) + 1
+	else:
+		if overflow:
+			lines.append(f"(+{overflow} more)")
+	return "\n".join(lines)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""Delivery of emails queued in the MongoDB outbox."""
+
+import os
+
+from threading import Event, Thread
+from typing import Union
+from uuid import uuid4
+
+import logme
+
+
+@logme.log
+class OutboxWorker(object):
+	"""Drains the outbox collection on a set of background threads.
+
+	Each thread leases one email at a time, delivers it over the mailer's
+	pooled SMTP connections and removes it from the outbox. A failed email
+	is released with exponential backoff and dead-lettered once it has
+	used up its attempts. An email leased by a process that dies is picked
+	up again when its lease expires, so nothing is lost on a pod restart.
+
+	Attributes
+	----------
+	db : MongoConnector
+		Connection to the outbox collection.
+	mailer : Mailer
+		Builds and sends the emails.
+	workers : int
+		Number of delivery threads.
+	lease_seconds : float
+		How long a thread may hold an email before it can be retried elsewhere.
+	max_attempts : int
+		Number of delivery attempts before an email is dead-lettered.
+	backoff : float
+		Seconds to wait after the first failure; doubled for each later failure.
+	poll_interval : float
+		Seconds to sleep when the outbox is empty and no notify() arrives.
+	"""
+	def __init__(self, db, mailer, workers: int = 2, lease_seconds: float = 60.0,
+		max_attempts: int = 6, backoff: float = 30.0, poll_interval: float = 5.0):
+		self.db = db
+		self.mailer = mailer
+		self.workers = workers
+		self.lease_seconds = lease_seconds
+		self.max_attempts = max_attempts
+		self.backoff = backoff
+		self.poll_interval = poll_interval
+		self.builders = {
+			"confirmation": lambda payload: mailer.build_confirmation(payload["question_document"]),
+			"notification": lambda payload: mailer.build_notification(payload["question_document"]),
+			"answer": lambda payload: mailer.build_answer(
+				(payload["answer"], payload["question_document"], payload["diplomat"])
+			),
+		}
+		self._wake = Event()
+		self._stopping = Event()
+		self._threads = []
+
+
+	@classmethod
+	def from_environment(cls, db, mailer) -> "OutboxWorker":
+		"""Create a worker configured by the OUTBOX_* environment variables."""
+		return cls(
+			db,
+			mailer,
+			workers=int(os.environ.get("OUTBOX_WORKERS", 2)),
+			lease_seconds=float(os.environ.get("OUTBOX_LEASE_SECONDS", 60)),
+			max_attempts=int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 6)),
+			backoff=float(os.environ.get("OUTBOX_BACKOFF", 30)),
+			poll_interval=float(os.environ.get("OUTBOX_POLL_INTERVAL", 5)),
+		)
+
+
+	def start(self) -> None:
+		"""Start the delivery threads."""
+		prefix = uuid4().hex[:8]
+		for i in range(self.workers):
+			thread = Thread(target=self._work, args=(f"{prefix}-{i}",), name=f"outbox-{i}")
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+
+	def stop(self, timeout: float = 10.0) -> None:
+		"""Ask the delivery threads to exit after their current email."""
+		self._stopping.set()
+		self._wake.set()
+		for thread in self._threads:
+			thread.join(timeout)
+
+
+	def notify(self) -> None:
+		"""Wake the delivery threads because an email was just enqueued."""
+		self._wake.set()
+
+
+	def enqueue(self, kind: str, **payload) -> None:
+		"""Add an email to the outbox and wake the delivery threads.
+
+		Parameters
+		----------
+		kind : str
+			One of "confirmation", "notification" or "answer".
+		**payload
+			The data the matching Mailer.build_* method needs.
+		"""
+		if kind not in self.builders:
+			raise ValueError(f"Unknown email kind {kind!r}.")
+		self.db.enqueue_email(kind, payload)
+		self.notify()
+
+
+	def deliver(self, document: dict) -> None:
+		"""Build and send the email described by an outbox document."""
+		message = self.builders[document["kind"]](document["payload"])
+		self.mailer.send_batch([message])
+
+
+	def delay(self, attempts: int) -> Union[float, None]:
+		"""Seconds before the next attempt, or None once attempts are used up."""
+		if attempts >= self.max_attempts:
+			return None
+		return self.backoff * 2 ** (attempts - 1)
+
+
+	def _work(self, owner: str) -> None:
+		"""Delivery loop for one thread."""
+		while not self._stopping.is_set():
+			try:
+				document = self.db.lease_email(owner, self.lease_seconds)
+			except Exception as e:
+				self.logger.exception(e)
+				document = None
+			if document is None:
+				self._wake.wait(self.poll_interval)
+				self._wake.clear()
+				continue
+			try:
+				self._process(document)
+			except Exception as e:
+				self.logger.exception(e)
+
+
+	def _process(self, document: dict) -> None:
+		"""Deliver one leased email and record the outcome in the outbox."""
+		try:
+			self.deliver(document)
+		except Exception as e:
+			delay = self.delay(document["attempts"])
+			if delay is None:
+				self.logger.error(f"Dead-lettered {document['kind']} email {document['_id']}: {e}")
+			else:
+				self.logger.warning(f"Retrying {document['kind']} email {document['_id']} in {delay}s: {e}")
+			self.db.retry_email(document, repr(e), delay)
+		else:
+			self.db.complete_email(document)
+			self.logger.info(f"Delivered {document['kind']} email {document['_id']}.")
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""Readiness checks that only look at local state."""
+
+from typing import Dict, Tuple
+
+import logme
+
+from engineering_diplomats.services.snapshot import Snapshot
+
+
+@logme.log
+class Readiness(object):
+	"""Decides whether this process should receive traffic.
+
+	Each check looks at state the process already has or can reach
+	within the cluster: the Mongo client's view of the replica set
+	(maintained by pymongo's monitor threads, so no round trip), a
+	memcached stats call and the background worker queue. Results are
+	cached for ``ttl`` seconds and refreshed in the background, so a
+	probe costs a dictionary lookup. No check depends on a third party.
+
+	Attributes
+	----------
+	db : MongoConnector
+		Provides the Mongo client and the memcached client.
+	pool : WorkerPool
+		The worker pool whose queue depth is checked.
+	snapshot : Snapshot
+		The cached check results.
+	max_queue_fill : float
+		Fraction of the worker queue that may be in use before the process is not ready.
+	"""
+	def __init__(self, db, pool, ttl: float = 5.0, max_queue_fill: float = 0.9):
+		self.db = db
+		self.pool = pool
+		self.max_queue_fill = max_queue_fill
+		self.snapshot = Snapshot(self._check, ttl, name="readiness")
+
+
+	def check(self) -> Tuple[bool, Dict[str, bool]]:
+		"""Return whether every check passed, and each check's result.
+
+		Returns
+		-------
+		Tuple[bool, Dict[str, bool]]
+			True if ready, and a mapping from check name to result.
+		"""
+		checks = self.snapshot.get()
+		return all(checks.values()), checks
+
+
+	def _check(self) -> Dict[str, bool]:
+		checks = {}
+		for name, check in (("mongo", self._mongo), ("memcached", self._memcached), ("workers", self._workers)):
+			try:
+				checks[name] = bool(check())
+			except Exception as e:
+				self.logger.exception(e)
+				checks[name] = False
+			if not checks[name]:
+				self.logger.warning(f"Readiness check failed: {name}")
+		return checks
+
+
+	def _mongo(self) -> bool:
+		return self.db.client.topology_description.has_writable_server()
+
+
+	def _memcached(self) -> bool:
+		# bmemcached reports an empty dict for servers it cannot reach
+		return any(self.db.cache.client.stats().values())
+
+
+	def _workers(self) -> bool:
+		stats = self.pool.stats
+		return stats["queue_size"] <= 0 or stats["queued"] < stats["queue_size"] * self.max_queue_fill
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""In-memory roster of registered Engineering Diplomats."""
+
+from threading import Event, Thread
+from typing import FrozenSet
+
+import logme
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from engineering_diplomats.services.snapshot import Snapshot
+
+
+@logme.log
+class DiplomatRoster(object):
+	"""The registered diplomat emails, held as a set for O(1) membership checks.
+
+	The roster is loaded once and then kept current by a MongoDB change
+	stream on the registered_diplomats collection, which reloads it as soon
+	as the collection changes. The TTL is only a safety net while the change
+	stream is healthy. If the deployment does not support change streams,
+	the roster falls back to polling every ``poll_ttl`` seconds.
+
+	Attributes
+	----------
+	db : MongoConnector
+		Connection to the registered_diplomats collection.
+	snapshot : Snapshot
+		The cached set of lowercase emails.
+	ttl : float
+		TTL used while the change stream is healthy.
+	poll_ttl : float
+		TTL used while change streams are unavailable.
+	"""
+	def __init__(self, db, ttl: float = 3600.0, poll_ttl: float = 60.0):
+		self.db = db
+		self.ttl = ttl
+		self.poll_ttl = poll_ttl
+		self.snapshot = Snapshot(self._load, ttl, name="diplomats")
+		self._stopping = Event()
+		self._thread = None
+
+
+	def __contains__(self, email: str) -> bool:
+		return email is not None and email.lower() in self.snapshot.get()
+
+
+	def start(self) -> None:
+		"""Watch the collection for changes on a background thread."""
+		self._thread = Thread(target=self._watch, name="diplomat-roster")
+		self._thread.daemon = True
+		self._thread.start()
+
+
+	def stop(self) -> None:
+		"""Stop watching after the next change or poll interval."""
+		self._stopping.set()
+
+
+	def _load(self) -> FrozenSet[str]:
+		return frozenset(email.lower() for email in self.db.get_diplomats())
+
+
+	def _watch(self) -> None:
+		"""Reload the roster whenever the change stream reports a change."""
+		while not self._stopping.is_set():
+			try:
+				with self.db.watch_diplomats() as stream:
+					# Changes made before the stream opened are picked up here
+					self.snapshot.ttl = self.ttl
+					self.snapshot.reload()
+					while not self._stopping.is_set():
+						if stream.try_next() is not None:
+							self.logger.info("Registered diplomats changed; reloading roster.")
+							self.snapshot.reload()
+			except OperationFailure as e:
+				self.logger.warning(f"Change streams are unavailable; polling the roster instead: {e}")
+				self.snapshot.ttl = self.poll_ttl
+				return
+			except PyMongoError as e:
+				self.logger.exception(e)
+				self.snapshot.ttl = self.poll_ttl
+				self._stopping.wait(self.poll_ttl)
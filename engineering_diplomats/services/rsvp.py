@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Coalesced, conflict-safe RSVP writes to Google Calendar."""
+
+from concurrent.futures import Future
+from threading import Lock, Timer
+from typing import Callable, List, Tuple
+
+import logme
+
+from googleapiclient.errors import HttpError
+
+PRECONDITION_FAILED = 412
+
+
+@logme.log
+class RSVPWriter(object):
+	"""Collects RSVP changes per event and writes them as one patch.
+
+	The first RSVP for an event opens a short window. Every RSVP for the
+	same event that arrives within the window joins it, and when the window
+	closes the pending additions and removals are applied to the event's
+	current attendee list in a single patch. The patch is conditional on the
+	event's ETag (If-Match), so a concurrent writer can never silently drop
+	an attendee; on 412 Precondition Failed the event is re-read and the
+	changes are re-applied.
+
+	Attributes
+	----------
+	get_service : Callable[[], googleapiclient.discovery.Resource]
+		Returns an authorized Calendar v3 service.
+	calendar_id : str
+		The calendar that owns the events.
+	window : float
+		Number of seconds to collect RSVPs for an event before writing.
+	max_attempts : int
+		Number of conditional patches to attempt before giving up.
+	on_write : Callable[[dict], None]
+		Called with the patched event resource after each successful write.
+		Its exceptions are logged, not passed to the RSVPs' futures.
+	"""
+	def __init__(self, get_service: Callable, calendar_id: str = "primary", window: float = 0.25,
+		max_attempts: int = 5, on_write: Callable[[dict], None] = None):
+		self.get_service = get_service
+		self.calendar_id = calendar_id
+		self.window = window
+		self.max_attempts = max_attempts
+		self.on_write = on_write
+		self._pending = {}
+		self._lock = Lock()
+
+
+	def submit(self, email: str, event_id: str, unregister: bool) -> Future:
+		"""Queue an RSVP change for an event.
+
+		Parameters
+		----------
+		email : str
+			The email of the diplomat RSVPing.
+		event_id : str
+			The event being RSVPed for.
+		unregister : bool
+			True to remove the attendee, False to add them.
+
+		Returns
+		-------
+		concurrent.futures.Future
+			Resolves to the patched event resource once the change is written.
+		"""
+		future = Future()
+		with self._lock:
+			batch = self._pending.get(event_id)
+			if batch is None:
+				batch = self._pending[event_id] = []
+				timer = Timer(self.window, self.flush, args=(event_id,))
+				timer.daemon = True
+				timer.start()
+			batch.append((email, unregister, future))
+		return future
+
+
+	def flush(self, event_id: str) -> None:
+		"""Write every pending change for an event and resolve their futures."""
+		with self._lock:
+			batch = self._pending.pop(event_id, [])
+		if not batch:
+			return
+		try:
+			event = self._write(event_id, batch)
+		except Exception as e:
+			self.logger.exception(e)
+			for _, _, future in batch:
+				future.set_exception(e)
+			return
+		for _, _, future in batch:
+			future.set_result(event)
+
+
+	def _write(self, event_id: str, batch: List[Tuple[str, bool, Future]]) -> dict:
+		"""Apply a batch of changes with a conditional patch, retrying on conflicts."""
+		for attempt in range(1, self.max_attempts + 1):
+			event = self.get_service().events().get(calendarId=self.calendar_id, eventId=event_id).execute()
+			attendees = {a.get("email"): a for a in event.get("attendees", [])}
+			for email, unregister, _ in batch:
+				if unregister:
+					attendees.pop(email, None)
+				else:
+					attendees.setdefault(email, {"email": email})
+			if list(attendees.values()) == event.get("attendees", []):
+				return event
+
+			request = self.get_service().events().patch(
+				calendarId=self.calendar_id,
+				eventId=event_id,
+				sendUpdates="none",
+				body={"attendees": list(attendees.values())},
+			)
+			if "etag" in event:
+				request.headers["If-Match"] = event["etag"]
+			try:
+				event = request.execute()
+			except HttpError as e:
+				if e.resp.status != PRECONDITION_FAILED or attempt == self.max_attempts:
+					raise
+				self.logger.info(f"Event {event_id} changed during RSVP write; retrying ({attempt}).")
+				continue
+			self.logger.debug(f"Wrote {len(batch)} RSVP change(s) to event {event_id}.")
+			if self.on_write is not None:
+				# The RSVPs are saved; a failure here must not be reported as theirs
+				try:
+					self.on_write(event)
+				except Exception as e:
+					self.logger.exception(e)
+			return event
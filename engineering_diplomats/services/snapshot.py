@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""In-memory snapshots of slow, read-mostly data sources."""
+
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable
+
+import logme
+
+from engineering_diplomats.decorators import thread_task
+
+
+@logme.log
+class Snapshot(object):
+	"""Serves the last value returned by a loader for up to ``ttl`` seconds.
+
+	Once a snapshot is older than its TTL, callers keep receiving the stale
+	value while a single background refresh reloads it. Only the very first
+	load (or the first load after an invalidation) blocks the caller, and
+	concurrent callers share that one load instead of each calling the loader.
+
+	Attributes
+	----------
+	loader : Callable[[], Any]
+		Function that produces a fresh value, e.g. a Google Calendar query.
+	ttl : float
+		Number of seconds a loaded value is considered fresh.
+	name : str
+		Name used when logging refreshes and failures.
+	"""
+	def __init__(self, loader: Callable[[], Any], ttl: float, name: str = None):
+		self.loader = loader
+		self.ttl = ttl
+		self.name = name or loader.__name__
+		self._value = None
+		self._loaded_at = None
+		self._generation = 0
+		self._refreshing = False
+		self._state_lock = Lock()
+		self._load_lock = Lock()
+
+
+	@property
+	def age(self) -> float:
+		"""Seconds since the current value was loaded, or None if there is no value."""
+		loaded_at = self._loaded_at
+		return None if loaded_at is None else monotonic() - loaded_at
+
+
+	def get(self) -> Any:
+		"""Return the current value, loading or refreshing it as needed.
+
+		Returns
+		-------
+		Any
+			The most recently loaded value. May be up to one refresh
+			older than ``ttl`` seconds.
+		"""
+		with self._state_lock:
+			value, loaded_at = self._value, self._loaded_at
+			stale = loaded_at is not None and monotonic() - loaded_at >= self.ttl
+			if stale and not self._refreshing:
+				self._refreshing = True
+				generation = self._generation
+			else:
+				stale = False
+
+		if loaded_at is None:
+			return self._load()
+		if stale and not self._refresh(generation):
+			# The pool rejected the refresh; let a later call try again
+			with self._state_lock:
+				self._refreshing = False
+		return value
+
+
+	def reload(self) -> Any:
+		"""Load a fresh value on the calling thread and serve it immediately.
+
+		Returns
+		-------
+		Any
+			The freshly loaded value.
+		"""
+		with self._state_lock:
+			generation = self._generation
+		value = self.loader()
+		self._store(value, generation)
+		return value
+
+
+	def invalidate(self) -> None:
+		"""Discard the current value so that the next call to get() reloads it.
+
+		Any refresh that is already running is ignored when it completes.
+		"""
+		with self._state_lock:
+			self._generation += 1
+			self._value = None
+			self._loaded_at = None
+
+
+	def _store(self, value: Any, generation: int) -> bool:
+		"""Keep a loaded value unless the snapshot was invalidated while loading."""
+		with self._state_lock:
+			if generation != self._generation:
+				return False
+			self._value = value
+			self._loaded_at = monotonic()
+			return True
+
+
+	def _load(self) -> Any:
+		"""Load a value on the calling thread, sharing the load with concurrent callers."""
+		with self._load_lock:
+			with self._state_lock:
+				if self._loaded_at is not None:
+					return self._value
+				generation = self._generation
+			value = self.loader()
+			self._store(value, generation)
+			return value
+
+
+	@thread_task
+	def _refresh(self, generation: int) -> None:
+		"""Reload a stale value in the background."""
+		try:
+			self.logger.debug(f"Refreshing {self.name} snapshot.")
+			self._store(self.loader(), generation)
+		except Exception as e:
+			self.logger.exception(e)
+		finally:
+			with self._state_lock:
+				self._refreshing = False
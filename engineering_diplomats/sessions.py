@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""Server-side sessions stored in memcached."""
+
+import os
+import re
+
+from datetime import timedelta
+from secrets import token_urlsafe
+from threading import Lock
+
+import logme
+
+from flask.sessions import SecureCookieSession, SessionInterface
+
+from engineering_diplomats.controllers.cache import LRUCache
+from engineering_diplomats.decorators import thread_task
+
+NAMESPACE = "sessions"
+SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
+
+class ServerSideSession(SecureCookieSession):
+	"""A session whose data lives in memcached under an opaque id.
+
+	Attributes
+	----------
+	sid : str
+		The session id sent in the cookie.
+	new : bool
+		True if the id was created for this request.
+	revoked : List[str]
+		Ids to delete from memcached when the session is saved.
+	"""
+	def __init__(self, initial: dict = None, sid: str = None):
+		super().__init__(initial)
+		self.new = sid is None
+		self.sid = sid if sid is not None else token_urlsafe(32)
+		self.revoked = []
+
+
+	def regenerate(self) -> None:
+		"""Move the data to a new id and revoke the old one,
+		e.g. when a user logs in, so a planted id cannot be reused."""
+		if not self.new:
+			self.revoked.append(self.sid)
+		self.sid = token_urlsafe(32)
+		self.new = True
+		self.modified = True
+
+
+@logme.log
+class MemcachedSessionInterface(SessionInterface):
+	"""Keeps session data in the shared cache and only an opaque id in the cookie.
+
+	The cookie is an unsigned random 256-bit id, set once when a session
+	is created or regenerated. By default every request reads the session
+	from memcached, so a session changed or revoked on one replica is
+	seen by all of them on the next request. A positive ``local_ttl``
+	also keeps sessions in the cache's in-process tier for that many
+	seconds, trading that consistency for fewer reads.
+
+	Expiry slides: a session idle for ``lifetime`` expires, but every
+	request extends it. To avoid a write per request, the expiry of an
+	unmodified session is extended at most once per ``touch_interval``,
+	and extensions queued while a batch is being written are written
+	together in the next batch, in the background.
+
+	Attributes
+	----------
+	cache : MemcachedConnector
+		The shared cache.
+	lifetime : timedelta
+		Idle time after which a session expires.
+	local_ttl : float
+		Seconds a session may be served from the in-process tier, 0 to always read memcached.
+	touch_interval : float
+		Minimum seconds between extensions of one session's expiry.
+	"""
+	def __init__(self, cache, lifetime: timedelta = timedelta(days=7), local_ttl: float = 0.0,
+			touch_interval: float = 300.0):
+		self.cache = cache
+		self.lifetime = lifetime
+		self.local_ttl = local_ttl
+		self.touch_interval = touch_interval
+		self._touched = LRUCache(int(os.environ.get("SESSION_TOUCHED_SIZE", 10000)))
+		self._pending = set()
+		self._pending_lock = Lock()
+		self._flushing = False
+
+
+	@classmethod
+	def from_environment(cls, cache) -> "MemcachedSessionInterface":
+		"""Create an interface configured by the SESSION_* environment variables."""
+		return cls(
+			cache,
+			lifetime=timedelta(seconds=float(os.environ.get("SESSION_LIFETIME", 7 * 24 * 60 * 60))),
+			local_ttl=float(os.environ.get("SESSION_L1_TTL", 0)),
+			touch_interval=float(os.environ.get("SESSION_TOUCH_INTERVAL", 300)),
+		)
+
+
+	def open_session(self, app, request) -> ServerSideSession:
+		sid = request.cookies.get(self.get_cookie_name(app))
+		if sid is None or not SESSION_ID.match(sid):
+			return ServerSideSession()
+		data = self.cache.get(NAMESPACE, sid, local_ttl=self.local_ttl)
+		if data is None:
+			return ServerSideSession()
+		return ServerSideSession(data, sid)
+
+
+	def save_session(self, app, session: ServerSideSession, response) -> None:
+		name = self.get_cookie_name(app)
+		domain = self.get_cookie_domain(app)
+		path = self.get_cookie_path(app)
+		for sid in session.revoked:
+			self.cache.delete(NAMESPACE, sid)
+
+		if session.accessed:
+			response.vary.add("Cookie")
+
+		if not session:
+			if not session.new:
+				# Emptied, e.g. by logout: revoke it on every replica
+				self.cache.delete(NAMESPACE, session.sid)
+				response.delete_cookie(name, domain=domain, path=path)
+			return
+
+		if session.modified or session.new:
+			self.cache.set(NAMESPACE, session.sid, dict(session), self._ttl, local_ttl=self.local_ttl)
+			self._touched.set(session.sid, True, self.touch_interval)
+		else:
+			self._touch(session)
+
+		if session.new:
+			response.set_cookie(
+				name,
+				session.sid,
+				expires=self.get_expiration_time(app, session),
+				httponly=self.get_cookie_httponly(app),
+				domain=domain,
+				path=path,
+				secure=self.get_cookie_secure(app),
+				samesite=self.get_cookie_samesite(app),
+			)
+
+
+	@property
+	def _ttl(self) -> float:
+		return self.lifetime.total_seconds()
+
+
+	def _touch(self, session: ServerSideSession) -> None:
+		"""Queue an unmodified session to have its expiry extended."""
+		if self._touched.get(session.sid) is not None:
+			return
+		self._touched.set(session.sid, True, self.touch_interval)
+		with self._pending_lock:
+			self._pending.add(session.sid)
+			flush = not self._flushing
+			self._flushing = True
+		if flush and not self._flush():
+			# The pool rejected the flush; the next touch tries again
+			with self._pending_lock:
+				self._flushing = False
+
+
+	@thread_task
+	def _flush(self) -> None:
+		"""Extend the expiry of every queued session in one batch."""
+		while True:
+			with self._pending_lock:
+				pending, self._pending = self._pending, set()
+				if not pending:
+					self._flushing = False
+					return
+			try:
+				touched = self.cache.touch(NAMESPACE, pending, self._ttl)
+				self.logger.debug(f"Extended {touched} of {len(pending)} sessions.")
+			except Exception as e:
+				self.logger.exception(e)
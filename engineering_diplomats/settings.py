@@ -2,12 +2,22 @@
 
 """Settings and config."""
 
+import atexit
+import logging
 import os
 
-from googleapiclient.discovery import build
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import RLock
+from time import perf_counter
+from typing import Any, Callable
+
+from googleapiclient.discovery import Resource, build_from_document
 from httplib2 import Http
 from oauth2client import file, client, tools
 
+from engineering_diplomats.logging_pipeline import LogPipeline
+
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -36,12 +46,122 @@ app_config_kwargs = {
     "RECAPTCHA_DATA_ATTRS": {"theme": "dark"},
 }
 
-# Google Calendar service initialization
-store = file.Storage("token.json")
-creds = store.get()
-if not creds or creds.invalid: # pragma: allow
-	flow = client.flow_from_clientsecrets(os.environ.get("GOOGLE_CREDS"), "https://www.googleapis.com/auth/calendar")
-	creds = tools.run_flow(flow, store)
-service = build("calendar", "v3", http=creds.authorize(Http()))
+# Logger of the email delivery log, which is kept apart from the application's log
+EMAIL_LOGGER = "engineering_diplomats.emails"
+
+# Resources below are created on first use rather than at import, so importing
+# this module (every worker, every test) does no disk or network I/O.
+_lock = RLock()
+_resources = {}
+startup_timings = OrderedDict()
+
+
+@contextmanager
+def timed(name: str):
+	"""Record how long a startup step takes in startup_timings.
+
+	Parameters
+	----------
+	name : str
+		The name of the step, e.g. "calendar_service".
+	"""
+	started = perf_counter()
+	try:
+		yield
+	finally:
+		startup_timings[name] = perf_counter() - started
+
+
+def startup_report() -> str:
+	"""Summarize startup_timings, slowest step first.
+
+	Returns
+	-------
+	str
+		One "name: milliseconds" entry per recorded step.
+	"""
+	steps = sorted(startup_timings.items(), key=lambda step: step[1], reverse=True)
+	return ", ".join(f"{name}: {seconds * 1000:.1f}ms" for name, seconds in steps)
+
+
+def _resource(name: str, factory: Callable[[], Any]) -> Any:
+	"""Create a named resource once, on first use, and time its creation."""
+	if name not in _resources:
+		with _lock:
+			if name not in _resources:
+				with timed(name):
+					_resources[name] = factory()
+	return _resources[name]
+
+
+def _google_credentials():
+	store = file.Storage("token.json")
+	creds = store.get()
+	if not creds or creds.invalid: # pragma: allow
+		flow = client.flow_from_clientsecrets(os.environ.get("GOOGLE_CREDS"), "https://www.googleapis.com/auth/calendar")
+		creds = tools.run_flow(flow, store)
+	return creds
+
+
+def _calendar_service():
+	# Imported here as the controllers package imports this module
+	from engineering_diplomats.controllers.http import HttpPool
+
+	# The vendored discovery document spares a request to Google on every start
+	with open(os.path.join(__location__, "discovery", "calendar.v3.json")) as discovery:
+		document = discovery.read()
+	credentials = get_google_credentials()
+	http = HttpPool(
+		lambda: credentials.authorize(Http(timeout=float(os.environ.get("CALENDAR_TIMEOUT", 30)))),
+		size=int(os.environ.get("CALENDAR_MAX_CONNECTIONS", 4)),
+	)
+	atexit.register(http.close)
+	return build_from_document(document, http=http)
+
+
+def _cache():
+	# Imported here as the controllers package imports this module
+	from engineering_diplomats.controllers.cache import MemcachedConnector
+
+	return MemcachedConnector()
+
+
+def _email_log():
+	pipeline = LogPipeline(
+		filename=os.environ.get("EMAIL_LOG_FILE", os.path.join(__location__, "../logs/emails.log")),
+		capacity=int(os.environ.get("EMAIL_LOG_QUEUE_SIZE", 1000)),
+		batch_size=int(os.environ.get("LOG_BATCH_SIZE", 100)),
+		level="DEBUG",
+		logger=EMAIL_LOGGER,
+		console=False,
+	)
+	pipeline.start()
+	return logging.getLogger(EMAIL_LOGGER)
+
+
+def get_google_credentials() -> client.OAuth2Credentials:
+	"""Google OAuth2 credentials from token.json, running the consent flow if they are invalid."""
+	return _resource("google_credentials", _google_credentials)
+
+
+def get_calendar_service() -> Resource:
+	"""The authorized Google Calendar v3 service.
+
+	The service may be shared between threads: each request borrows one
+	of CALENDAR_MAX_CONNECTIONS (default 4) pooled, keep-alive Http objects.
+	"""
+	return _resource("calendar_service", _calendar_service)
+
+
+def get_cache() -> Any:
+	"""The process-wide MemcachedConnector with its in-process LRU tier."""
+	return _resource("cache", _cache)
+
+
+def get_email_log() -> logging.Logger:
+	"""The email delivery log, written as JSON lines to EMAIL_LOG_FILE by a background thread.
 
-emails_log_file = open(os.path.join(__location__, "../logs/emails.log"), "a+")
+	It does not propagate to the application's log; see Mailer.send_batch()
+	for the fields of each record.
+	"""
+	return _resource("email_log", _email_log)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""Request tracing: samplers, child spans and a bounded export queue."""
+
+import atexit
+import os
+
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Union
+
+import logme
+
+from jinja2 import Template
+from opencensus.common.transports.base import Transport
+from opencensus.trace import execution_context
+from opencensus.trace.samplers import AlwaysOffSampler, AlwaysOnSampler, ProbabilitySampler, Sampler
+from opencensus.trace.tracers.noop_tracer import NoopTracer
+
+SAMPLERS = ("probability", "rate_limited", "always", "never", "off")
+
+# Probes, scrapes and static files are never traced
+EXCLUDED_PATHS = ["livez", "readyz", "metrics", "static/", "_ah/health"]
+
+
+class RateLimitedSampler(Sampler):
+	"""Samples at most ``per_second`` requests each second, however busy the server is.
+
+	A token bucket holding up to ``burst`` tokens is refilled at
+	``per_second`` tokens a second, and each sampled request takes one.
+	Requests that arrive already sampled by a caller are counted against
+	the same budget, so the limit holds even then.
+
+	Attributes
+	----------
+	per_second : float
+		The long-run maximum number of sampled requests per second.
+	burst : float
+		The number of requests that can be sampled at once after a quiet period.
+	"""
+	def __init__(self, per_second: float = 1.0, burst: float = None):
+		self.per_second = per_second
+		self.burst = burst if burst is not None else max(1.0, per_second)
+		self._tokens = self.burst
+		self._updated = monotonic()
+		self._lock = Lock()
+
+
+	def should_sample(self, span_context) -> bool:
+		with self._lock:
+			now = monotonic()
+			self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.per_second)
+			self._updated = now
+			if self._tokens < 1.0:
+				return False
+			self._tokens -= 1.0
+			return True
+
+
+def sampler_from_environment() -> Union[Sampler, None]:
+	"""Create the sampler chosen by TRACE_SAMPLER.
+
+	- probability : ProbabilitySampler(TRACE_SAMPLE_RATE), default rate 1e-4.
+	- rate_limited : RateLimitedSampler(TRACE_RATE_LIMIT), default 1 per second.
+	- always, never : sample every request or none.
+	- off : do not install tracing at all.
+
+	Returns
+	-------
+	Union[Sampler, None]
+		The sampler, or None for "off".
+
+	Raises
+	------
+	ValueError
+		If TRACE_SAMPLER is not one of SAMPLERS.
+	"""
+	name = os.environ.get("TRACE_SAMPLER", "probability")
+	if name == "probability":
+		return ProbabilitySampler(float(os.environ.get("TRACE_SAMPLE_RATE", 1e-4)))
+	if name == "rate_limited":
+		return RateLimitedSampler(float(os.environ.get("TRACE_RATE_LIMIT", 1)))
+	if name == "always":
+		return AlwaysOnSampler()
+	if name == "never":
+		return AlwaysOffSampler()
+	if name == "off":
+		return None
+	raise ValueError(f"Unknown TRACE_SAMPLER {name!r}; expected one of {SAMPLERS}.")
+
+
+def start_span(name: str):
+	"""Start a child span in the current request's trace, if the request is sampled.
+
+	Unsampled requests, and work outside of a request, pay for one
+	context lookup and nothing else.
+
+	Returns
+	-------
+	Union[opencensus.trace.tracer.Tracer, None]
+		The tracer to pass to end_span(), or None if nothing is traced.
+	"""
+	tracer = execution_context.get_opencensus_tracer()
+	# A finished request leaves its tracer behind but no current span
+	if isinstance(getattr(tracer, "tracer", tracer), NoopTracer) or execution_context.get_current_span() is None:
+		return None
+	tracer.start_span(name)
+	return tracer
+
+
+def end_span(tracer) -> None:
+	"""End the span started by start_span()."""
+	if tracer is not None:
+		tracer.end_span()
+
+
+class TracedTemplate(Template):
+	"""A Jinja template whose rendering is a child span of the request."""
+	def render(self, *args, **kwargs) -> str:
+		tracer = start_span(f"render {self.name or 'template'}")
+		try:
+			return super().render(*args, **kwargs)
+		finally:
+			end_span(tracer)
+
+
+@logme.log
+class BoundedTransport(Transport):
+	"""Exports finished traces on a background thread through a bounded queue.
+
+	opencensus' AsyncTransport queues without limit, so a slow or
+	unreachable exporter makes memory grow with traffic. Here at most
+	``queue_size`` traces wait; later traces are dropped and counted
+	until the exporter catches up.
+
+	Attributes
+	----------
+	exporter : opencensus.trace.base_exporter.Exporter
+		Sends batches of spans, e.g. to Stackdriver.
+	queue_size : int
+		Maximum number of traces waiting to be exported.
+	batch_size : int
+		Maximum number of traces sent in one call to the exporter.
+	wait : float
+		Seconds between exports.
+	"""
+	def __init__(self, exporter, queue_size: int = 1000, batch_size: int = 100, wait: float = 5.0):
+		self.exporter = exporter
+		self.queue_size = queue_size
+		self.batch_size = batch_size
+		self.wait = wait
+		self._queue = Queue(maxsize=queue_size)
+		self._thread = None
+		self._lock = Lock()
+		self._counters = {"exported": 0, "dropped": 0, "failed": 0}
+		atexit.register(self.flush)
+
+
+	@classmethod
+	def factory(cls) -> Callable:
+		"""A transport factory for opencensus exporters, configured by the TRACE_* environment variables."""
+		def create(exporter) -> "BoundedTransport":
+			return cls(
+				exporter,
+				queue_size=int(os.environ.get("TRACE_QUEUE_SIZE", 1000)),
+				batch_size=int(os.environ.get("TRACE_BATCH_SIZE", 100)),
+				wait=float(os.environ.get("TRACE_EXPORT_INTERVAL", 5)),
+			)
+		return create
+
+
+	@property
+	def stats(self) -> dict:
+		"""Spans exported, dropped because the queue was full, and lost to exporter errors."""
+		with self._lock:
+			stats = dict(self._counters)
+		stats.update(queued=self._queue.qsize())
+		return stats
+
+
+	def export(self, span_datas) -> None:
+		"""Queue one trace's spans, or drop them if the queue is full."""
+		self._start()
+		try:
+			self._queue.put_nowait(span_datas)
+		except Full:
+			self._count("dropped", len(span_datas))
+
+
+	def flush(self) -> None:
+		"""Export every queued trace on the calling thread."""
+		batch = self._take()
+		while batch:
+			self._emit(batch)
+			batch = self._take()
+
+
+	def _start(self) -> None:
+		"""Start the export thread on first use, e.g. after the worker has forked."""
+		if self._thread is not None and self._thread.is_alive():
+			return
+		with self._lock:
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = Thread(target=self._work, name="trace-export", daemon=True)
+				self._thread.start()
+
+
+	def _work(self) -> None:
+		# Spans created by the exporter's own requests are not traced
+		execution_context.set_is_exporter(True)
+		while True:
+			# Sending every ``wait`` seconds batches the spans of many requests
+			sleep(self.wait)
+			self.flush()
+
+
+	def _take(self) -> list:
+		"""Remove up to batch_size traces from the queue without waiting."""
+		batch = []
+		try:
+			while len(batch) < self.batch_size:
+				batch.append(self._queue.get_nowait())
+		except Empty:
+			pass
+		return batch
+
+
+	def _emit(self, batch: list) -> None:
+		span_datas = [span_data for trace in batch for span_data in trace]
+		try:
+			self.exporter.emit(span_datas)
+		except Exception as e:
+			self.logger.warning(f"Dropping {len(span_datas)} spans that could not be exported: {e}")
+			self._count("failed", len(span_datas))
+		else:
+			self._count("exported", len(span_datas))
+
+
+	def _count(self, counter: str, amount: int) -> None:
+		with self._lock:
+			self._counters[counter] += amount
@@ -4,40 +4,38 @@
 
 import os
 
-from datetime import datetime, timedelta
-from typing import List, Tuple, Union
+from typing import List, Union
 
-from dateutil.parser import parse
-from twilio.rest import Client
+from engineering_diplomats.decorators import cached
+from engineering_diplomats.metrics import measure
+from engineering_diplomats.services import CalendarIndex, NotificationDispatcher, RSVPWriter, Snapshot
+from engineering_diplomats.settings import get_cache, get_calendar_service
+
+EVENTS_CACHE_TTL = float(os.environ.get("EVENTS_CACHE_TTL", 60))
+
+calendar_index = CalendarIndex(get_calendar_service)
+
+notifications = NotificationDispatcher.from_environment()
 
-from engineering_diplomats.decorators import thread_task
-from engineering_diplomats.settings import service
 
-@thread_task
 def send_text_message(message: str) -> None:
 	"""Send testing text messages.
 	Currently, this is only used to notify me about 
 	periodic tasks.
 	
-	Twilio's Client class automatically reads sid and token from
-	the TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN environment variables.
+	Messages are coalesced and rate limited by the SMS_* environment
+	variables; see NotificationDispatcher.
 	
 	Parameters
 	----------
 	message : str
 		The message to be sent by SMS.
 	"""
-	Client().messages.create(
-		to=os.environ["TWILIO_TARGET"], 
-		from_=os.environ["TWILIO_NUMBER"],
-		body=message,
-	)
+	notifications.notify(message)
 
 
-@thread_task
 def answer_submission(handler: object, request_data: dict) -> None:
-    """Performs answer submission logic on a new thread.
-    Mainly to mitigate how slow SMTP calls are.
+    """Queues the answer email for delivery by the outbox workers.
 
     Parameters
     -----------
@@ -45,28 +43,20 @@ def answer_submission(handler: object, request_data: dict) -> None:
         Active instance of the SiteHandler.
 
     request_data : dict
-        Current list of questions, the submitted question's id, 
+        The answered question's document, the submitted question's id, 
         the submitted answer, and the diplomat's email. 
     """
-    question_id = request_data.get("id")
-    questions = request_data.get("questions")
-    for question in questions:
-        if question_id == question.get("question_id"):
-            question_document = question
-            break
-    
-    answer_data = (
-        request_data.get("answer"),
-        question_document,
-        request_data.get("diplomat"),
+    handler.outbox.enqueue(
+        "answer",
+        answer=request_data.get("answer"),
+        question_document=request_data.get("question"),
+        diplomat=request_data.get("diplomat"),
     )
-    handler.mailer.send_answer(answer_data)
 
 
-@thread_task
 def question_submission(handler: object, question_document: object) -> None:
-    """Performs question submission logic on a new thread.
-    Mainly used to mitigate how slow SMTP exchanges are.
+    """Queues the confirmation and notification emails for a new question.
+    Delivery happens on the outbox workers, off the request path.
 
     Parameters
     ----------
@@ -77,12 +67,17 @@ def question_submission(handler: object, question_document: object) -> None:
         The metadata of the question that was just submitted.
 
     """
-    handler.mailer.send_confirmation(question_document)
-    handler.mailer.send_notification(question_document)
+    handler.outbox.enqueue("confirmation", question_document=question_document)
+    handler.outbox.enqueue("notification", question_document=question_document)
 
 
-def get_events() -> Union[List[List], List[None]]:
-	"""Get all events from my Google Calendar.
+@cached("events", EVENTS_CACHE_TTL)
+@measure("calendar")
+def fetch_events() -> Union[List[List], List[None]]:
+	"""Get all upcoming events from my Google Calendar.
+	Syncs the local calendar index with the Calendar API;
+	views should use get_events(). Results are shared with
+	other workers through the cache for EVENTS_CACHE_TTL seconds.
 
 	Returns
 	-------
@@ -106,31 +101,49 @@ def get_events() -> Union[List[List], List[None]]:
 	------
 	event.attendees denotes that diplomats that have RSVPed for an event
 	"""
-	now = datetime.utcnow().isoformat() + "Z" 
-	events_result = service.events().list(
-		calendarId="primary", 
-		timeMin=now,
-		maxResults=100, 
-		singleEvents=True,
-		orderBy="startTime").execute()
-	all_events = []
-	for event in events_result.get("items", []):
-		start_date, *start_time = parse(event["start"].get("dateTime")).strftime("%m/%d/%Y %I:%M %p").split(" ")
-		start_time = " ".join(start_time)
-		start = f"{start_date} at {start_time}"
-		
-		# Ignore calendar entries that do no have a location
-		if "location" in event: # pragma: allow
-			entry = [event["summary"], start, event["location"], event.get("attendees", None), event.get("id")]
-			if entry[3] is not None: # pragma: allow
-				entry[3] = [e["email"] for e in entry[3]]
-			all_events.append(entry)
-	return all_events
+	calendar_index.sync()
+	return calendar_index.upcoming()
+
+
+events_snapshot = Snapshot(fetch_events, ttl=EVENTS_CACHE_TTL, name="events")
 
 
+def get_events() -> Union[List[List], List[None]]:
+	"""Get all events from the cached calendar snapshot.
+
+	The snapshot is refreshed in the background once it is older
+	than EVENTS_CACHE_TTL seconds (default 60), so only the first
+	request after startup or after an RSVP waits on Google Calendar.
+
+	Returns
+	-------
+	Union[List[List], List[None]]
+		The event entries described in fetch_events().
+	"""
+	return events_snapshot.get()
+
+
+def _rsvp_written(event: dict) -> None:
+	"""Reflect a patched event in the calendar index and snapshot."""
+	calendar_index.apply(event)
+	get_cache().delete("events", fetch_events.cache_key())
+	events_snapshot.invalidate()
+
+
+rsvp_writer = RSVPWriter(
+	get_calendar_service,
+	window=float(os.environ.get("RSVP_WRITE_WINDOW", 0.25)),
+	on_write=_rsvp_written,
+)
+
+
+@measure("calendar")
 def update_event(email: str, event_id: str, unregister: bool) -> str:
 	"""Update the RSVP of an event with a new attendee.
 
+	RSVPs for the same event that arrive within RSVP_WRITE_WINDOW
+	seconds (default 0.25) are written together as one conditional patch.
+
 	Parameters
 	----------
 	email : str
@@ -145,30 +158,9 @@ def update_event(email: str, event_id: str, unregister: bool) -> str:
 	str
 		Result message of the update
 	"""
-	request_body = {
-		"sendUpdates": "none",
-	}
-
-	# Get all attendees
-	all_attendees = service.events().get(
-		calendarId="primary", 
-		eventId=event_id
-		).execute().get("attendees")
-	
-	if all_attendees is None:
-		all_attendees = []
-	else:
-		all_attendees = [a.get("email") for a in all_attendees]
-	
 	if unregister:
-		# Remove the attendee 
-		all_attendees.remove(email)
-		request_body["attendees"] = [{"email": email} for email in all_attendees]
 		flash_message = "You are now unregistered for this event."
 	else:
-		# Add the new attendee
-		all_attendees.append(email)
-		request_body["attendees"] = [{"email": e} for e in all_attendees]
 		flash_message = """
 			You are RSVPed for this event. 
 			If this event is an on-campus information session,
@@ -177,11 +169,7 @@ def update_event(email: str, event_id: str, unregister: bool) -> str:
 			"""
 	
 	try:
-		service.events().patch(
-			calendarId="primary",
-			eventId=event_id,
-			body=request_body,
-		).execute()
+		rsvp_writer.submit(email, event_id, unregister).result(timeout=30)
 		state = "RSVPed" if not unregister else "cancelled"
 		send_text_message(f"{email} has successfully {state} for event {event_id}.")
 		return flash_message
@@ -190,4 +178,3 @@ def update_event(email: str, event_id: str, unregister: bool) -> str:
 		error_message = f"Error: {e}"
 		send_text_message(f"Error: {e}")
 		return error_message
-
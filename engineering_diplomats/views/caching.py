@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Full-page caching for views whose content does not depend on the visitor."""
+
+import json
+import os
+
+from functools import wraps
+from hashlib import sha1
+from typing import Any, Callable
+
+from flask import current_app, make_response, request, session
+
+from engineering_diplomats.assets import load_manifest
+from engineering_diplomats.settings import get_cache
+
+PAGE_CACHE_TTL = float(os.environ.get("PAGE_CACHE_TTL", 300))
+
+_template_versions = {}
+
+
+def template_version() -> str:
+	"""A digest of the application's templates and asset manifest, computed once per process.
+
+	Part of every page's cache key, so that pages rendered by an older
+	deployment are never served by a newer one. The manifest is included
+	because pages link to fingerprinted asset names, which change with
+	the CSS and JavaScript even when the templates do not.
+	"""
+	folder = os.path.join(current_app.root_path, current_app.template_folder or "templates")
+	if folder not in _template_versions:
+		digest = sha1()
+		for root, directories, files in os.walk(folder):
+			directories.sort()
+			for name in sorted(files):
+				path = os.path.join(root, name)
+				digest.update(os.path.relpath(path, folder).encode())
+				with open(path, "rb") as template:
+					digest.update(template.read())
+		digest.update(json.dumps(load_manifest(current_app.static_folder), sort_keys=True).encode())
+		_template_versions[folder] = digest.hexdigest()[:12]
+	return _template_versions[folder]
+
+
+def data_version(value: Any) -> str:
+	"""A short digest of a view's data, for the ``version`` of cached_page()."""
+	return sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def cached_page(ttl: float = PAGE_CACHE_TTL, version: Callable = None) -> Callable:
+	"""Defines a wrapper that serves a view's rendered page from the shared cache.
+
+	Pages are keyed by path, query string, template version and data
+	version, and stored
+	with a strong ETag, so a request carrying a matching If-None-Match is
+	answered with 304 Not Modified without rendering. Visitors with a
+	logged-in session or pending flashed messages see a navbar, footer or
+	message that differs from the cached page, so their requests bypass
+	the cache.
+
+	Parameters
+	----------
+	ttl : float
+		Seconds to cache each page for; PAGE_CACHE_TTL (default 300) by default.
+	version : Callable
+		Called with the view's arguments on every request; returns a value
+		that changes with the page's data, e.g. data_version() of the
+		cached data it is rendered from. A page is then never served once
+		its data has changed or been reloaded. None for pages without data.
+
+	Returns
+	-------
+	Callable
+		A decorator for views that return a rendered template.
+	"""
+	def decorator(f: Callable) -> Callable:
+		@wraps(f)
+		def wrapper(*args, **kwargs):
+			if request.method != "GET" or "user" in session or session.get("_flashes"):
+				return f(*args, **kwargs)
+
+			def render():
+				body = f(*args, **kwargs).encode()
+				return sha1(body).hexdigest(), body
+
+			key = f"{template_version()}:{request.full_path}"
+			if version is not None:
+				key = f"{key}:{version(*args, **kwargs)}"
+			etag, body = get_cache().get_or_set("pages", key, render, ttl)
+			response = make_response(body)
+			response.set_etag(etag)
+			response.headers["Cache-Control"] = "no-cache"
+			return response.make_conditional(request)
+		return wrapper
+	return decorator
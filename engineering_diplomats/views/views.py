@@ -11,29 +11,64 @@ from uuid import uuid4
 import logme
 
 from flask import (
+	Response,
 	abort,
+	current_app,
 	flash,
+	get_flashed_messages,
 	jsonify,
 	redirect, 
 	request, 
 	render_template, 
 	session, 
+	stream_with_context,
 	url_for,
 )
 
-from requests import get as rget
-
+from engineering_diplomats.metrics import CONTENT_TYPE, registry
 from engineering_diplomats.models import (
 	User,
 	QuestionDocument,
 	StudentQueryForm,
 )
 
+from engineering_diplomats.services import Readiness, Snapshot
 from engineering_diplomats.utilities import answer_submission, get_events, question_submission, update_event
+from engineering_diplomats.views.caching import cached_page, data_version
+from engineering_diplomats.workers import task_pool
 
 HTMLBody = TypeVar("HTMLBody", str, str, str)
 
 
+def stream_template(template_name: str, **context) -> Response:
+	"""Render a template progressively instead of into one string.
+
+	The page is sent in pieces as Jinja renders it, so the layout's head
+	reaches the browser before slow context values (a Mongo cursor, the
+	calendar) have been read, and rows are sent as they are rendered.
+
+	Parameters
+	----------
+	template_name : str
+		The template to render.
+	**context
+		The template's variables. Iterables are consumed while rendering.
+
+	Returns
+	-------
+	flask.Response
+		A streamed response.
+	"""
+	app = current_app._get_current_object()
+	app.update_template_context(context)
+	# The session is saved before the body is sent, so pop flashed
+	# messages now; the template then reads them from the request.
+	get_flashed_messages()
+	stream = app.jinja_env.get_template(template_name).stream(context)
+	stream.enable_buffering(int(os.environ.get("STREAM_BUFFER_SIZE", 16)))
+	return Response(stream_with_context(stream))
+
+
 @logme.log
 class SiteHandler(object):
 	"""Views for engineeringdiplomats.org.
@@ -46,17 +81,36 @@ class SiteHandler(object):
 		An instance of an authenticated Outlook OAuth client.
 	mailer : flask.Mail
 		An instance of a configured mailing object.
+	outbox : OutboxWorker
+		Queues emails for delivery off the request path.
+	roster : DiplomatRoster
+		The registered Engineering Diplomats' emails.
+	http : HTTPClient
+		Pooled client for outbound calls to Microsoft Graph and GitHub.
+	build_info : Snapshot
+		Versions reported by /health, refreshed every BUILD_INFO_TTL seconds.
+	readiness : Readiness
+		Cached local checks reported by /readyz.
+	shared_metrics : SharedMetrics
+		Combines the metrics of every worker process, or None to serve this process's alone.
 	callback : str
 		The callback URI expected by Microsoft Outlook's OAuth2 API.
 	"""
-	def __init__(self, db, oauth, mailer):
+	def __init__(self, db, oauth, mailer, outbox, roster, http):
 		self.db = db
 		self.oauth = oauth
 		self.mailer = mailer
+		self.outbox = outbox
+		self.roster = roster
+		self.http = http
 		self.callback = "http://localhost:8080/authorize"
 		self.external = False
+		self.questions_page_size = int(os.environ.get("QUESTIONS_PAGE_SIZE", 25))
 		self.deps_url = os.environ.get("DEPS_URL")
 		self.repo_url = os.environ.get("REPO_URL")
+		self.build_info = Snapshot(self._build_info, float(os.environ.get("BUILD_INFO_TTL", 3600)), name="build_info")
+		self.readiness = Readiness(db, task_pool, ttl=float(os.environ.get("READINESS_TTL", 5)))
+		self.shared_metrics = None
 
 	def get_token(self) -> Union[str, None]: # pragma: no cover
 		"""Called by flask_oauthlib.client to retrieve current access token.
@@ -89,6 +143,7 @@ class SiteHandler(object):
 		return False
 
 
+	@cached_page()
 	def index(self) -> HTMLBody:
 		"""View for home page.
 		
@@ -157,22 +212,27 @@ class SiteHandler(object):
 				"email": request.args.get("email"),
 				"name": request.args.get("name"),	
 			}
+		# Issue a new session id on login so that a planted one cannot be reused
+		if hasattr(session, "regenerate"):
+			session.regenerate()
 		session["access_token"] = response.get("access_token")
 		
 		# Confirm user authentication by calling the Graph API
 		# Create a mock user if running TestSuiteFlask
 		headers = {
+			"Authorization": f"Bearer {session['access_token']}",
 			"client-request-id": str(uuid4()),
 			"return-client-request-id": "true",
 		}
-		graphdata = self.oauth.get("me", headers=headers).data
+		graphdata = self.http.get(f"{self.oauth.base_url}me", headers=headers)
+		graphdata = graphdata.json() if graphdata.ok else {}
 		try:
 			user = User(graphdata.get("displayName"), graphdata.get("mail").lower())
 		except AttributeError:
 			user = User(response.get("name"), response.get("email"))
 
 		# Check if the user that is logging in is an Engineering Diplomat
-		if user.email in self.db.get_diplomats():
+		if user.email in self.roster:
 			user.is_diplomat = "True" # TODO: bool condition test
 		
 		# Define the rest of the session user
@@ -208,6 +268,8 @@ class SiteHandler(object):
 				If an Engineering Diplomat has submitted an answer.
 			HTMLBody
 				If the user is attempting to access questions page.
+			abort
+				A 404 status code if the question was already answered.
 
 		Notes
 		------
@@ -215,21 +277,31 @@ class SiteHandler(object):
 		"""
 		if self.is_authorized:
 			if session.get("user").get("is_diplomat") == "True":
-				questions = self.db.get_questions()
 				if request.method == "GET":
-					return render_template("questions.jinja2", questions=questions)
+					try:
+						page = self.db.stream_questions_page(request.args.get("after"), self.questions_page_size)
+					except ValueError:
+						abort(400)
+					return stream_template("questions.jinja2", page=page, is_first_page="after" not in request.args)
 				if request.method == "POST":
 					question_id = request.form.get("id")
+					question_document = self.db.pop_question(question_id)
+					if question_document is None:
+						self.logger.info(f"Question {question_id} was already answered.")
+						abort(404)
 					request_data = {
-						"questions": questions,
+						"question": question_document,
 						"id": question_id,
 						"answer": request.form.get("answer"),
 						"diplomat": session.get("user").get("email"),
 					}
-					answer_submission(self, request_data)
-					self.logger.info(f"Sent answer to question {question_id}.")
-					self.db.remove_question(question_id)
-					self.logger.info(f"Removed question with id {question_id}.")
+					try:
+						answer_submission(self, request_data)
+					except Exception:
+						# Put the question back so that it can be answered again
+						self.db.insert_question(question_document)
+						raise
+					self.logger.info(f"Queued answer and removed question {question_id}.")
 					flash("Your answer has been submitted. Thanks!")
 					return redirect(url_for("questions", _external=self.external))
 			flash("Only Engineering Diplomats may answer questions.")
@@ -271,7 +343,7 @@ class SiteHandler(object):
 				)
 				self.db.insert_question(question_document)
 				
-				# Send a notification email to both the student and the President
+				# Queue a notification email to both the student and the President
 				question_submission(self, question_document)
 
 				# Flash and log a success message
@@ -320,14 +392,20 @@ class SiteHandler(object):
 						False,
 					)
 			flash(flash_message)
-		return render_template("events.jinja2", events=get_events())
+
+		def events():
+			# Fetched while streaming, after the page's head has been sent
+			yield from get_events()
+		return stream_template("events.jinja2", events=events())
 
 
+	@cached_page()
 	def resources(self) -> HTMLBody:
 		"""View for resources page."""
 		return render_template("resources.jinja2")
 
 
+	@cached_page(version=lambda self: data_version(self.db.get_fundraisers()))
 	def fundraisers(self) -> HTMLBody:
 		"""View for fundraisers page."""
 		return render_template("fundraisers.jinja2", fundraisers=self.db.get_fundraisers())
@@ -350,12 +428,44 @@ class SiteHandler(object):
 
 
 	def health(self) -> dict:
-		deps = rget(self.deps_url).json()
-		return jsonify(
-			head=rget(self.repo_url).json()["sha"][:6],
-			python=deps["_meta"]["requires"]["python_version"],
-			flask=deps["default"]["flask"]["version"],
-			gevent=deps["default"]["gevent"]["version"],
-			pymongo=deps["default"]["pymongo"]["version"],
-			requests=deps["default"]["requests"]["version"],
-		)
+		"""Build metadata: the deployed commit and dependency versions.
+
+		Served from the build_info snapshot, so GitHub is only
+		contacted when the snapshot is refreshed in the background.
+		"""
+		return jsonify(**self.build_info.get())
+
+
+	def livez(self) -> dict:
+		"""Liveness probe. Answering at all means the worker is serving requests."""
+		return jsonify(status="ok")
+
+
+	def readyz(self) -> tuple:
+		"""Readiness probe backed by the cached local checks.
+
+		Returns
+		-------
+		tuple
+			The result of each check, with status 200 if all passed, otherwise 503.
+		"""
+		ready, checks = self.readiness.check()
+		return jsonify(status="ok" if ready else "unavailable", **checks), 200 if ready else 503
+
+
+	def metrics(self) -> Response:
+		"""Request, dependency, cache and worker pool metrics for Prometheus."""
+		source = self.shared_metrics if self.shared_metrics is not None else registry
+		return Response(source.render(), content_type=CONTENT_TYPE)
+
+
+	def _build_info(self) -> dict:
+		deps = self.http.get(self.deps_url).json()
+		return {
+			"head": self.http.get(self.repo_url).json()["sha"][:6],
+			"python": deps["_meta"]["requires"]["python_version"],
+			"flask": deps["default"]["flask"]["version"],
+			"gevent": deps["default"]["gevent"]["version"],
+			"pymongo": deps["default"]["pymongo"]["version"],
+			"requests": deps["default"]["requests"]["version"],
+		}
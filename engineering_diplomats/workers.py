@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""A shared, bounded pool of worker threads for background tasks."""
+
+import atexit
+import os
+import signal
+
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable
+
+import logme
+
+OVERFLOW_POLICIES = ("block", "caller_runs", "reject")
+
+
+@logme.log
+class WorkerPool(object):
+	"""Runs submitted callables on a fixed number of daemon threads.
+
+	Tasks wait in a bounded queue. When the queue is full, the overflow
+	policy decides what happens to a new task:
+
+	- block : wait up to ``block_timeout`` seconds for room, then reject.
+	- caller_runs : run the task on the submitting thread (backpressure).
+	- reject : drop the task and count it as rejected.
+
+	Threads are started on the first submission rather than at import,
+	and are recreated in a forked child process.
+
+	Attributes
+	----------
+	workers : int
+		Number of worker threads.
+	queue_size : int
+		Maximum number of tasks waiting to run.
+	overflow : str
+		One of OVERFLOW_POLICIES.
+	name : str
+		Prefix for worker thread names.
+	"""
+	def __init__(self, workers: int = 4, queue_size: int = 100, overflow: str = "caller_runs",
+		block_timeout: float = 5.0, name: str = "worker"):
+		if overflow not in OVERFLOW_POLICIES:
+			raise ValueError(f"Unknown overflow policy {overflow!r}; expected one of {OVERFLOW_POLICIES}.")
+		self.workers = workers
+		self.queue_size = queue_size
+		self.overflow = overflow
+		self.block_timeout = block_timeout
+		self.name = name
+		self._reset()
+		if hasattr(os, "register_at_fork"):
+			os.register_at_fork(after_in_child=self._reset)
+
+
+	def _reset(self) -> None:
+		"""Forget all threads and queued work, e.g. in a freshly forked child."""
+		self._queue = Queue(maxsize=self.queue_size)
+		self._threads = []
+		self._accepting = True
+		self._lock = Lock()
+		self._counters = {
+			"submitted": 0,
+			"completed": 0,
+			"failed": 0,
+			"rejected": 0,
+			"caller_ran": 0,
+			"wait_seconds_total": 0.0,
+			"run_seconds_total": 0.0,
+			"run_seconds_max": 0.0,
+		}
+
+
+	@property
+	def stats(self) -> dict:
+		"""Queue depth, task counters and latency totals.
+
+		Returns
+		-------
+		dict
+			Snapshot of the pool's counters.
+		"""
+		with self._lock:
+			stats = dict(self._counters)
+		stats.update(queued=self._queue.qsize(), workers=len(self._threads), queue_size=self.queue_size)
+		return stats
+
+
+	def submit(self, f: Callable, *args, **kwargs) -> bool:
+		"""Schedule ``f(*args, **kwargs)`` to run on a worker thread.
+
+		Returns
+		-------
+		bool
+			True if the task was queued or ran on the caller,
+			False if it was rejected.
+		"""
+		if not self._accepting:
+			self.logger.warning(f"Pool {self.name} is draining; running {f.__name__} on the caller.")
+			self._run(f, args, kwargs, monotonic())
+			return True
+		self._start()
+		task = (f, args, kwargs, monotonic())
+		try:
+			if self.overflow == "block":
+				self._queue.put(task, timeout=self.block_timeout)
+			else:
+				self._queue.put_nowait(task)
+		except Full:
+			if self.overflow == "caller_runs":
+				self._count("caller_ran")
+				self._run(*task)
+				return True
+			self._count("rejected")
+			self.logger.error(f"Pool {self.name} is full; rejected {f.__name__}.")
+			return False
+		self._count("submitted")
+		return True
+
+
+	def join(self) -> None:
+		"""Block until every queued task has run."""
+		self._queue.join()
+
+
+	def drain(self, timeout: float = 30.0) -> bool:
+		"""Stop accepting work and wait for queued tasks to finish.
+
+		Parameters
+		----------
+		timeout : float
+			Maximum number of seconds to wait for all workers.
+
+		Returns
+		-------
+		bool
+			True if every worker finished within the timeout.
+		"""
+		if not self._accepting and not any(thread.is_alive() for thread in self._threads):
+			return True
+		self._accepting = False
+		deadline = monotonic() + timeout
+		for _ in self._threads:
+			try:
+				# A full queue must not hold up the deadline; the workers are daemons
+				self._queue.put(None, timeout=max(0.0, deadline - monotonic()))
+			except Full:
+				break
+		for thread in self._threads:
+			thread.join(max(0.0, deadline - monotonic()))
+		drained = not any(thread.is_alive() for thread in self._threads)
+		self.logger.info(f"Pool {self.name} drained: {drained}; {self.stats}")
+		return drained
+
+
+	def _start(self) -> None:
+		"""Start the worker threads on first use."""
+		if len(self._threads) == self.workers:
+			return
+		with self._lock:
+			while len(self._threads) < self.workers:
+				thread = Thread(target=self._work, name=f"{self.name}-{len(self._threads)}")
+				thread.daemon = True
+				thread.start()
+				self._threads.append(thread)
+
+
+	def _work(self) -> None:
+		"""Worker loop: run tasks until a None sentinel is received."""
+		while True:
+			task = self._queue.get()
+			try:
+				if task is None:
+					return
+				self._run(*task)
+			finally:
+				self._queue.task_done()
+
+
+	def _run(self, f: Callable, args: tuple, kwargs: dict, queued_at: float) -> None:
+		"""Run one task and record its latency and outcome."""
+		started = monotonic()
+		try:
+			f(*args, **kwargs)
+		except Exception as e:
+			self._count("failed")
+			self.logger.exception(e)
+		else:
+			self._count("completed")
+		finally:
+			elapsed = monotonic() - started
+			with self._lock:
+				self._counters["wait_seconds_total"] += started - queued_at
+				self._counters["run_seconds_total"] += elapsed
+				self._counters["run_seconds_max"] = max(self._counters["run_seconds_max"], elapsed)
+
+
+	def _count(self, counter: str) -> None:
+		with self._lock:
+			self._counters[counter] += 1
+
+
+task_pool = WorkerPool(
+	workers=int(os.environ.get("WORKER_THREADS", 4)),
+	queue_size=int(os.environ.get("WORKER_QUEUE_SIZE", 100)),
+	overflow=os.environ.get("WORKER_OVERFLOW", "caller_runs"),
+	name="task",
+)
+
+
+def install_signal_handlers() -> None:
+	"""Exit through SystemExit on SIGTERM, so that the shared pool is drained on the way out.
+
+	Kubernetes sends SIGTERM and waits terminationGracePeriodSeconds
+	(30 by default) before killing the pod. The handler only raises
+	SystemExit; the pool is drained by the code that catches it, e.g.
+	production.wsgi's serve(), or at exit, for up to WORKER_DRAIN_TIMEOUT
+	(default 25) seconds. Draining in the handler itself would wait on
+	the workers from whichever greenlet the signal interrupted. Must be
+	called from the main thread.
+	"""
+	def handle_sigterm(signum, frame):
+		raise SystemExit(0)
+
+	signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+@atexit.register
+def _drain_at_exit() -> None:
+	"""Give unfinished tasks up to WORKER_DRAIN_TIMEOUT seconds to complete on exit."""
+	if task_pool._accepting and task_pool._queue.unfinished_tasks:
+		task_pool.drain(float(os.environ.get("WORKER_DRAIN_TIMEOUT", 25)))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""Concurrent-request throughput of the gevent server with and without monkey patching.
+
+The server under test runs production.wsgi's setup (a gevent WSGIServer with a
+greenlet Pool) in front of a view that makes one blocking HTTP call to a slow
+local upstream, standing in for Google Calendar, Graph or MongoDB. The load
+generator then fires concurrent requests at it. Run it with:
+
+	python production/benchmark.py --requests 200 --concurrency 50 --delay 0.1
+
+See docs/benchmarks.md for results.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+UPSTREAM_PORT = 8181
+SERVER_PORT = 8182
+
+
+def upstream(delay: float) -> None:
+	"""Serve a fixed response after ``delay`` seconds, concurrently."""
+	from gevent import monkey
+	monkey.patch_all()
+	from gevent.pywsgi import WSGIServer
+
+	def application(environ, start_response):
+		time.sleep(delay)
+		start_response("200 OK", [("Content-Type", "application/json")])
+		return [b'{"items": []}']
+
+	WSGIServer(("127.0.0.1", UPSTREAM_PORT), application, log=None).serve_forever()
+
+
+def server(patch: bool, pool_size: int) -> None:
+	"""Serve a view that calls the upstream once per request."""
+	if patch:
+		from gevent import monkey
+		monkey.patch_all()
+	from gevent.pool import Pool
+	from gevent.pywsgi import WSGIServer
+
+	def application(environ, start_response):
+		body = urlopen(f"http://127.0.0.1:{UPSTREAM_PORT}/").read()
+		start_response("200 OK", [("Content-Type", "application/json")])
+		return [body]
+
+	WSGIServer(("127.0.0.1", SERVER_PORT), application, spawn=Pool(pool_size), log=None).serve_forever()
+
+
+def wait_for(port: int, timeout: float = 10.0) -> None:
+	"""Block until something accepts HTTP requests on ``port``."""
+	deadline = time.monotonic() + timeout
+	while True:
+		try:
+			urlopen(f"http://127.0.0.1:{port}/", timeout=5).read()
+			return
+		except OSError:
+			if time.monotonic() > deadline:
+				raise
+			time.sleep(0.1)
+
+
+def load(requests: int, concurrency: int) -> dict:
+	"""Send ``requests`` requests from ``concurrency`` client threads."""
+	def fetch(_):
+		started = time.monotonic()
+		urlopen(f"http://127.0.0.1:{SERVER_PORT}/", timeout=120).read()
+		return time.monotonic() - started
+
+	started = time.monotonic()
+	with ThreadPoolExecutor(concurrency) as executor:
+		latencies = sorted(executor.map(fetch, range(requests)))
+	elapsed = time.monotonic() - started
+	return {
+		"throughput": requests / elapsed,
+		"p50": latencies[len(latencies) // 2],
+		"p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+	}
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--requests", type=int, default=200)
+	parser.add_argument("--concurrency", type=int, default=50)
+	parser.add_argument("--delay", type=float, default=0.1, help="Upstream latency in seconds.")
+	parser.add_argument("--pool-size", type=int, default=256)
+	parser.add_argument("--role", choices=("upstream", "patched", "unpatched"), help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.role == "upstream":
+		return upstream(args.delay)
+	if args.role is not None:
+		return server(args.role == "patched", args.pool_size)
+
+	here = os.path.abspath(__file__)
+	common = ["--delay", str(args.delay), "--pool-size", str(args.pool_size)]
+	upstream_process = subprocess.Popen([sys.executable, here, "--role", "upstream"] + common)
+	try:
+		wait_for(UPSTREAM_PORT)
+		print(f"{args.requests} requests, {args.concurrency} concurrent, {args.delay}s upstream latency")
+		for role in ("unpatched", "patched"):
+			server_process = subprocess.Popen([sys.executable, here, "--role", role] + common)
+			try:
+				wait_for(SERVER_PORT)
+				result = load(args.requests, args.concurrency)
+			finally:
+				server_process.terminate()
+				server_process.wait()
+			print(f"{role:>9}: {result['throughput']:8.1f} req/s  p50 {result['p50'] * 1000:7.1f} ms  p99 {result['p99'] * 1000:7.1f} ms")
+	finally:
+		upstream_process.terminate()
+		upstream_process.wait()
+
+
+if __name__ == "__main__":
+	main()
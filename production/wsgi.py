@@ -1,19 +1,133 @@
 # -*- coding: utf-8 -*-
 
+# Patch the standard library before anything else imports socket, ssl, threading
+# or time, so that pymongo, smtplib, httplib2, requests and twilio yield to other
+# greenlets while they wait on the network instead of blocking the whole server.
+from gevent import monkey
+monkey.patch_all()
+
+import atexit
 import os
+import random
+import signal
+import socket
 import sys
+import time
+
+from typing import Tuple
 
+import gevent
 import logme
 
+from gevent import Timeout
+from gevent.pool import Pool
 from gevent.pywsgi import WSGIServer
 
-from engineering_diplomats.main import init_app
+from engineering_diplomats.compression import Compress
+from engineering_diplomats.logging_pipeline import install_logging
+from engineering_diplomats.workers import install_signal_handlers, task_pool
+
+
+class RequestTimeout(object):
+	"""WSGI middleware that answers 504 when a request runs too long.
+
+	Under gevent one slow dependency call only blocks its own greenlet,
+	but without a deadline a hung call would hold a pool slot forever.
+
+	Attributes
+	----------
+	app : Callable
+		The wrapped WSGI application.
+	seconds : float
+		The deadline for producing a response.
+	"""
+	def __init__(self, app, seconds: float):
+		self.app = app
+		self.seconds = seconds
+
+
+	def __call__(self, environ, start_response):
+		timeout = Timeout(self.seconds)
+		timeout.start()
+		try:
+			return self.app(environ, start_response)
+		except Timeout as e:
+			if e is not timeout:
+				raise
+			start_response("504 Gateway Timeout", [("Content-Type", "text/plain")], sys.exc_info())
+			return [b"The request timed out."]
+		finally:
+			timeout.close()
+
+
+class MaxRequests(object):
+	"""WSGI middleware that stops a worker after it has served ``limit`` requests.
+
+	Rolling workers over bounds the damage of slow memory leaks; the
+	supervisor starts a fresh worker in its place.
+
+	Attributes
+	----------
+	app : Callable
+		The wrapped WSGI application.
+	limit : int
+		Number of requests to serve before stopping, 0 for no limit.
+	server : gevent.pywsgi.WSGIServer
+		The server to stop once the limit is reached.
+	"""
+	def __init__(self, app, limit: int):
+		self.app = app
+		self.limit = limit
+		self.server = None
+		self.served = 0
+
+
+	def __call__(self, environ, start_response):
+		self.served += 1
+		if self.served == self.limit and self.server is not None:
+			gevent.spawn(self.server.stop, timeout=float(os.environ.get("WORKER_STOP_TIMEOUT", 10)))
+		return self.app(environ, start_response)
+
+
+def listen(address: Tuple[str, int], reuse_port: bool = False) -> socket.socket:
+	"""Create the listening socket shared by the workers.
+
+	Parameters
+	----------
+	address : Tuple[str, int]
+		The host and port to bind.
+	reuse_port : bool
+		Set SO_REUSEPORT so that each worker can bind its own socket
+		and let the kernel balance connections between them.
+	"""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reuse_port:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind(address)
+	sock.listen(int(os.environ.get("LISTEN_BACKLOG", 1024)))
+	return sock
 
 
 @logme.log
-def main(logger=None) -> None:
-	"""Main routine to initialize and start the production environment."""
-	
+def serve(listener: socket.socket, logger=None) -> None:
+	"""Initialize the application and serve requests until stopped.
+
+	Runs in each worker after the fork, so that every process opens its
+	own MongoDB, memcached and SMTP connections.
+
+	Each request runs in its own greenlet. GEVENT_POOL_SIZE (default 256)
+	caps the number of concurrent requests, REQUEST_TIMEOUT (default 30)
+	is the per-request deadline in seconds and MAX_REQUESTS (default 0,
+	no limit) plus up to MAX_REQUESTS_JITTER rolls the worker over.
+
+	When the worker rolls over or receives SIGTERM, requests in flight
+	get WORKER_STOP_TIMEOUT (default 10) seconds to finish, and then the
+	background tasks get the rest of WORKER_DRAIN_TIMEOUT (default 25).
+	"""
+	from engineering_diplomats.main import init_app
+	from engineering_diplomats.utilities import notifications
+
 	app = init_app()
 	os.environ["FLASK_ENV"] = "production"
 	os.environ["DEBUG"] = "0"
@@ -23,12 +137,125 @@ def main(logger=None) -> None:
 	app.site_handler.external = True
 	logger.info(f"OAuth2 callback defined as: {app.site_handler.callback}")
 	logger.info(f"Redirect external set to: {app.site_handler.external}")
+	pool_size = int(os.environ.get("GEVENT_POOL_SIZE", 256))
+	request_timeout = float(os.environ.get("REQUEST_TIMEOUT", 30))
+	max_requests = int(os.environ.get("MAX_REQUESTS", 0))
+	if max_requests:
+		max_requests += random.randint(0, int(os.environ.get("MAX_REQUESTS_JITTER", 0)))
+	logger.info(f"Serving with {pool_size} greenlets and a {request_timeout}s request timeout.")
+	application = MaxRequests(RequestTimeout(Compress.from_environment(app), request_timeout), max_requests)
+	install_signal_handlers()
+	application.server = WSGIServer(
+		listener=listener,
+		application=application,
+		spawn=Pool(pool_size),
+		log=logger,
+	)
+	stop_timeout = float(os.environ.get("WORKER_STOP_TIMEOUT", 10))
+	try:
+		# On SIGTERM's SystemExit too, this stops accepting and waits for requests in flight
+		application.server.serve_forever(stop_timeout=stop_timeout)
+	finally:
+		task_pool.drain(max(0.0, float(os.environ.get("WORKER_DRAIN_TIMEOUT", 25)) - stop_timeout))
+		# Send the notifications still waiting for their window or the rate limit
+		notifications.close()
+		logger.info(f"Worker {os.getpid()} stopped after {application.served} requests.")
+
+
+@logme.log
+def supervise(workers: int, address: Tuple[str, int], reuse_port: bool, logger=None) -> None:
+	"""Fork ``workers`` processes that serve ``address`` and replace any that exit.
+
+	Parameters
+	----------
+	workers : int
+		Number of worker processes, usually the number of cores in the pod.
+	address : Tuple[str, int]
+		The host and port to serve.
+	reuse_port : bool
+		True to have each worker bind its own SO_REUSEPORT socket,
+		False to have them inherit one socket bound by the supervisor.
+		With SO_REUSEPORT, connections that the kernel already queued
+		on a worker's socket are reset when that worker rolls over,
+		so the inherited socket is the default.
+	"""
+	shared = None if reuse_port else listen(address)
+	children = {}
+	stopping = False
+
+	def spawn(slot: int) -> None:
+		# The child's log file is named after its slot, which outlives its pid
+		os.environ["WORKER_ID"] = str(slot)
+		pid = os.fork()
+		if pid == 0:
+			# The supervisor's handler would forward SIGTERM to the worker's siblings
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			signal.signal(signal.SIGINT, signal.default_int_handler)
+			children.clear()
+			code = 0
+			try:
+				serve(shared if shared is not None else listen(address, reuse_port=True))
+			except BaseException as e:
+				code = getattr(e, "code", 1) if isinstance(e, SystemExit) else 1
+				if code:
+					logger.exception(e)
+			finally:
+				# os._exit() skips atexit, which flushes traces, pending texts, SMTP connections and logs
+				atexit._run_exitfuncs()
+				os._exit(code or 0)
+		children[pid] = (slot, time.monotonic())
+		logger.info(f"Started worker {slot} with pid {pid}.")
+
+	def handle_sigterm(signum, frame):
+		nonlocal stopping
+		stopping = True
+		for pid in list(children):
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+	signal.signal(signal.SIGTERM, handle_sigterm)
+	signal.signal(signal.SIGINT, handle_sigterm)
+	for slot in range(workers):
+		spawn(slot)
+
+	while children:
+		try:
+			pid, status = os.waitpid(-1, 0)
+		except ChildProcessError:
+			break
+		except InterruptedError:
+			continue
+		slot, started = children.pop(pid, (None, None))
+		if slot is None:
+			continue
+		logger.info(f"Worker {slot} (pid {pid}) exited with status {status}.")
+		if stopping:
+			continue
+		# Avoid a tight crash loop if workers die right after starting
+		if time.monotonic() - started < 1.0:
+			time.sleep(1.0)
+		spawn(slot)
+
+
+@logme.log
+def main(logger=None) -> None:
+	"""Main routine to initialize and start the production environment.
+
+	WEB_CONCURRENCY (default 1) sets the number of worker processes. With
+	more than one, a supervisor forks the workers and restarts any that
+	exit; REUSE_PORT=1 makes each worker bind its own SO_REUSEPORT socket
+	instead of inheriting the supervisor's.
+	"""
+	install_logging()
+	address = ("0.0.0.0", 8080)
+	workers = int(os.environ.get("WEB_CONCURRENCY", 1))
 	try:
-		WSGIServer(
-			listener=("0.0.0.0", 8080), 
-			application=app,  
-			log=logger,
-		).serve_forever()
+		if workers > 1:
+			supervise(workers, address, reuse_port=bool(int(os.environ.get("REUSE_PORT", 0))))
+		else:
+			serve(listen(address))
 	# Don't need to do much on exception as recovery is handled by Kubernetes scheduler
 	except OSError as e:
 		logger.exception(e)
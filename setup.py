@@ -9,5 +9,6 @@ setup(
 	description="engineeringdiplomats.org",
 	packages=find_packages(),
 	include_package_data=True,
+	package_data={"engineering_diplomats": ["discovery/*.json"]},
 	zip_safe=False,
 )
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import logging
+import smtplib
+import threading
+
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from time import sleep
 from uuid import uuid4
 
@@ -9,8 +14,13 @@ import pytest
 from bson.objectid import ObjectId
 from flask_mail import Mail
 
-from engineering_diplomats.controllers import Mailer, MemcachedConnector, MongoConnector
+from engineering_diplomats.controllers import HTTPClient, HttpPool, Mailer, MemcachedConnector, MongoConnector, SMTPPool
+from engineering_diplomats.controllers.cache import LRUCache
+from engineering_diplomats.controllers.db import QuestionPage
+from engineering_diplomats.metrics import dependency_seconds
 from engineering_diplomats.models import QuestionDocument
+from engineering_diplomats.services import DiplomatRoster
+from engineering_diplomats.settings import EMAIL_LOGGER
 
 
 class TestSuiteControllers(object):
@@ -28,6 +38,11 @@ class TestSuiteControllers(object):
 		# Find my email in the list of Diplomats' emails
 		assert "simon.woldemichael@ttu.edu" in mongo_connector.get_diplomats()
 
+		# The in-memory roster answers membership without a query per check
+		roster = DiplomatRoster(mongo_connector)
+		assert "Simon.Woldemichael@ttu.edu" in roster
+		assert "not.a.diplomat@ttu.edu" not in roster
+
 		# Create a new question
 		question_document = QuestionDocument(
 			question_id=uuid4().hex,
@@ -40,20 +55,58 @@ class TestSuiteControllers(object):
 		# Insert question into database
 		assert type(mongo_connector.insert_question(question_document)) is ObjectId
 
-		# Make sure recently inserted question exists when get call is made
-		found = False
-		for document in mongo_connector.get_questions():
-			if document["question_id"] == question_document["question_id"]:
-				found = True
+		# A streamed page holds the same questions and cursor as a listed one
+		page = mongo_connector.stream_questions_page(limit=2)
+		streamed = [q["question_id"] for q in page]
+		questions, after = mongo_connector.get_questions_page(limit=2)
+		assert streamed == [q["question_id"] for q in questions]
+		assert page.next_page == after
+
+		# Walk the paginated listing until the new question shows up
+		found, after = False, None
+		while not found:
+			questions, after = mongo_connector.get_questions_page(after, limit=2)
+			assert len(questions) <= 2
+			found = any(q["question_id"] == question_document["question_id"] for q in questions)
+			if after is None:
+				break
 		assert found
+		assert mongo_connector.get_question(question_document["question_id"])["question"] == "How do I study abroad?"
 
-		# Delete the question that was just added
-		assert mongo_connector.remove_question(question_document["question_id"])
+		# Answering removes the question exactly once
+		assert mongo_connector.pop_question(question_document["question_id"])["question"] == "How do I study abroad?"
+		assert mongo_connector.pop_question(question_document["question_id"]) is None
 
 		# Get points for a Diplomat
 		assert mongo_connector.get_points(question_document["submitters_email"])
 
 
+	def test_outbox(self, app):
+		"""Test leasing, retrying and completing outbox emails.
+		
+		Parameters
+		----------
+		app : flask.Flask
+			Instance of the application injected by pytest.
+		"""
+		mongo_connector = MongoConnector(app)
+		# Keep the application's delivery workers away from the test documents
+		mongo_connector.outbox_collection = mongo_connector.client.diplomats.outbox_test
+		owner = uuid4().hex
+
+		assert type(mongo_connector.enqueue_email("confirmation", {"question": "test"})) is ObjectId
+		document = mongo_connector.lease_email(owner, lease_seconds=60)
+		assert document["status"] == "leased" and document["attempts"] == 1
+		assert mongo_connector.lease_email(uuid4().hex, lease_seconds=60) is None
+
+		# A failed email is released for a later attempt
+		mongo_connector.retry_email(document, "error", delay=0)
+		document = mongo_connector.lease_email(owner, lease_seconds=60)
+		assert document["attempts"] == 2 and document["last_error"] == "error"
+		assert mongo_connector.complete_email(document)
+		mongo_connector.outbox_collection.drop()
+
+
 	def test_mailer(self, app):
 		"""Test mailing controller.
 
@@ -88,9 +141,175 @@ class TestSuiteControllers(object):
 		)
 		assert mailer.send_answer(answer_data) is None
 
+		# Send both question emails over a single pooled connection
+		records = []
+		handler = logging.Handler()
+		handler.emit = records.append
+		logging.getLogger(EMAIL_LOGGER).addHandler(handler)
+		messages = [mailer.build_confirmation(question_document), mailer.build_notification(question_document)]
+		try:
+			assert mailer.send_batch(messages) is None
+		finally:
+			logging.getLogger(EMAIL_LOGGER).removeHandler(handler)
+
+		# Each message is recorded in the email delivery log
+		assert [record.message_id for record in records] == [message.msgId for message in messages]
+		assert records[0].recipients == ["simon.woldemichael@ttu.edu"]
+		assert all(record.error is None for record in records)
+
+
+	def test_question_page(self):
+		"""A page stops one question short of the next page and times
+		only its reads from Mongo, within the page's deadline."""
+		questions = [{"_id": ObjectId(), "submission_date": datetime(2020, 1, day)} for day in (1, 2, 3)]
+		class Cursor(object):
+			def __init__(self, *args):
+				self.questions = iter(questions)
+			def __next__(self):
+				return next(self.questions)
+			def sort(self, *args):
+				return self
+			limit = batch_size = sort
+			def __enter__(self):
+				return self
+			def __exit__(self, *args):
+				pass
+
+		class Connector(object):
+			questions_collection = type("Collection", (), {"find": Cursor})()
+			encode_cursor = staticmethod(MongoConnector.encode_cursor)
+
+		timed = dependency_seconds.labels("mongo", "questions_page", "ok")
+		observed = sum(timed.counts)
+		page = QuestionPage(Connector(), {}, limit=2, timeout=5)
+		assert list(page) == questions[:2]
+		assert page.next_page == MongoConnector.encode_cursor(questions[1])
+		assert sum(timed.counts) == observed + 1
+
+
+	def test_smtp_pool(self):
+		"""A connection that raised mid-transaction is closed, not returned to the pool."""
+		closed = []
+		class Connection(object):
+			host = None
+			def __exit__(self, *args):
+				closed.append(self)
+
+		pool = SMTPPool(None, size=1)
+		pool._open = Connection
+		with pool.connection() as connection:
+			pass
+		with pytest.raises(smtplib.SMTPRecipientsRefused):
+			with pool.connection() as reused:
+				raise smtplib.SMTPRecipientsRefused({})
+		assert reused is connection
+		assert closed == [connection]
+		assert pool._idle.empty()
+
 
 	def test_cache(self):
 		"""Test the memecached client."""
 		cache_client = MemcachedConnector().client
 		cache_client.set("key", "hello")
 		assert cache_client.get("key") == "hello"
+
+		cache = MemcachedConnector()
+		namespace = f"test-{uuid4().hex}"
+		assert cache.set(namespace, "small", {"points": 1}, ttl=60)
+		assert cache.set(namespace, "large", ["x" * 64] * 64, ttl=60)
+		cache.local.clear()
+		assert cache.get_multi(namespace, ["small", "large", "missing"]) == {
+			"small": {"points": 1},
+			"large": ["x" * 64] * 64,
+		}
+		assert cache.get(namespace, "small") == {"points": 1}
+		assert cache.stats["l2_hits"] == 2
+		assert cache.stats["l1_hits"] == 1
+
+		# Concurrent misses on one key compute it once, with or without the in-process tier
+		calls = []
+		def compute():
+			calls.append(1)
+			sleep(0.1)
+			return "computed"
+		for key in ("flight", "remote-flight"):
+			threads = [
+				threading.Thread(target=cache.get_or_set, args=(namespace, key, compute, 60))
+				for _ in range(5)
+			]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			cache.local = LRUCache(0)
+		assert len(calls) == 2
+		cache.delete(namespace, "flight")
+		assert cache.get(namespace, "flight") is None
+
+
+	def test_http_pool(self):
+		"""Concurrent requests never share an Http, never exceed
+		the pool size, and reuse Http objects once they are idle."""
+		created, in_flight, peak = [], [], []
+		lock = threading.Lock()
+
+		class FakeHttp(object):
+			def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+				with lock:
+					assert self not in in_flight
+					in_flight.append(self)
+					peak.append(len(in_flight))
+				sleep(0.05)
+				with lock:
+					in_flight.remove(self)
+				return {"status": "200"}, b"{}"
+
+			def close(self):
+				pass
+
+		def factory():
+			created.append(FakeHttp())
+			return created[-1]
+
+		pool = HttpPool(factory, size=3)
+		threads = [threading.Thread(target=pool.request, args=("https://www.googleapis.com/",)) for _ in range(12)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		assert max(peak) <= 3
+		assert len(created) <= 3
+		pool.close()
+
+
+	def test_http_client(self):
+		"""Transient 503s are retried on a kept-alive connection
+		and every attempt is counted in the host's stats."""
+		statuses = [503, 200]
+		ports = set()
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def do_GET(self):
+				ports.add(self.client_address[1])
+				self.send_response(statuses.pop(0))
+				self.send_header("Content-Length", "2")
+				self.end_headers()
+				self.wfile.write(b"{}")
+
+			def log_message(self, *args):
+				pass
+
+		server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		host = f"127.0.0.1:{server.server_port}"
+		client = HTTPClient(retries=1, backoff=0.01)
+		try:
+			assert client.get(f"http://{host}/").json() == {}
+			assert client.stats[host]["requests"] == 2
+			assert client.stats[host]["errors"] == 1
+			assert len(ports) == 1
+		finally:
+			client.close()
+			server.shutdown()
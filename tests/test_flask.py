@@ -13,6 +13,7 @@ from engineering_diplomats.controllers import MongoConnector
 OK = 200
 NOT_FOUND = 404
 REDIRECT = 302 # "FOUND"
+NOT_MODIFIED = 304
 
 
 class TestSuiteFlask(object):
@@ -41,6 +42,8 @@ class TestSuiteFlask(object):
 		"""
 		assert client.get(url_for("index")).status_code == OK
 		assert client.get(url_for("resources")).status_code == OK
+		etag = client.get(url_for("resources")).headers["ETag"]
+		assert client.get(url_for("resources"), headers={"If-None-Match": etag}).status_code == NOT_MODIFIED
 		assert client.get(url_for("login")).status_code == OK
 		assert client.get(url_for("events")).status_code == OK
 		assert client.get(url_for("fundraisers")).status_code == OK
@@ -49,6 +52,11 @@ class TestSuiteFlask(object):
 		assert client.get(url_for("logout")).status_code == REDIRECT
 		assert client.get(url_for("questions")).status_code == REDIRECT
 		assert client.get(url_for("authorize")).status_code == NOT_FOUND
+		assert client.get(url_for("livez")).status_code == OK
+		assert client.get(url_for("readyz")).status_code == OK
+		metrics = client.get(url_for("metrics"))
+		assert metrics.status_code == OK
+		assert 'http_request_duration_seconds_count{endpoint="index",method="GET",status="200"}' in metrics.get_data(as_text=True)
 		
 		assert app.site_handler.is_authorized is False
 
@@ -122,6 +130,8 @@ class TestSuiteFlask(object):
 		# Test /questions 
 		assert client.get(url_for("questions")).status_code == OK
 		assert client.post(url_for("questions"), data=data).status_code == REDIRECT
+		# The question is gone once answered, so a second answer is rejected
+		assert client.post(url_for("questions"), data=data).status_code == NOT_FOUND
 
 		# Test /points while logged in
 		assert client.get(url_for("points")).status_code == OK
@@ -135,3 +145,36 @@ class TestSuiteFlask(object):
 		assert client.get(url_for("logout")).status_code == REDIRECT
 		assert "state" not in session
 		assert "user" not in session
+
+
+	def test_server_side_sessions(self, client, app):
+		"""The session cookie only holds an opaque id, which changes
+		on login and stops working everywhere after logout.
+
+		Parameters
+		----------
+		client : Client
+			An instance of werkzeug.test.Client
+
+		app : flask.Flask
+            Instance of the application injected as a test fixture
+            by pytest.
+		"""
+		response = client.post(url_for("login"))
+		state = response.location.split("state=")[1]
+		anonymous_id = response.headers["Set-Cookie"].split(";")[0].split("=", 1)[1]
+		query_string = {
+			"state": state,
+			"name": "Woldemichael, Simon",
+			"email": "simon.woldemichael@ttu.edu",
+		}
+		response = client.get(url_for("authorize"), query_string=query_string)
+		session_id = response.headers["Set-Cookie"].split(";")[0].split("=", 1)[1]
+		assert session_id != anonymous_id
+		assert "simon" not in session_id
+
+		replay = app.test_client()
+		replay.set_cookie("session", session_id)
+		assert replay.get(url_for("points")).status_code == OK
+		assert client.get(url_for("logout")).status_code == REDIRECT
+		assert replay.get(url_for("points")).status_code == REDIRECT
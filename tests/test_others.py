@@ -2,31 +2,343 @@
 
 """Tests for helper functions and specific decorators."""
 
+import gzip
+import json
+import logging
+import subprocess
 import threading
 
 from datetime import datetime
-from time import sleep
+from time import monotonic, sleep
+from uuid import uuid4
 
+from flask import Flask
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+
+from engineering_diplomats.compression import Compress
+from engineering_diplomats.logging_pipeline import LogPipeline, RingBuffer
+from engineering_diplomats.metrics import Registry, SharedMetrics
+from engineering_diplomats.settings import get_calendar_service, startup_timings
+from engineering_diplomats.tracing import BoundedTransport, RateLimitedSampler, sampler_from_environment
+from engineering_diplomats.services import CalendarIndex, LocalTransport, NotificationDispatcher, Readiness, RSVPWriter, Snapshot
 from engineering_diplomats.utilities import get_events, send_text_message, update_event
+from engineering_diplomats.views.caching import cached_page, data_version
+from engineering_diplomats.workers import WorkerPool, task_pool
 
 import pytest
 
+
+class FakeCalendar(object):
+	"""Stand-in for the Calendar v3 service that serves one
+	page of changes per events().list().execute() call, or
+	raises the page if it is an exception."""
+	def __init__(self, pages):
+		self.pages = pages
+		self.requests = []
+
+	def events(self):
+		return self
+
+	def list(self, **kwargs):
+		self.requests.append(kwargs)
+		return self
+
+	def execute(self):
+		page = self.pages.pop(0)
+		if isinstance(page, Exception):
+			raise page
+		return page
+
+
+class FakeEvent(object):
+	"""Stand-in for a single Calendar event that enforces If-Match
+	and lets the test inject one conflicting write."""
+	def __init__(self):
+		self.event = {"id": "info-session", "etag": "0", "attendees": []}
+		self.patches = 0
+		self.conflict = True
+		self.headers = {}
+
+	def events(self):
+		return self
+
+	def get(self, **kwargs):
+		self.call = lambda: dict(self.event)
+		return self
+
+	def patch(self, body, **kwargs):
+		def call():
+			if self.conflict:
+				self.conflict = False
+				self.event = dict(self.event, etag="1", attendees=[{"email": "other@ttu.edu"}])
+			if self.headers.get("If-Match") != self.event["etag"]:
+				raise HttpError(Response({"status": 412}), b"Precondition Failed")
+			self.patches += 1
+			self.event = dict(self.event, etag=str(int(self.event["etag"]) + 1), **body)
+			return dict(self.event)
+		self.call = call
+		self.headers = {}
+		return self
+
+	def execute(self):
+		return self.call()
+
+
 class TestSuiteOther(object):
 
 	def test_send_text(self):
-		"""Send a text message. Sleeps current thread until
-		the task thread used to send the text has died.
+		"""Send a text message. Blocks until the worker
+		pool used to send the text is idle.
 		"""
+		failed = task_pool.stats["failed"]
 		assert send_text_message(f"Ran test at {datetime.now()}") is None
-		task_thread = None
-		for thread in threading.enumerate():
-			if thread.name == "send_text_message":
-				task_thread = thread
-				break
-		while task_thread.is_alive():
-			sleep(1)
+		task_pool.join()
+		assert task_pool.stats["failed"] == failed
+
+
+	def test_worker_pool(self):
+		"""Overflowing tasks are rejected or run on the caller."""
+		ran = []
+		release = threading.Event()
+		pool = WorkerPool(workers=1, queue_size=1, overflow="reject", name="test")
+		assert pool.submit(release.wait)
+		sleep(0.1)
+		assert pool.submit(ran.append, 1)
+		assert not pool.submit(ran.append, 2)
+		release.set()
+		pool.join()
+		assert ran == [1]
+		assert pool.stats["rejected"] == 1
+		assert pool.stats["completed"] == 2
+
+		pool.overflow = "caller_runs"
+		assert pool.submit(ran.append, 3)
+		assert pool.drain(timeout=5)
+		assert pool.stats["queued"] == 0
+
+		# A full queue does not hold up the drain past its timeout
+		release.clear()
+		pool = WorkerPool(workers=1, queue_size=1, overflow="reject", name="test")
+		pool.submit(release.wait)
+		sleep(0.1)
+		pool.submit(ran.append, 4)
+		started = monotonic()
+		assert not pool.drain(timeout=0.2)
+		assert monotonic() - started < 1
+		release.set()
+
+
+	def test_readiness(self):
+		"""Readiness fails when memcached is unreachable
+		and reports the cached result until it is refreshed."""
+		class Stub(object):
+			def __init__(self, **attributes):
+				self.__dict__.update(attributes)
+
+		servers = {"memcached:11211": {}}
+		topology = Stub(has_writable_server=lambda: True)
+		db = Stub(client=Stub(topology_description=topology), cache=Stub(client=Stub(stats=lambda: servers)))
+		readiness = Readiness(db, WorkerPool(workers=1, queue_size=10, name="test"), ttl=60)
+		assert readiness.check() == (False, {"mongo": True, "memcached": False, "workers": True})
+		servers["memcached:11211"] = {"pid": "1"}
+		assert readiness.check()[0] is False
+		readiness.snapshot.invalidate()
+		assert readiness.check()[0] is True
+
+
+	def test_cached_page(self):
+		"""A cached page is rendered again once its data version changes."""
+		app = Flask(__name__)
+		app.secret_key = "test"
+		data = {"fundraiser": "Bake sale"}
+		path = f"/{uuid4().hex}"
+
+		@app.route(path)
+		@cached_page(version=lambda: data_version(data))
+		def page():
+			return data["fundraiser"]
+
+		client = app.test_client()
+		assert client.get(path).data == b"Bake sale"
+		data["fundraiser"] = "Car wash"
+		assert client.get(path).data == b"Car wash"
+
+
+	def test_compress(self):
+		"""Large text responses are gzipped in one piece or chunk by chunk,
+		and small or already encoded responses are passed through."""
+		def application(environ, start_response):
+			headers = [("Content-Type", "text/html; charset=utf-8"), ("ETag", '"page"')]
+			if environ["PATH_INFO"] == "/small":
+				start_response("200 OK", headers + [("Content-Length", "5")])
+				return [b"small"]
+			if environ["PATH_INFO"] == "/stream":
+				start_response("200 OK", headers)
+				return (b"<p>%d</p>" % i * 100 for i in range(3))
+			if environ["PATH_INFO"] == "/write":
+				start_response("200 OK", headers)(b"<p>written</p>" * 50)
+				return [b"<p>returned</p>"]
+			start_response("200 OK", headers + [("Content-Length", "1000")])
+			return [b"a" * 1000]
+
+		def get(path, accept_encoding="gzip, deflate"):
+			response = {}
+			def start_response(status, headers, exc_info=None):
+				response.update(status=status, headers=dict(headers))
+			environ = {"PATH_INFO": path, "REQUEST_METHOD": "GET", "HTTP_ACCEPT_ENCODING": accept_encoding}
+			body = b"".join(Compress(application, min_size=500)(environ, start_response))
+			return response["headers"], body
+
+		headers, body = get("/")
+		assert headers["Content-Encoding"] == "gzip"
+		assert headers["ETag"] == '"page-gzip"'
+		assert int(headers["Content-Length"]) == len(body)
+		assert gzip.decompress(body) == b"a" * 1000
+
+		headers, body = get("/stream")
+		assert "Content-Length" not in headers
+		assert gzip.decompress(body).startswith(b"<p>0</p>")
+
+		headers, body = get("/write")
+		assert gzip.decompress(body) == b"<p>written</p>" * 50 + b"<p>returned</p>"
+
+		# Uncompressed text still varies with Accept-Encoding for shared caches
+		headers, body = get("/small")
+		assert "Content-Encoding" not in headers and body == b"small"
+		assert headers["Vary"] == "Accept-Encoding"
+		headers, body = get("/", accept_encoding="identity")
+		assert "Content-Encoding" not in headers and body == b"a" * 1000
+		assert headers["Vary"] == "Accept-Encoding"
+
 
-		assert not task_thread.is_alive()
+	def test_metrics(self, tmpdir):
+		"""Histograms render cumulative buckets, estimate quantiles
+		and are added up across worker processes."""
+		registry = Registry()
+		histogram = registry.histogram("call_seconds", "Call time.", ("dependency",), buckets=(0.1, 1.0))
+		for seconds in (0.05, 0.05, 0.5, 2.0):
+			histogram.labels("mongo").observe(seconds)
+		registry.counter("calls_total", "Calls.").inc(4)
+
+		text = registry.render()
+		assert 'call_seconds_bucket{dependency="mongo",le="0.1"} 2' in text
+		assert 'call_seconds_bucket{dependency="mongo",le="+Inf"} 4' in text
+		assert 'call_seconds_count{dependency="mongo"} 4' in text
+		assert "calls_total 4" in text
+		assert histogram.labels("mongo").quantile(0.5) == pytest.approx(0.1)
+		with pytest.raises(ValueError):
+			registry.counter("call_seconds", "Not a histogram.", ("dependency",))
+
+		shared = SharedMetrics(registry, str(tmpdir))
+		with open(str(tmpdir.join("1.json")), "w") as sibling:
+			sibling.write(json.dumps(registry.snapshot()))
+		assert "calls_total 8" in shared.render()
+
+		# An exited worker's counters are archived rather than dropped
+		exited = subprocess.Popen(["true"])
+		exited.wait()
+		with open(str(tmpdir.join(f"{exited.pid}.json")), "w") as sibling:
+			sibling.write(json.dumps(registry.snapshot()))
+		assert "calls_total 12" in shared.render()
+		assert not tmpdir.join(f"{exited.pid}.json").check()
+		text = shared.render()
+		assert "calls_total 12" in text
+		assert 'call_seconds_count{dependency="mongo"} 12' in text
+
+
+	def test_tracing(self, monkeypatch):
+		"""Samplers are chosen by environment variable, the rate limiter
+		caps sampled requests, and a full export queue drops spans."""
+		monkeypatch.setenv("TRACE_SAMPLER", "rate_limited")
+		monkeypatch.setenv("TRACE_RATE_LIMIT", "2")
+		sampler = sampler_from_environment()
+		assert isinstance(sampler, RateLimitedSampler)
+		assert [sampler.should_sample(None) for _ in range(3)] == [True, True, False]
+		monkeypatch.setenv("TRACE_SAMPLER", "off")
+		assert sampler_from_environment() is None
+
+		emitted = []
+		class Exporter(object):
+			def emit(self, span_datas):
+				emitted.extend(span_datas)
+
+		transport = BoundedTransport(Exporter(), queue_size=1, wait=60)
+		transport.export(["root", "child"])
+		transport.export(["dropped"])
+		transport.flush()
+		assert emitted == ["root", "child"]
+		assert transport.stats == {"exported": 2, "dropped": 1, "failed": 0, "queued": 0}
+
+
+	def test_log_pipeline(self, tmpdir):
+		"""Records are written as JSON lines to a rotated file, and a
+		full queue drops its oldest records instead of blocking."""
+		filename = str(tmpdir.join("main.log"))
+		pipeline = LogPipeline(filename, max_bytes=2048, backup_count=2, batch_size=10, level="INFO")
+		pipeline.start()
+		logger = logging.getLogger("engineering_diplomats.test")
+		for i in range(50):
+			logger.info("record %d", i, extra={"email": "diplomat@ttu.edu"})
+		pipeline.stop()
+
+		assert tmpdir.join("main.log.1").check()
+		lines = [json.loads(line) for line in tmpdir.join("main.log").readlines()]
+		assert lines[-1]["message"] == "record 49"
+		assert lines[-1]["severity"] == "INFO"
+		assert lines[-1]["email"] == "diplomat@ttu.edu"
+
+		buffer = RingBuffer(capacity=2)
+		for record in ("first", "second", "third"):
+			buffer.put_nowait(record)
+		assert buffer.dropped == 1
+		assert [buffer.get(), buffer.get()] == ["second", "third"]
+
+
+	def test_notification_dispatcher(self, monkeypatch):
+		"""Notifications within one window are sent as a single digest,
+		and sends beyond the rate limit wait for the next token."""
+		transport = LocalTransport()
+		dispatcher = NotificationDispatcher(transport, window=0.1, rate=2, burst=1)
+		for i in range(3):
+			dispatcher.notify(f"a{i}@ttu.edu has successfully RSVPed for event info-session.")
+		sleep(0.2)
+		assert transport.sent == ["3 notifications:\n" + "\n".join(
+			f"a{i}@ttu.edu has successfully RSVPed for event info-session." for i in range(3))]
+
+		# The bucket is empty, so the next digest waits about 1 / rate seconds
+		dispatcher.notify("Error: first")
+		dispatcher.notify("Error: second")
+		sleep(0.15)
+		assert len(transport.sent) == 1
+		sleep(0.4)
+		assert transport.sent[1] == "2 notifications:\nError: first\nError: second"
+		assert dispatcher.stats == {"notified": 5, "sent": 2, "failed": 0, "pending": 0}
+
+		# Closing sends what is pending at once, regardless of the rate limit
+		dispatcher.notify("Error: third")
+		dispatcher.close()
+		assert transport.sent[2] == "Error: third"
+
+		# The pod's rate limit is shared between its worker processes
+		monkeypatch.setenv("SMS_TRANSPORT", "local")
+		monkeypatch.setenv("SMS_RATE_LIMIT", "6")
+		monkeypatch.setenv("WEB_CONCURRENCY", "2")
+		dispatcher = NotificationDispatcher.from_environment()
+		assert dispatcher.rate == 0.05
+		assert dispatcher.burst == 1.5
+		monkeypatch.setenv("SMS_RATE_LIMIT", "0")
+		with pytest.raises(ValueError):
+			NotificationDispatcher.from_environment()
+
+
+	def test_calendar_service(self):
+		"""The Calendar service is built once, on first use,
+		from the vendored discovery document."""
+		service = get_calendar_service()
+		assert get_calendar_service() is service
+		assert "calendar_service" in startup_timings
+		assert service.events().list(calendarId="primary").uri.startswith("https://www.googleapis.com/calendar/v3/")
 
 
 	def test_get_events(self):
@@ -35,3 +347,99 @@ class TestSuiteOther(object):
 		all_events = get_events()
 		for event in all_events:
 			assert len(event) == 5
+
+
+	def test_snapshot(self, monkeypatch):
+		"""Stale snapshots are served while a single refresh runs,
+		and invalidated snapshots are reloaded on the next read."""
+		calls = []
+		def loader():
+			calls.append(len(calls))
+			return len(calls)
+
+		snapshot = Snapshot(loader, ttl=0.5)
+		assert snapshot.get() == 1
+		assert snapshot.get() == 1
+		assert len(calls) == 1
+
+		# Once stale, the old value is returned and refreshed in the background
+		sleep(0.6)
+		assert snapshot.get() == 1
+		sleep(0.2)
+		assert snapshot.get() == 2
+
+		# Invalidation forces a synchronous reload
+		snapshot.invalidate()
+		assert snapshot.get() == 3
+
+		# A refresh rejected by the pool is retried on a later read
+		sleep(0.6)
+		monkeypatch.setattr(task_pool, "submit", lambda *args, **kwargs: False)
+		assert snapshot.get() == 3
+		monkeypatch.undo()
+		assert snapshot.get() == 3
+		sleep(0.2)
+		assert snapshot.get() == 4
+
+
+	def test_calendar_index(self):
+		"""Incremental syncs only apply the events that changed."""
+		event = {
+			"id": "info-session",
+			"summary": "Info Session",
+			"location": "Livermore Center",
+			"start": {"dateTime": "2099-01-01T10:00:00-06:00"},
+			"end": {"dateTime": "2099-01-01T11:00:00-06:00"},
+		}
+		moved = dict(event, start={"dateTime": "2099-01-02T10:00:00-06:00"},
+			end={"dateTime": "2099-01-02T11:00:00-06:00"}, attendees=[{"email": "diplomat@ttu.edu"}])
+		service = FakeCalendar([
+			{"items": [event], "nextSyncToken": "first"},
+			{"items": [moved], "nextSyncToken": "second"},
+			{"items": [{"id": "info-session", "status": "cancelled"}], "nextSyncToken": "third"},
+		])
+		index = CalendarIndex(lambda: service)
+
+		assert index.sync() == 1
+		assert index.upcoming() == [["Info Session", "01/01/2099 at 10:00 AM", "Livermore Center", None, "info-session"]]
+		assert index.sync() == 1
+		assert service.requests[1]["syncToken"] == "first"
+		assert index.upcoming()[0][1:4] == ["01/02/2099 at 10:00 AM", "Livermore Center", ["diplomat@ttu.edu"]]
+		assert index.sync() == 1
+		assert index.upcoming() == []
+		assert index.sync_token == "third"
+		assert "timeMin" in service.requests[0] and "timeMin" not in service.requests[1]
+
+		# An expired sync token rebuilds the index from a full sync
+		service.pages = [
+			HttpError(Response({"status": 410}), b"Gone"),
+			{"items": [event], "nextSyncToken": "fourth"},
+		]
+		assert index.sync() == 1
+		assert service.requests[-2]["syncToken"] == "third"
+		assert "syncToken" not in service.requests[-1] and "timeMin" in service.requests[-1]
+		assert index.upcoming() == [["Info Session", "01/01/2099 at 10:00 AM", "Livermore Center", None, "info-session"]]
+		assert index.sync_token == "fourth"
+
+
+	def test_rsvp_writer(self):
+		"""RSVPs within one window are written as a single conditional
+		patch that survives a concurrent change to the event."""
+		service = FakeEvent()
+		writer = RSVPWriter(lambda: service, window=0.1)
+		futures = [
+			writer.submit("a@ttu.edu", "info-session", False),
+			writer.submit("b@ttu.edu", "info-session", False),
+			writer.submit("a@ttu.edu", "info-session", True),
+		]
+		event = futures[0].result(timeout=5)
+		assert all(future.result(timeout=5) is event for future in futures)
+		assert service.patches == 1
+		assert [a["email"] for a in event["attendees"]] == ["other@ttu.edu", "b@ttu.edu"]
+
+		# A failing on_write callback does not fail RSVPs that were saved
+		def on_write(event):
+			raise RuntimeError("cache unavailable")
+		writer = RSVPWriter(lambda: service, window=0.1, on_write=on_write)
+		event = writer.submit("c@ttu.edu", "info-session", False).result(timeout=5)
+		assert "c@ttu.edu" in [a["email"] for a in event["attendees"]]